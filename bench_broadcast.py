@@ -0,0 +1,132 @@
+"""Рассылка: BroadcastEngine против прежней отправки по одному сообщению.
+
+Сообщения уходят через настоящий клиент бота (main4.bot) на локальный сервер,
+который изображает Bot API: отвечает с задержкой BOT_API_LATENCY и, как
+Telegram, возвращает 429 с retry_after, если за последнюю секунду к нему уже
+поступило SERVER_RATE сообщений или в личный чат - больше одного. Показаны
+устойчивая скорость (сообщений в секунду), число ответов 429 и наибольшее число
+сообщений, принятых сервером за одну секунду.
+
+Запуск: python bench_broadcast.py [число получателей]
+По умолчанию - 1500 получателей (около минуты при 30 сообщениях в секунду);
+прежний способ проверяется на первых 200.
+"""
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import telebot
+
+# Бот создаётся при импорте main4; запросы уходят на локальный сервер, поэтому токен - заглушка
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+
+import main4
+
+SERVER_RATE = 30  # сообщений в секунду, после которых сервер отвечает 429
+BOT_API_LATENCY = (0.03, 0.15)  # секунд на ответ сервера
+LEGACY_SAMPLE = 200
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    recent = collections.deque()  # моменты принятых сообщений за последнюю секунду
+    chat_last = {}
+    per_second = collections.Counter()
+    too_many = 0
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update({key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()})
+        chat_id = int(params.get('chat_id', 0))
+        cls = type(self)
+        with cls.lock:
+            now = time.monotonic()
+            while cls.recent and cls.recent[0] <= now - 1:
+                cls.recent.popleft()
+            if len(cls.recent) >= SERVER_RATE or now - cls.chat_last.get(chat_id, -10) < 1:
+                cls.too_many += 1
+                status, body = 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                     'parameters': {'retry_after': 1}}
+            else:
+                cls.recent.append(now)
+                cls.chat_last[chat_id] = now
+                cls.per_second[int(now)] += 1
+                status, body = 200, {'ok': True, 'result': {
+                    'message_id': 1, 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}}}
+        # Запрос учтён в момент поступления, ответ уходит после обработки
+        time.sleep(random.uniform(*BOT_API_LATENCY))
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.recent.clear()
+            cls.chat_last.clear()
+            cls.per_second.clear()
+            cls.too_many = 0
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+    return server
+
+def legacy_broadcast(recipients):
+    """Прежняя рассылка: по одному сообщению с паузой 0.05 с"""
+    stats = collections.Counter()
+    for recipient_id in recipients:
+        try:
+            main4.bot.send_message(recipient_id, "Тест рассылки")
+            stats['sent'] += 1
+            time.sleep(0.05)
+        except telebot.apihelper.ApiException:
+            stats['failed'] += 1
+    return stats
+
+def engine_broadcast(recipients):
+    engine = main4.BroadcastEngine(lambda recipient_id: main4.bot.send_message(recipient_id, "Тест рассылки"))
+    return engine.run(recipients)
+
+def measure(name, func, recipients):
+    FakeBotApi.reset()
+    started = time.perf_counter()
+    stats = func(recipients)
+    elapsed = time.perf_counter() - started
+    # Крайние секунды неполные, поэтому в пиковую скорость не входят
+    busiest = max(sorted(FakeBotApi.per_second.values())[1:-1] or FakeBotApi.per_second.values() or [0])
+    print(f"{name:<10} {len(recipients):>11} {stats['sent']:>11} {elapsed:>8.1f} "
+          f"{stats['sent'] / elapsed:>10.1f} {FakeBotApi.too_many:>6} {busiest:>13}")
+
+def main(recipient_count):
+    start_server()
+    recipients = [str(100000000 + i) for i in range(recipient_count)]
+    print(f"Сервер: не больше {SERVER_RATE} сообщений в секунду, задержка ответа "
+          f"{BOT_API_LATENCY[0] * 1000:.0f}-{BOT_API_LATENCY[1] * 1000:.0f} мс")
+    print(f"{'способ':<10} {'получателей':>11} {'отправлено':>11} {'время, с':>8} "
+          f"{'сообщ./с':>10} {'429':>6} {'пик за 1 с':>13}")
+    measure('прежний', legacy_broadcast, recipients[:LEGACY_SAMPLE])
+    measure('движок', engine_broadcast, recipients)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1500)
@@ -0,0 +1,79 @@
+"""Поиск пользователей: индекс (префиксы и триграммы) против прежнего прохода по всем.
+
+Прежний поиск - search_user_step до индекса: lower() и проверка подстроки в
+username, имени и фамилии каждого пользователя. Индекс - search_index.search
+(см. SearchIndex). Показаны время построения индекса, прирост памяти (RSS) и
+среднее время запроса для запросов разной избирательности.
+
+Запуск: python bench_search.py [число пользователей ...]
+По умолчанию - 1 000 000 пользователей.
+"""
+import os
+import random
+import resource
+import sys
+import time
+
+# Бот создаётся при импорте main4; для замеров достаточно токена-заглушки
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+
+import main4
+
+FIRST_NAMES = ['Александр', 'Мария', 'Иван', 'Ольга', 'Сергей', 'Алёна', 'John', 'Kate', 'Alexey', 'Natalia']
+LAST_NAMES = ['Иванов', 'Смирнова', 'Кузнецов', 'Цветкова', 'Petrov', 'Smith', 'Хабибуллин', None]
+QUERIES = ['Цветк', 'tsvetk', 'алёна', 'user_12345', 'иванов', 'Фам1234', 'андр', 'zzz']
+
+def make_users(user_count):
+    rnd = random.Random(user_count)
+    users = main4.RecordStore(main4.UserRecord)
+    for i in range(user_count):
+        user_id = str(100000000 + i * 7)
+        users[user_id] = {
+            'id': user_id,
+            'first_name': rnd.choice(FIRST_NAMES) if rnd.random() < 0.5 else f"Имя{rnd.randrange(50000)}",
+            'last_name': rnd.choice(LAST_NAMES) if rnd.random() < 0.5 else f"Фам{rnd.randrange(50000)}",
+            'username': rnd.choice([None, f"user_{i}"]),
+            'messages_count': rnd.randrange(5000),
+            'reactions_received': rnd.randrange(500),
+        }
+    return users
+
+def linear_search(users, search_query):
+    """Прежний поиск: проход по всем пользователям"""
+    search_query = search_query.lower()
+    return [
+        user for user in users.values()
+        if search_query in (user['username'] or '').lower()
+        or search_query in (user['first_name'] or '').lower()
+        or search_query in (user['last_name'] or '').lower()
+    ]
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # КБ -> МБ (Linux)
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat, result
+
+def main(user_counts):
+    for user_count in user_counts:
+        users = make_users(user_count)
+        main4.users = users
+        main4.search_index.reset()
+        before = rss_mb()
+        started = time.perf_counter()
+        main4.search_index._ensure_built()
+        build_seconds = time.perf_counter() - started
+        print(f"\nПользователей: {user_count}")
+        print(f"Построение индекса: {build_seconds:.1f} с, пик RSS +{rss_mb() - before:.0f} МБ")
+        print(f"{'запрос':<12} {'найдено':>8} {'проход, мс':>11} {'индекс, мс':>11} {'найдено проходом':>17}")
+        for search_query in QUERIES:
+            scan_seconds, scanned = timed(lambda: linear_search(users, search_query), 1)
+            index_seconds, found = timed(lambda: main4.query_search_users(search_query, main4.SEARCH_PAGE_SIZE), 20)
+            print(f"{search_query:<12} {found[1]:>8} {scan_seconds * 1000:>11.1f} "
+                  f"{index_seconds * 1000:>11.2f} {len(scanned):>17}")
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1000000])
@@ -0,0 +1,111 @@
+"""Сравнение форматов снимка: время загрузки и пиковая память (RSS).
+
+legacy - прежний запуск: json.load одного data.json в обычные словари.
+json и binary - текущий запуск: шарды в выбранном формате и перевод в записи.
+Для них также показано, через сколько бот начинает работу, если пользователи
+догружаются в фоне (load_records(..., background=True)).
+
+Запуск: python bench_snapshot.py [число пользователей ...]
+По умолчанию сравниваются 100 000 и 1 000 000 пользователей. Каждая загрузка
+выполняется в отдельном процессе, чтобы пиковая память не смешивалась.
+"""
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Бот создаётся при импорте main4; для замеров достаточно токена-заглушки
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+
+import main4
+
+FORMATS = ('legacy', 'json', 'binary')
+
+def make_data(user_count):
+    rnd = random.Random(user_count)
+    users = {}
+    for i in range(user_count):
+        user_id = str(100000000 + i * 7)
+        users[user_id] = {
+            'id': user_id,
+            'first_name': f"Имя{rnd.randrange(10000)}",
+            'last_name': rnd.choice([None, f"Фамилия{rnd.randrange(10000)}"]),
+            'username': rnd.choice([None, f"user_{i}"]),
+            'joined_at': f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 12:00:00",
+            'messages_count': rnd.randrange(5000),
+            'reactions_received': rnd.randrange(500),
+            'chats': [str(-1000 - rnd.randrange(200)) for _ in range(rnd.randrange(3))],
+            'channels': [],
+            'language': rnd.choice(['ru', 'en']),
+        }
+    chats = {
+        str(-1000 - i): {'id': str(-1000 - i), 'title': f"Чат {i}", 'type': 'supergroup', 'members': [],
+                         'messages_count': 0, 'created_at': '2024-01-01 00:00:00'}
+        for i in range(200)
+    }
+    return {'users': users, 'chats': chats, 'channels': {}}
+
+def prepare(directory, data):
+    """Записывает одни и те же данные во всех сравниваемых форматах"""
+    # Прежний формат: один data.json с отступами
+    with open(os.path.join(directory, 'legacy.json'), 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    for snapshot_format in ('json', 'binary'):
+        main4.JsonStorage(**storage_args(directory, snapshot_format)).write_data(data, 0)
+
+def storage_args(directory, snapshot_format):
+    return {
+        'data_dir': os.path.join(directory, snapshot_format),
+        'journal_file': os.path.join(directory, 'data.journal'),
+        'legacy_file': os.path.join(directory, 'missing.json'),
+        'snapshot_format': snapshot_format,
+    }
+
+def file_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+def measure_load(directory, snapshot_format):
+    """Выполняется в дочернем процессе: загружает снимок и печатает время и пиковую память"""
+    started = time.perf_counter()
+    serving = None
+    if snapshot_format == 'legacy':
+        with open(os.path.join(directory, 'legacy.json'), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    else:
+        # Как при запуске бота: загрузка шардов и перевод в компактные записи, пользователи - в фоне
+        data, loader = main4.load_records(main4.JsonStorage(**storage_args(directory, snapshot_format)), background=True)
+        serving = time.perf_counter() - started
+        loader.wait()
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # КБ -> МБ (Linux)
+    print(json.dumps({'seconds': elapsed, 'serving_seconds': serving, 'peak_rss_mb': peak_rss, 'users': len(data['users'])}))
+
+def main(user_counts):
+    for user_count in user_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            prepare(directory, make_data(user_count))
+            print(f"\nПользователей: {user_count}")
+            print(f"{'формат':<8} {'размер, МБ':>11} {'загрузка, с':>12} {'до работы, с':>13} {'пик RSS, МБ':>12}")
+            for snapshot_format in FORMATS:
+                output = subprocess.run(
+                    [sys.executable, __file__, '--load', directory, snapshot_format],
+                    check=True, capture_output=True, text=True
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                path = os.path.join(directory, 'legacy.json' if snapshot_format == 'legacy' else snapshot_format)
+                serving = result['serving_seconds']
+                serving_text = f"{serving:.2f}" if serving is not None else '-'
+                print(f"{snapshot_format:<8} {file_size(path) / 1024 / 1024:>11.1f} "
+                      f"{result['seconds']:>12.2f} {serving_text:>13} {result['peak_rss_mb']:>12.0f}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--load':
+        measure_load(sys.argv[2], sys.argv[3])
+    else:
+        main([int(n) for n in sys.argv[1:]] or [100000, 1000000])
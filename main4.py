@@ -5,13 +5,31 @@ import psutil
 import telebot
 from telebot import types
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from logging.handlers import RotatingFileHandler
 import time
+import threading
+import sqlite3
+import itertools
+import zlib
+import marshal
+import gc
+import calendar
+import functools
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import struct
+import codecs
+import bisect
+import heapq
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 # Инициализация бота
-bot = telebot.TeleBot('')
+# Токен можно задать переменной окружения BOT_TOKEN (её же задают тесты и замеры)
+bot = telebot.TeleBot(os.environ.get('BOT_TOKEN', ''))
 
 # Настройка логирования
 log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
@@ -43,32 +61,2437 @@ EMOJI = {
 # Глобальные переменные для хранения данных
 users, chats, channels = {}, {}, {}
 
-def save_data():
-    try:
-        data = {'users': users, 'chats': chats, 'channels': channels}
-        with open('data.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.info("Данные успешно сохранены")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении данных: {str(e)}")
-        # Можно добавить резервное сохранение или уведомление администратора
-        bot.send_message(SUPER_ADMIN_ID, f"{EMOJI['error']} Ошибка при сохранении данных: {str(e)}")
+# Компактное представление записей в памяти
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_EMPTY_LIST = ()  # общий маркер пустого списка; настоящий список создаётся при первом обращении
+_MISSING = object()
+CHAT_TOP_SIZE = 10  # участников в рейтинге чата, который поддерживается постоянно
+# Скользящие окна рейтинга активности: название -> длина в часах
+RATING_WINDOWS = {'day': 24, 'week': 7 * 24, 'month': 30 * 24}
+RATING_WINDOW_HOURS = max(RATING_WINDOWS.values())  # столько часов истории хранится у пользователя
+
+@functools.lru_cache(maxsize=4096)
+def _day_start(date_text):
+    return calendar.timegm((int(date_text[:4]), int(date_text[5:7]), int(date_text[8:10]), 0, 0, 0, 0, 0, 0))
+
+def parse_timestamp(value):
+    """Строка "%Y-%m-%d %H:%M:%S" -> число секунд (время берётся как есть, без часового пояса)"""
+    if type(value) is str and len(value) == 19 and value[4] == '-' and value[13] == ':':
+        try:
+            hours, minutes, seconds = value[11:].split(':')
+            return _day_start(value[:10]) + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        except ValueError:
+            pass
+    return value
+
+def format_timestamp(value):
+    if isinstance(value, int):
+        return time.strftime(TIMESTAMP_FORMAT, time.gmtime(value))
+    return value
+
+def current_hour():
+    """Номер текущего часа от начала эпохи (UTC) - ключ корзин ActivityWindow"""
+    return int(time.time() // 3600)
+
+class MemberCounters(MutableMapping):
+    """Счётчики участников одного чата: {id пользователя: значение}.
+
+    Хранятся двумя массивами (id и значения), отсортированными по id, - около
+    16 байт на участника вместо сотни у словаря. Лучшие CHAT_TOP_SIZE участников
+    поддерживаются при каждом изменении, поэтому топ чата не требует сортировки.
+    """
+
+    __slots__ = ('_ids', '_values', '_top')
+
+    def __init__(self, values=None, owner=None):
+        # owner (запись, которой принадлежат счётчики) нужен только ActivityWindow
+        items = sorted((int(user_id), value) for user_id, value in (values or {}).items())
+        self._ids = array('q', [user_id for user_id, _ in items])
+        self._values = array('q', [value for _, value in items])
+        # Лучшие участники: [(-значение, id), ...] по возрастанию; None - пересчитать при запросе
+        self._top = None
+
+    def _index(self, user_id):
+        i = bisect.bisect_left(self._ids, user_id)
+        return i if i < len(self._ids) and self._ids[i] == user_id else -1
+
+    def __getitem__(self, user_id):
+        i = self._index(int(user_id))
+        if i < 0:
+            raise KeyError(user_id)
+        return self._values[i]
+
+    def __setitem__(self, user_id, value):
+        user_id = int(user_id)
+        i = bisect.bisect_left(self._ids, user_id)
+        if i < len(self._ids) and self._ids[i] == user_id:
+            previous = self._values[i]
+            self._values[i] = value
+        else:
+            previous = None
+            self._ids.insert(i, user_id)
+            self._values.insert(i, value)
+        self._update_top(user_id, value, previous)
+
+    def __delitem__(self, user_id):
+        i = self._index(int(user_id))
+        if i < 0:
+            raise KeyError(user_id)
+        del self._ids[i]
+        del self._values[i]
+        self._top = None
+
+    def __iter__(self):
+        return (str(user_id) for user_id in self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _update_top(self, user_id, value, previous):
+        top = self._top
+        if top is None:
+            return
+        for position, (_, top_id) in enumerate(top):
+            if top_id == user_id:
+                if previous is not None and value < previous:
+                    # Значение уменьшилось: на это место мог претендовать кто-то вне топа
+                    self._top = None
+                else:
+                    top[position] = (-value, user_id)
+                    top.sort()
+                return
+        if len(top) < CHAT_TOP_SIZE or (-value, user_id) < top[-1]:
+            # В неполном топе уже все участники, иначе вытесняем худшего
+            top.append((-value, user_id))
+            top.sort()
+            del top[CHAT_TOP_SIZE:]
+
+    def top(self, n=CHAT_TOP_SIZE):
+        """n участников с наибольшими значениями: [(id, значение), ...]"""
+        if n > CHAT_TOP_SIZE:
+            best = heapq.nsmallest(n, zip((-v for v in self._values), self._ids))
+        else:
+            if self._top is None:
+                self._top = heapq.nsmallest(CHAT_TOP_SIZE, zip((-v for v in self._values), self._ids))
+            best = self._top[:n]
+        return [(str(user_id), -value) for value, user_id in best]
+
+    def to_dict(self):
+        return {str(user_id): value for user_id, value in zip(self._ids, self._values)}
+
+    def __repr__(self):
+        return f"MemberCounters({self.to_dict()!r})"
+
+class ActivityWindow(MutableMapping):
+    """Очки активности пользователя по часам: {номер часа (current_hour): очки}.
+
+    Хранятся два массива (часы по возрастанию и очки) только за последние
+    RATING_WINDOW_HOURS часов: более старые корзины отбрасываются при записи,
+    поэтому память на пользователя ограничена. Запись в корзину текущего часа -
+    добавление в конец массива или изменение последнего элемента. Изменения
+    передаются в window_ratings (рейтинги за сутки, неделю и месяц).
+    """
+
+    __slots__ = ('_hours', '_points', 'owner')
+
+    def __init__(self, values=None, owner=None):
+        oldest = current_hour() - RATING_WINDOW_HOURS + 1
+        items = sorted((int(hour), points) for hour, points in (values or {}).items() if int(hour) >= oldest)
+        self._hours = array('q', [hour for hour, _ in items])
+        self._points = array('q', [points for _, points in items])
+        self.owner = owner
+
+    def _index(self, hour):
+        i = bisect.bisect_left(self._hours, hour)
+        return i if i < len(self._hours) and self._hours[i] == hour else -1
+
+    def __getitem__(self, hour):
+        i = self._index(int(hour))
+        if i < 0:
+            raise KeyError(hour)
+        return self._points[i]
+
+    def __setitem__(self, hour, points):
+        if self.owner is None:
+            self._store(int(hour), points)
+            return
+        with window_ratings.lock:
+            window_ratings.advance()
+            hour = int(hour)
+            previous = self._store(hour, points)
+            if previous is not None and points != previous:
+                window_ratings.add_points(self.owner, hour, points - previous)
+
+    def _store(self, hour, points):
+        """Записывает очки часа; возвращает прежние очки или None, если час вне окна"""
+        oldest = current_hour() - RATING_WINDOW_HOURS + 1
+        expired = bisect.bisect_left(self._hours, oldest)
+        if expired:
+            # Эти часы уже вышли из всех окон, рейтинги их не учитывают
+            del self._hours[:expired]
+            del self._points[:expired]
+        if hour < oldest:
+            return None
+        i = bisect.bisect_left(self._hours, hour)
+        if i < len(self._hours) and self._hours[i] == hour:
+            previous = self._points[i]
+            self._points[i] = points
+        else:
+            previous = 0
+            self._hours.insert(i, hour)
+            self._points.insert(i, points)
+        return previous
+
+    def __delitem__(self, hour):
+        i = self._index(int(hour))
+        if i < 0:
+            raise KeyError(hour)
+        if self.owner is None:
+            del self._hours[i]
+            del self._points[i]
+            return
+        with window_ratings.lock:
+            window_ratings.advance()
+            i = self._index(int(hour))
+            if i < 0:
+                raise KeyError(hour)
+            hour, points = self._hours[i], self._points[i]
+            del self._hours[i]
+            del self._points[i]
+            if points:
+                window_ratings.add_points(self.owner, hour, -points)
+
+    def __iter__(self):
+        return (str(hour) for hour in self._hours)
+
+    def __len__(self):
+        return len(self._hours)
+
+    def points_since(self, hour):
+        """Сумма очков за часы начиная с hour"""
+        return sum(self._points[bisect.bisect_left(self._hours, hour):])
+
+    def first_hour_since(self, hour):
+        """Самый ранний час с очками начиная с hour или None"""
+        i = bisect.bisect_left(self._hours, hour)
+        return self._hours[i] if i < len(self._hours) else None
+
+    def to_dict(self):
+        return {str(hour): points for hour, points in zip(self._hours, self._points)}
+
+    def __repr__(self):
+        return f"ActivityWindow({self.to_dict()!r})"
+
+class EntityRecord(MutableMapping):
+    """Запись пользователя, чата или канала со словарным интерфейсом.
+
+    Известные поля лежат в слотах (отсутствующее поле - незаполненный слот),
+    прочие - в словаре _extra. Идентификаторы интернируются, время хранится
+    числом секунд и отдаётся строкой "%Y-%m-%d %H:%M:%S".
+    """
+
+    __slots__ = ('_extra',)
+    FIELDS = ()
+    TIME_FIELDS = frozenset()
+    ID_LIST_FIELDS = frozenset()
+    # Поля с часто повторяющимися строками: хранится одна копия на все записи
+    INTERNED_FIELDS = frozenset({'id'})
+    # Словари-счётчики, хранящиеся компактно: поле -> класс (MemberCounters, ActivityWindow)
+    COUNTER_FIELDS = {}
+    # Список связей, который хранится не в записи, а в индексе участия (membership)
+    MEMBERSHIP_FIELD = None
+    MEMBERSHIP_SIDE = None
+    # Хранилище записей и его списки администратора: порядки (RecordOrder, задаются
+    # после их создания) и поля, показанные в строках списка (см. ListPageCache)
+    STORE_NAME = None
+    ORDERS = ()
+    LIST_FIELDS = frozenset()
+
+    def __init__(self, values=()):
+        self._extra = None
+        self.update(values)
+
+    @classmethod
+    def from_dict(cls, values):
+        # Тот же разбор, что в __setitem__, но без вызова метода на каждое поле: так загружаются миллионы записей
+        record = cls.__new__(cls)
+        record._extra = None
+        field_kinds = cls._field_kinds
+        intern = sys.intern
+        membership_value = None
+        for key, value in values.items():
+            kind = field_kinds.get(key)
+            if kind is None:
+                record[key] = value
+                continue
+            if kind == 'membership':
+                # Индекс ведётся по id записи, поэтому связи добавляются после всех полей
+                membership_value = value
+                continue
+            if kind == 'time':
+                value = parse_timestamp(value)
+            elif kind == 'id_list':
+                if value == []:
+                    value = _EMPTY_LIST
+                elif type(value) is list:
+                    value = [intern(item) if type(item) is str else item for item in value]
+            elif kind == 'interned' and type(value) is str:
+                value = intern(value)
+            elif kind == 'counters':
+                counter_type = cls.COUNTER_FIELDS[key]
+                if type(value) is not counter_type:
+                    value = counter_type(value, record)
+            setattr(record, key, value)
+        if membership_value is not None:
+            record[cls.MEMBERSHIP_FIELD] = membership_value
+        return record
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+        cls._field_kinds = {
+            field: 'time' if field in cls.TIME_FIELDS else 'id_list' if field in cls.ID_LIST_FIELDS
+            else 'interned' if field in cls.INTERNED_FIELDS else 'counters' if field in cls.COUNTER_FIELDS
+            else 'plain'
+            for field in cls.FIELDS
+        }
+        if cls.MEMBERSHIP_FIELD:
+            cls._field_kinds[cls.MEMBERSHIP_FIELD] = 'membership'
+
+    def __getitem__(self, key):
+        if key == self.MEMBERSHIP_FIELD:
+            return MembershipView(self.MEMBERSHIP_SIDE, self.id)
+        if key in self._field_set:
+            value = getattr(self, key, _MISSING)
+            if value is _MISSING:
+                raise KeyError(key)
+            if key in self.TIME_FIELDS:
+                return format_timestamp(value)
+            if value is _EMPTY_LIST:
+                # Список могут изменить на месте, поэтому сохраняем настоящий
+                value = []
+                setattr(self, key, value)
+            return value
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key == self.MEMBERSHIP_FIELD:
+            self._set_membership(value)
+        elif key in self._field_set:
+            if key in self.TIME_FIELDS:
+                value = parse_timestamp(value)
+            elif key in self.ID_LIST_FIELDS and isinstance(value, list):
+                if value:
+                    value[:] = [sys.intern(item) if isinstance(item, str) else item for item in value]
+                else:
+                    value = _EMPTY_LIST
+            elif key in self.INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            elif key in self.COUNTER_FIELDS and not isinstance(value, self.COUNTER_FIELDS[key]):
+                value = self.COUNTER_FIELDS[key](value, self)
+            setattr(self, key, value)
+            if key in self.LIST_FIELDS:
+                list_pages.invalidate(self.STORE_NAME)
+            for order in self.ORDERS:
+                if key in order.fields:
+                    order.update(self)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key == self.MEMBERSHIP_FIELD:
+            self._set_membership(())
+        elif key in self._field_set:
+            if getattr(self, key, _MISSING) is _MISSING:
+                raise KeyError(key)
+            delattr(self, key)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key == self.MEMBERSHIP_FIELD:
+            return True
+        if key in self._field_set:
+            return getattr(self, key, _MISSING) is not _MISSING
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, field, _MISSING) is not _MISSING:
+                yield field
+        if self.MEMBERSHIP_FIELD:
+            yield self.MEMBERSHIP_FIELD
+        if self._extra:
+            yield from list(self._extra)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        """Обычный словарь в прежнем виде (для журнала, снимков и выгрузки)"""
+        result = {}
+        for field in self.FIELDS:
+            value = getattr(self, field, _MISSING)
+            if value is _MISSING:
+                continue
+            if field in self.TIME_FIELDS:
+                value = format_timestamp(value)
+            elif value is _EMPTY_LIST:
+                value = []
+            elif field in self.ID_LIST_FIELDS:
+                value = list(value)
+            elif field in self.COUNTER_FIELDS:
+                value = value.to_dict()
+            result[field] = value
+        if self.MEMBERSHIP_FIELD:
+            result[self.MEMBERSHIP_FIELD] = list(self[self.MEMBERSHIP_FIELD])
+        if self._extra:
+            result.update(self._extra)
+        return result
+
+    def _set_membership(self, ids):
+        if self.MEMBERSHIP_SIDE == 'chat':
+            membership.set_members(self.id, ids)
+        else:
+            membership.set_chats(self.id, ids)
+
+    def on_stored(self):
+        """Вызывается после добавления записи в хранилище (RecordStore)"""
+        list_pages.invalidate(self.STORE_NAME)
+        for order in self.ORDERS:
+            order.add(self)
+
+    def on_removed(self):
+        """Вызывается при удалении записи из хранилища: связи удалённой сущности не должны остаться в индексе"""
+        if self.MEMBERSHIP_FIELD:
+            self._set_membership(())
+        list_pages.invalidate(self.STORE_NAME)
+        for order in self.ORDERS:
+            order.remove(self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class UserRecord(EntityRecord):
+    FIELDS = ('id', 'first_name', 'last_name', 'username', 'joined_at', 'messages_count',
+              'reactions_received', 'channels', 'language', 'blocked', 'notifications', 'activity')
+    __slots__ = FIELDS
+    TIME_FIELDS = frozenset({'joined_at'})
+    ID_LIST_FIELDS = frozenset({'channels'})
+    INTERNED_FIELDS = frozenset({'id', 'language'})
+    COUNTER_FIELDS = {'activity': ActivityWindow}
+    MEMBERSHIP_FIELD = 'chats'
+    MEMBERSHIP_SIDE = 'user'
+    STORE_NAME = 'users'
+    LIST_FIELDS = frozenset({'first_name', 'last_name', 'username'})
+    # Поля, из которых складывается рейтинг (calculate_rating): их изменения обновляют leaderboard
+    RATING_FIELDS = frozenset({'messages_count', 'reactions_received'})
+    # Поля, по которым ищет администратор (search_index)
+    SEARCH_FIELDS = frozenset({'username', 'first_name', 'last_name'})
+
+    def __setitem__(self, key, value):
+        if key in self.SEARCH_FIELDS:
+            # Место в индексе определяется старым значением, поэтому запись убирается до изменения
+            search_index.remove(self)
+            super().__setitem__(key, value)
+            search_index.add(self)
+            return
+        super().__setitem__(key, value)
+        if key == 'messages_count':
+            active_users.update(self)
+        elif key == 'channels':
+            channel_users.update(self)
+        if key == 'activity':
+            window_ratings.update(self)
+        elif key in audience_segments.fields:
+            audience_segments.update(self, key)
+
+    def on_stored(self):
+        super().on_stored()
+        window_ratings.add(self)
+        active_users.add(self)
+        channel_users.add(self)
+        search_index.add(self)
+        audience_segments.add(self)
+
+    def on_removed(self):
+        super().on_removed()
+        window_ratings.remove(self)
+        active_users.remove(self)
+        channel_users.remove(self)
+        search_index.remove(self)
+        audience_segments.remove(self)
+
+class ChatRecord(EntityRecord):
+    FIELDS = ('id', 'title', 'type', 'messages_count', 'is_active', 'created_at',
+              'welcome_message', 'description', 'owner_id', 'member_messages')
+    __slots__ = FIELDS
+    TIME_FIELDS = frozenset({'created_at'})
+    INTERNED_FIELDS = frozenset({'id', 'type'})
+    COUNTER_FIELDS = {'member_messages': MemberCounters}
+    MEMBERSHIP_FIELD = 'members'
+    MEMBERSHIP_SIDE = 'chat'
+    STORE_NAME = 'chats'
+    LIST_FIELDS = frozenset({'title'})
+
+class ChannelRecord(EntityRecord):
+    FIELDS = ('id', 'title', 'username', 'description', 'created_at', 'posts_count', 'views_count',
+              'is_active', 'owner_id', 'subscribers')
+    __slots__ = FIELDS
+    TIME_FIELDS = frozenset({'created_at'})
+    ID_LIST_FIELDS = frozenset({'subscribers'})
+    STORE_NAME = 'channels'
+    LIST_FIELDS = frozenset({'title', 'username'})
+    SEARCH_FIELDS = frozenset({'title', 'username'})
+
+    def __setitem__(self, key, value):
+        if key in self.SEARCH_FIELDS:
+            channel_search_index.remove(self)
+            super().__setitem__(key, value)
+            channel_search_index.add(self)
+        else:
+            super().__setitem__(key, value)
+
+    def on_stored(self):
+        super().on_stored()
+        channel_search_index.add(self)
+
+    def on_removed(self):
+        super().on_removed()
+        channel_search_index.remove(self)
+
+class RecordStore(dict):
+    """Словарь записей одного типа: добавленные обычные словари превращаются в записи"""
+
+    __slots__ = ('record_type', '_loader')
+
+    def __init__(self, record_type):
+        super().__init__()
+        self.record_type = record_type
+
+    @classmethod
+    def from_loaded(cls, record_type, entities):
+        """Переводит загруженный словарь в записи, освобождая исходные словари по ходу"""
+        store = cls(record_type)
+        for key, entity in entities.items():
+            store[key] = entity
+            # Замена значения не меняет размер словаря, поэтому итерацию не ломает
+            entities[key] = None
+        return store
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, EntityRecord):
+            value = self.record_type.from_dict(value)
+        super().__setitem__(sys.intern(key) if isinstance(key, str) else key, value)
+        value.on_stored()
+
+    def __delitem__(self, key):
+        record = self[key]
+        super().__delitem__(key)
+        record.on_removed()
+
+    def pop(self, key, *default):
+        record = super().pop(key, *default)
+        if isinstance(record, EntityRecord):
+            record.on_removed()
+        return record
+
+class LoadingRecordStore(RecordStore):
+    """Хранилище, записи которого ещё загружаются по шардам.
+
+    Обращение по ключу сначала загружает шард этого ключа, а обход целиком ждёт
+    окончания загрузки. Когда загрузка завершена, класс объекта меняется обратно
+    на RecordStore, и проверки больше ничего не стоят. Базовые методы вызываются
+    явно, а не через super(): класс может смениться посреди вызова.
+    """
+
+    __slots__ = ()
+
+    def __contains__(self, key):
+        self._loader.ensure_loaded(key)
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        self._loader.ensure_loaded(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._loader.ensure_loaded(key)
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        self._loader.ensure_loaded(key)
+        RecordStore.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._loader.ensure_loaded(key)
+        RecordStore.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._loader.ensure_loaded(key)
+        return RecordStore.pop(self, key, *default)
+
+    def __iter__(self):
+        self._loader.wait()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._loader.wait()
+        return dict.__len__(self)
+
+    def keys(self):
+        self._loader.wait()
+        return dict.keys(self)
+
+    def values(self):
+        self._loader.wait()
+        return dict.values(self)
+
+    def items(self):
+        self._loader.wait()
+        return dict.items(self)
+
+RECORD_TYPES = {'users': UserRecord, 'chats': ChatRecord, 'channels': ChannelRecord}
+
+# Индекс участия в чатах
+
+MEMBERSHIP_SMALL_BUCKET = 8  # до такого размера связи хранятся кортежем, дальше - множеством
+
+def _bucket_add(mapping, key, value):
+    bucket = mapping.get(key)
+    if bucket is None:
+        mapping[key] = (value,)
+        return True
+    if value in bucket:
+        return False
+    if type(bucket) is tuple:
+        bucket += (value,)
+        mapping[key] = bucket if len(bucket) <= MEMBERSHIP_SMALL_BUCKET else set(bucket)
+    else:
+        bucket.add(value)
+    return True
+
+def _bucket_discard(mapping, key, value):
+    bucket = mapping.get(key)
+    if bucket is None or value not in bucket:
+        return False
+    if type(bucket) is tuple:
+        bucket = tuple(item for item in bucket if item != value)
+    else:
+        bucket.discard(value)
+    if bucket:
+        mapping[key] = bucket
+    else:
+        del mapping[key]
+    return True
+
+class MembershipIndex:
+    """Двусторонний индекс участия: чат -> участники и пользователь -> чаты.
+
+    Добавление, удаление и проверка выполняются за O(1); небольшие наборы
+    хранятся кортежами, чтобы не тратить память на множество для каждого пользователя.
+    Набор заменяется целиком (кортеж на новый кортеж или множество), поэтому изменения
+    идут под замком: иначе из двух одновременных изменений одного набора одно теряется.
+    """
+
+    def __init__(self):
+        self.chat_members = {}
+        self.user_chats = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_data(cls, data):
+        """Строит индекс по загруженным данным, забирая из них списки участников.
+
+        Связи из списков чата и пользователя объединяются; ссылки на удалённые чаты отбрасываются.
+        """
+        index = cls()
+        for store_name in ('chats', 'users'):
+            for entity_id, entity in data[store_name].items():
+                index.add_loaded(store_name, entity_id, entity, data['chats'])
+        return index
+
+    def add_loaded(self, store_name, entity_id, entity, chats):
+        """Забирает из загруженной сущности её список участия и добавляет связи в индекс.
+
+        Чаты должны загружаться раньше пользователей: ссылки на отсутствующие в chats чаты отбрасываются.
+        """
+        if store_name == 'chats':
+            for user_id in entity.pop('members', None) or ():
+                self.add(entity_id, user_id)
+        elif store_name == 'users':
+            for chat_id in entity.pop('chats', None) or ():
+                if chat_id in chats:
+                    self.add(chat_id, entity_id)
+
+    def add(self, chat_id, user_id):
+        chat_id, user_id = sys.intern(chat_id), sys.intern(user_id)
+        with self._lock:
+            if _bucket_add(self.chat_members, chat_id, user_id):
+                _bucket_add(self.user_chats, user_id, chat_id)
+                return True
+            return False
+
+    def discard(self, chat_id, user_id):
+        with self._lock:
+            if _bucket_discard(self.chat_members, chat_id, user_id):
+                _bucket_discard(self.user_chats, user_id, chat_id)
+                return True
+            return False
+
+    def contains(self, chat_id, user_id):
+        return user_id in self.chat_members.get(chat_id, ())
+
+    def members(self, chat_id):
+        return self.chat_members.get(chat_id, ())
+
+    def chats_of(self, user_id):
+        return self.user_chats.get(user_id, ())
+
+    def member_count(self, chat_id):
+        return len(self.chat_members.get(chat_id, ()))
+
+    def set_members(self, chat_id, user_ids):
+        with self._lock:
+            for user_id in tuple(self.members(chat_id)):
+                self.discard(chat_id, user_id)
+            for user_id in user_ids:
+                self.add(chat_id, user_id)
+
+    def set_chats(self, user_id, chat_ids):
+        with self._lock:
+            for chat_id in tuple(self.chats_of(user_id)):
+                self.discard(chat_id, user_id)
+            for chat_id in chat_ids:
+                self.add(chat_id, user_id)
+
+    def remove_chat(self, chat_id):
+        self.set_members(chat_id, ())
+
+    def remove_user(self, user_id):
+        self.set_chats(user_id, ())
+
+membership = MembershipIndex()
+
+class MembershipView:
+    """Участники чата или чаты пользователя из индекса с интерфейсом прежнего списка"""
+
+    __slots__ = ('_side', '_key')
+
+    def __init__(self, side, key):
+        self._side = side
+        self._key = key
+
+    def _bucket(self):
+        if self._side == 'chat':
+            return membership.members(self._key)
+        return membership.chats_of(self._key)
+
+    def __contains__(self, item):
+        return item in self._bucket()
+
+    def __iter__(self):
+        # Копия: набор могут менять другие потоки
+        return iter(tuple(self._bucket()))
+
+    def __len__(self):
+        return len(self._bucket())
+
+    def append(self, item):
+        if self._side == 'chat':
+            membership.add(self._key, item)
+        else:
+            membership.add(item, self._key)
+
+    def remove(self, item):
+        removed = membership.discard(self._key, item) if self._side == 'chat' else membership.discard(item, self._key)
+        if not removed:
+            raise ValueError(f"{item} отсутствует")
+
+    def __repr__(self):
+        return repr(list(self))
+
+# Параметры отложенной записи данных
+DATA_FILE = 'data.json'
+SAVE_INTERVAL = 5  # секунд между фоновыми сохранениями
+SAVE_DIRTY_THRESHOLD = 200  # количество изменений, после которого сохранение запускается досрочно
+COUNTER_STRIPES = 16  # число полос счётчиков активности
+COUNTER_MERGE_INTERVAL = 1  # секунд между слияниями счётчиков активности с данными; на столько может отставать статистика
+LEADERBOARD_BLOCK_SIZE = 512  # ключей в блоке таблицы рейтинга
+SEARCH_PAGE_SIZE = 10  # пользователей на странице результатов поиска
+LIST_PAGE_SIZE = 10  # записей на странице списков администратора
+LIST_PAGE_CACHE_SIZE = 256  # готовых страниц списков в кэше
+LIST_ACTIVITY_WINDOW = 'week'  # окно RATING_WINDOWS для списка «Активные»
+USERNAME_LOOKUP_WORKERS = 8  # одновременных запросов get_chat для username, которых нет в базе
+MESSAGE_AUTHORS_PER_CHAT = 20000  # последних сообщений чата, для которых помним автора
+MESSAGE_AUTHOR_CHATS = 2000  # чатов в кэше авторов; дольше всех неактивные вытесняются
+MESSAGE_AUTHOR_TTL = 3 * 24 * 3600  # секунд, в течение которых реакции на сообщение засчитываются автору
+# Обновления, которые запрашиваются у Telegram: реакции приходят только если перечислены явно.
+# Список заменяет набор по умолчанию, поэтому должен покрывать все *_handler этого файла
+ALLOWED_UPDATES = ['message', 'channel_post', 'callback_query', 'my_chat_member',
+                   'message_reaction', 'message_reaction_count']
+# Рассылка (ограничения Telegram: около 30 сообщений в секунду на бота, 1 в секунду
+# в один личный чат, 20 в минуту в одну группу)
+BROADCAST_RATE = 30  # сообщений в секунду на все чаты
+BROADCAST_PRIVATE_INTERVAL = 1.0  # секунд между сообщениями в один личный чат
+BROADCAST_GROUP_INTERVAL = 3.0  # секунд между сообщениями в одну группу или канал
+BROADCAST_WORKERS = 16  # одновременных отправок
+BROADCAST_MAX_RETRIES = 5  # повторов сообщения после ответа 429
+BROADCAST_BACKOFF = 0.8  # во столько раз снижается частота после ответа 429
+BROADCAST_RECOVERY = 0.01  # доля BROADCAST_RATE, на которую частота растёт после каждой успешной отправки
+BROADCAST_PROGRESS_INTERVAL = 3  # секунд между сохранениями хода рассылки и обновлениями сообщения о нём
+PROGRESS_EDIT_INTERVAL = 2  # наименьшее число секунд между правками сообщения о ходе долгой операции
+BROADCAST_DIR = 'broadcasts'  # каталог заданий рассылки (см. BroadcastJob)
+DELIVERY_FILE = 'delivery.json'  # состояние доставки получателям (см. DeliveryHealth)
+DELIVERY_SAVE_INTERVAL = 60  # секунд между сохранениями состояния доставки
+DELIVERY_SAVE_THRESHOLD = 50000  # изменений состояния доставки, после которых оно сохраняется досрочно
+DELIVERY_MAX_FAILURES = 3  # прочих ошибок подряд, после которых получатель считается недоступным
+DELIVERY_REPROBE_AFTER = 30 * 24 * 3600  # секунд, после которых недоступного получателя можно проверить снова
+# Ошибки 400, после которых чат считается несуществующим (описания в нижнем регистре)
+DELIVERY_NOT_FOUND_ERRORS = ('chat not found', 'user is deactivated', 'peer_id_invalid', 'user not found')
+SCHEDULE_FILE = 'schedule.json'  # задания планировщика (см. Scheduler)
+SCHEDULE_SAVE_INTERVAL = 5  # секунд между сохранениями заданий планировщика
+SCHEDULE_PAGE_SIZE = 10  # заданий на странице расписания
+SCHEDULE_MIN_INTERVAL = 60  # наименьший период повторяющегося задания (секунд)
+
+class WriteBehindStore:
+    """Отложенная запись: изменения только помечаются, а на диск их сбрасывает фоновый поток"""
+
+    def __init__(self, flush_func, interval=SAVE_INTERVAL, dirty_threshold=SAVE_DIRTY_THRESHOLD):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.dirty_threshold = dirty_threshold
+        self.dirty_count = 0
+        self.last_flush_time = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def mark_dirty(self):
+        """Помечает данные как изменённые"""
+        with self._lock:
+            self.dirty_count += 1
+            if self.dirty_count >= self.dirty_threshold:
+                self._wakeup.set()
+
+    def start(self):
+        """Запуск фонового потока сохранения"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='data-flusher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Сбрасывает накопленные изменения на диск. Возвращает True, если запись выполнялась"""
+        with self._flush_lock:
+            with self._lock:
+                dirty = self.dirty_count
+                self.dirty_count = 0
+            if not dirty:
+                return False
+            if not self.flush_func():
+                # Запись не удалась - возвращаем изменения, чтобы повторить попытку позже
+                with self._lock:
+                    self.dirty_count += dirty
+                return False
+            self.last_flush_time = datetime.now()
+            return True
+
+    def stop(self):
+        """Останавливает фоновый поток и выполняет финальное сохранение"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
+
+JOURNAL_FILE = 'data.journal'  # журнал изменений; к имени добавляется номер поколения
+JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024  # размер журнала (байт), после которого он сворачивается в снимок
+STORAGE_BACKEND = 'json'  # 'json' - шарды в data/ с журналом, 'sqlite' - база SQLite
+SQLITE_FILE = 'data.db'
+DATA_DIR = 'data'  # каталог шардов снимка JSON-хранилища
+USER_SHARDS = 16  # число шардов пользователей; для существующего хранилища берётся по файлам
+SNAPSHOT_FORMAT = 'json'  # формат шардов: 'json' или 'binary' (блоки с префиксом длины, быстрее загружается)
+BINARY_SNAPSHOT_MAGIC = b'TABSNAP2'
+# Прежний двоичный формат (блоки marshal) только читается: marshal может меняться между версиями Python
+LEGACY_BINARY_SNAPSHOT_MAGIC = b'TABSNAP1'
+BINARY_BLOCK_SIZE = 1000  # сущностей в одном блоке двоичного шарда
+JSON_STREAM_CHUNK = 1 << 20  # байт, читаемых за раз при потоковом разборе JSON
+LOAD_PROGRESS_INTERVAL = 5  # секунд между сообщениями о ходе загрузки
+
+def apply_journal_record(data, record):
+    """Применяет одну запись журнала к набору хранилищ {'users': ..., 'chats': ..., 'channels': ...}"""
+    op = record[0]
+    if op == 'put':
+        data[record[1]][record[2]] = record[3]
+    elif op == 'del':
+        data[record[1]].pop(record[2], None)
+    elif op == 'incr':
+        entity = data[record[1]].get(record[2])
+        if entity is None:
+            pass
+        elif len(record) > 5:
+            # Счётчик участника: ['incr', хранилище, id, поле, дельта, id участника]
+            counters = entity.get(record[3])
+            if counters is None:
+                entity[record[3]] = {}
+                counters = entity[record[3]]
+            counters[record[5]] = counters.get(record[5], 0) + record[4]
+        else:
+            entity[record[3]] = entity.get(record[3], 0) + record[4]
+    elif op == 'set':
+        entity = data[record[1]].get(record[2])
+        if entity is not None:
+            entity[record[3]] = record[4]
+    elif op == 'join':
+        chat_id, user_id = record[1], record[2]
+        chat = data['chats'].get(chat_id)
+        if chat is not None and user_id not in chat.setdefault('members', []):
+            chat['members'].append(user_id)
+        user = data['users'].get(user_id)
+        if user is not None and chat_id not in user.setdefault('chats', []):
+            user['chats'].append(chat_id)
+    elif op == 'leave':
+        chat_id, user_id = record[1], record[2]
+        chat = data['chats'].get(chat_id)
+        if chat is not None and user_id in chat.get('members', []):
+            chat['members'].remove(user_id)
+        user = data['users'].get(user_id)
+        if user is not None and chat_id in user.get('chats', []):
+            user['chats'].remove(chat_id)
+    else:
+        logger.warning(f"Неизвестная запись журнала: {op}")
+
+def atomic_write(path, write_func, binary=False):
+    """Атомарная запись файла: временный файл, fsync и переименование"""
+    tmp_path = path + '.tmp'
+    with (open(tmp_path, 'wb') if binary else open(tmp_path, 'w', encoding='utf-8')) as f:
+        write_func(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class StorageBackend:
+    """Базовый класс хранилища: очередь изменений, загрузка и пакетная запись"""
+
+    name = ''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._pending = []
+
+    def append(self, record):
+        """Добавляет запись в очередь; сериализация выполняется сразу, пока данные не изменились"""
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self._pending.append(line)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def note_change(self, record):
+        """Вызывается под self.lock для каждого изменения, применённого к данным в памяти"""
+
+    def write_pending(self):
+        """Сохраняет накопленные записи одним пакетом"""
+        with self.lock:
+            lines, self._pending = self._pending, []
+        if not lines:
+            return True
+        try:
+            self.write_lines(lines)
+            return True
+        except Exception as e:
+            with self.lock:
+                self._pending[:0] = lines
+            logger.error(f"Ошибка при сохранении изменений ({self.name}): {str(e)}")
+            try:
+                bot.send_message(SUPER_ADMIN_ID, f"{EMOJI['error']} Ошибка при сохранении данных: {str(e)}")
+            except Exception:
+                pass
+            return False
+
+    def load(self):
+        """Возвращает данные в виде {'users': ..., 'chats': ..., 'channels': ...}"""
+        raise NotImplementedError
+
+    def write_lines(self, lines):
+        raise NotImplementedError
+
+    def stats_lines(self):
+        """Строки для статистики базы данных в панели администратора"""
+        return []
+
+    def close(self):
+        pass
+
+def journal_record_keys(record):
+    """Сущности (хранилище, id), которые затрагивает запись журнала"""
+    if record[0] in ('join', 'leave'):
+        return (('chats', record[1]), ('users', record[2]))
+    return ((record[1], record[2]),)
+
+class JsonStorage(StorageBackend):
+    """Снимок в виде шардов (пользователи по хэшу id, чаты, каналы) и журнал изменений.
+
+    Каждый шард хранит номер поколения журнала, до которого он актуален, поэтому
+    при сворачивании журнала переписываются только изменившиеся шарды.
+    """
+
+    name = 'json'
+
+    def __init__(self, data_dir=DATA_DIR, journal_file=JOURNAL_FILE, compact_size=JOURNAL_COMPACT_SIZE,
+                 user_shards=USER_SHARDS, legacy_file=DATA_FILE, snapshot_format=SNAPSHOT_FORMAT):
+        super().__init__()
+        self.data_dir = data_dir
+        self.snapshot_format = snapshot_format
+        self.journal_file = journal_file
+        self.compact_size = compact_size
+        self.user_shards = user_shards
+        self.legacy_file = legacy_file
+        self.generation = 1
+        self.last_snapshot_duration = None
+        self.shard_generations = {}
+        # Время и длительность последней записи каждого шарда: {шард: (datetime, секунды)}
+        self.shard_flushes = {}
+        self._dirty_shards = set()
+        self._compact_thread = None
+        self._loading = False
+        # Записи журнала, ещё не применённые к незагруженным шардам: {шард: [запись, ...]}
+        self._journal_by_shard = {}
+        # Приращения счётчиков после начала снимка: {(хранилище, id): {поле: дельта}}
+        self._snapshot_deltas = None
+
+    def shard_names(self):
+        return [f"users.{i:02d}" for i in range(self.user_shards)] + ['chats', 'channels']
+
+    def shard_of(self, store_name, entity_id):
+        if store_name == 'users':
+            # crc32, а не hash(): распределение не должно меняться между запусками
+            return f"users.{zlib.crc32(entity_id.encode('utf-8')) % self.user_shards:02d}"
+        return store_name
+
+    def shard_path(self, shard, snapshot_format=None):
+        extension = '.bin' if (snapshot_format or self.snapshot_format) == 'binary' else '.json'
+        return os.path.join(self.data_dir, shard + extension)
+
+    def encode_entity(self, entity):
+        return json.dumps(entity, ensure_ascii=False, separators=(',', ':'))
+
+    def write_shard(self, shard, items, upto_generation):
+        """Атомарно пишет шард из пар (id, сериализованная сущность) в выбранном формате"""
+        if self.snapshot_format == 'binary':
+            atomic_write(self.shard_path(shard), lambda f: write_binary_shard(f, items, upto_generation), binary=True)
+            previous_path = self.shard_path(shard, 'json')
+        else:
+            atomic_write(self.shard_path(shard), lambda f: write_json_shard(f, items, upto_generation))
+            previous_path = self.shard_path(shard, 'binary')
+        # После смены формата шард в старом формате больше не нужен
+        if os.path.exists(previous_path):
+            os.remove(previous_path)
+
+    def write_data(self, data, generation):
+        """Записывает все шарды из готового набора данных {'users': ..., 'chats': ..., 'channels': ...}"""
+        os.makedirs(self.data_dir, exist_ok=True)
+        items_by_shard = {shard: [] for shard in self.shard_names()}
+        for store_name in ('users', 'chats', 'channels'):
+            for entity_id, entity in data[store_name].items():
+                items_by_shard[self.shard_of(store_name, entity_id)].append((entity_id, self.encode_entity(entity)))
+        for shard, items in items_by_shard.items():
+            self.write_shard(shard, items, generation)
+            self.shard_generations[shard] = generation
+
+    def existing_shard_path(self, shard):
+        """Путь к шарду на диске: в выбранном формате или, если его нет, в другом"""
+        path = self.shard_path(shard)
+        if not os.path.exists(path):
+            other_path = self.shard_path(shard, 'json' if self.snapshot_format == 'binary' else 'binary')
+            if os.path.exists(other_path):
+                # Шард в другом формате читаем как есть и переписываем при следующем снимке
+                self._dirty_shards.add(shard)
+                return other_path
+        return path
+
+    def iter_shard(self, shard):
+        """Сущности шарда по одной: пары (id, сущность)"""
+        path = self.existing_shard_path(shard)
+        if not os.path.exists(path):
+            return
+        try:
+            if path.endswith('.bin'):
+                with open(path, 'rb') as f:
+                    if f.read(len(LEGACY_BINARY_SNAPSHOT_MAGIC)) == LEGACY_BINARY_SNAPSHOT_MAGIC:
+                        # Шард в прежнем двоичном формате переписываем при следующем снимке
+                        self._dirty_shards.add(shard)
+                yield from iter_binary_shard(path)
+            else:
+                yield from iter_json_shard(path)
+        except (ValueError, EOFError, struct.error) as e:
+            # json.JSONDecodeError - подкласс ValueError
+            logger.error(f"Ошибка при чтении шарда {path}: {str(e)}. Прочитанная часть сохранена.")
+
+    def journal_path(self, generation):
+        return f"{self.journal_file}.{generation}"
+
+    def journal_generations(self):
+        """Номера поколений журнала, которые есть на диске"""
+        directory = os.path.dirname(self.journal_file) or '.'
+        prefix = os.path.basename(self.journal_file) + '.'
+        generations = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                generations.append(int(name[len(prefix):]))
+        return sorted(generations)
+
+    def journal_size(self):
+        """Суммарный размер файлов журнала на диске (байт)"""
+        return sum(os.path.getsize(self.journal_path(g)) for g in self.journal_generations())
+
+    def append(self, record):
+        # Запись относится к поколению, текущему на момент изменения данных в памяти
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self._pending.append((self.generation, line))
+            for store_name, entity_id in journal_record_keys(record):
+                self._dirty_shards.add(self.shard_of(store_name, entity_id))
+
+    def write_lines(self, lines):
+        """Дописывает записи в их поколения журнала и делает fsync"""
+        by_generation = {}
+        for generation, line in lines:
+            by_generation.setdefault(generation, []).append(line)
+        for generation, generation_lines in sorted(by_generation.items()):
+            path = self.journal_path(generation)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(generation_lines) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        current_path = self.journal_path(self.generation)
+        if os.path.exists(current_path) and os.path.getsize(current_path) >= self.compact_size:
+            self.compact_async()
+
+    def prepare_load(self):
+        """Готовит загрузку: переносит data.json, читает поколения шардов и раскладывает журнал по шардам.
+
+        Сами шарды после этого можно загружать в любом порядке и в любое время
+        через iter_shard и replay_shard.
+        """
+        os.makedirs(self.data_dir, exist_ok=True)
+        if os.path.exists(self.legacy_file):
+            self.migrate_legacy_file()
+        names = [n.split('.') for n in os.listdir(self.data_dir)]
+        user_indexes = [int(n[1]) for n in names if len(n) == 3 and n[0] == 'users' and n[1].isdigit() and n[2] in ('json', 'bin')]
+        if user_indexes:
+            # Число шардов определяется файлами на диске, чтобы id не переезжали между шардами
+            self.user_shards = max(user_indexes) + 1
+        for shard in self.shard_names():
+            self.shard_generations[shard] = read_shard_generation(self.existing_shard_path(shard))
+        self._loading = True
+        self._journal_by_shard = self.read_journal()
+
+    def finish_loading(self):
+        """Все шарды загружены: с этого момента снова можно писать снимки"""
+        self._loading = False
+        self._journal_by_shard = {}
+
+    def load(self):
+        """Загружает все шарды в обычные словари (перенос в SQLite и т. п.)"""
+        self.prepare_load()
+        shards = self.shard_names()
+        data = {'users': {}, 'chats': {}, 'channels': {}}
+        with ThreadPoolExecutor(max_workers=min(8, len(shards))) as executor:
+            results = list(executor.map(lambda shard: dict(self.iter_shard(shard)), shards))
+        for shard, items in zip(shards, results):
+            data[shard.split('.')[0]].update(items)
+        # Списки показывают пользователей в порядке регистрации, а шарды его не сохраняют
+        data['users'] = dict(sorted(data['users'].items(), key=lambda item: item[1].get('joined_at') or ''))
+        replayed = sum(self.replay_shard(shard, data) for shard in shards)
+        self.finish_loading()
+        logger.info(f"Загружено шардов: {len(shards)}, применено записей журнала: {replayed}")
+        return data
+
+    def migrate_legacy_file(self):
+        """Однократно разбивает монолитный data.json на шарды.
+
+        Файл разбирается потоково, по одной сущности, и каждая сразу сериализуется
+        для своего шарда, поэтому ни весь текст файла, ни всё дерево в памяти не держатся.
+        """
+        items_by_shard = {shard: [] for shard in self.shard_names()}
+        snapshot_generation = 0
+        progress = LoadProgress(f"Перенос {self.legacy_file}", os.path.getsize(self.legacy_file))
+        try:
+            with open(self.legacy_file, 'rb') as f:
+                reader = StreamingJsonReader(f, on_read=progress.update)
+                for key in reader.keys():
+                    if key in ('users', 'chats', 'channels'):
+                        for entity_id in reader.keys():
+                            entity = self.encode_entity(reader.value())
+                            items_by_shard[self.shard_of(key, entity_id)].append((entity_id, entity))
+                    elif key == 'journal_gen':
+                        snapshot_generation = reader.value()
+                    else:
+                        reader.value()
+        except ValueError as e:
+            logger.error(f"Ошибка при чтении файла данных: {str(e)}. Прочитанная часть сохранена, "
+                         f"остальное будет восстановлено из журнала.")
+            snapshot_generation = 0
+        for shard, items in items_by_shard.items():
+            self.write_shard(shard, items, snapshot_generation)
+            self.shard_generations[shard] = snapshot_generation
+        # Пока data.json на месте, перенос считается незавершённым и повторится при следующем запуске
+        os.replace(self.legacy_file, self.legacy_file + '.migrated')
+        logger.info(f"{self.legacy_file} разбит на шарды в {self.data_dir}")
+
+    def read_journal(self):
+        """Читает поколения журнала новее шардов и раскладывает записи по шардам: {шард: [запись, ...]}.
+
+        Запись попадает только в те шарды, которые были записаны раньше её поколения:
+        в более свежих шардах она уже учтена (для приращений счётчиков это важно).
+        """
+        by_shard = {}
+        newest_shard = max(self.shard_generations.values(), default=0)
+        oldest_shard = min(self.shard_generations.values(), default=0)
+        generations = self.journal_generations()
+        for generation in generations:
+            if generation <= oldest_shard:
+                continue
+            with open(self.journal_path(generation), 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная при сбое запись - дальше в этом поколении данных нет
+                        logger.warning(f"Повреждённая запись журнала {generation}:{line_number} пропущена")
+                        break
+                    for store_name, entity_id in journal_record_keys(record):
+                        shard = self.shard_of(store_name, entity_id)
+                        if self.shard_generations.get(shard, 0) < generation:
+                            by_shard.setdefault(shard, []).append(record)
+        # Новые записи всегда пишем в свежее поколение, чтобы не дописывать к оборванной строке
+        self.generation = max(generations + [newest_shard]) + 1
+        return by_shard
+
+    def replay_shard(self, shard, data):
+        """Применяет к загруженному шарду его записи журнала. Возвращает число применённых записей.
+
+        Запись о вступлении или выходе из чата затрагивает два шарда; каждый из них
+        применяет только свою сторону связи.
+        """
+        records = self._journal_by_shard.pop(shard, ())
+        for record in records:
+            target = {}
+            for store_name, entity_id in journal_record_keys(record):
+                target[store_name] = data[store_name] if self.shard_of(store_name, entity_id) == shard else {}
+            apply_journal_record(target, record)
+        if records:
+            # Без self.lock: шард может загружаться по обращению из потока, который
+            # уже держит self.lock, а снимки до окончания загрузки не пишутся
+            self._dirty_shards.add(shard)
+        return len(records)
+
+    def compact_async(self):
+        """Запускает запись изменившихся шардов в фоновом потоке.
+
+        Снимок фиксируется мгновенно: текущее поколение журнала закрывается, а
+        сами данные сериализуются позже из памяти. Поздние изменения повторяются
+        из журнала; все они идемпотентны, кроме приращений счётчиков, поэтому
+        приращения после начала снимка запоминаются и вычитаются при записи.
+        """
+        with self.lock:
+            if self._loading or (self._compact_thread and self._compact_thread.is_alive()):
+                # Пока загружены не все шарды, снимок записал бы их неполными
+                return
+            upto_generation = self.generation
+            self.generation += 1
+            dirty_shards, self._dirty_shards = self._dirty_shards, set()
+            self._snapshot_deltas = {}
+            self._compact_thread = threading.Thread(
+                target=self.compact, args=(upto_generation, dirty_shards), name='snapshot-writer', daemon=True
+            )
+            self._compact_thread.start()
+
+    def note_change(self, record):
+        if self._snapshot_deltas is not None and record[0] == 'incr':
+            deltas = self._snapshot_deltas.setdefault((record[1], record[2]), {})
+            # Счётчики участников учитываются по паре (поле, участник)
+            key = (record[3], record[5]) if len(record) > 5 else record[3]
+            deltas[key] = deltas.get(key, 0) + record[4]
+
+    def _entity_at_snapshot(self, store_name, entity_id, store):
+        """Сериализованная сущность в состоянии на момент начала снимка (None, если её уже удалили)"""
+        for attempt in range(3):
+            with self.lock:
+                entity = store.get(entity_id)
+                if entity is None:
+                    return None
+                entity = entity.to_dict()
+                for field, delta in self._snapshot_deltas.get((store_name, entity_id), {}).items():
+                    if isinstance(field, tuple):
+                        field, member_id = field
+                        counters = entity.setdefault(field, {})
+                        counters[member_id] = counters.get(member_id, 0) - delta
+                    else:
+                        entity[field] = entity.get(field, 0) - delta
+            try:
+                return self.encode_entity(entity)
+            except RuntimeError:
+                # Вложенный словарь изменился во время сериализации - повторяем
+                continue
+        raise RuntimeError(f"Не удалось сериализовать {store_name}:{entity_id}")
+
+    def _shard_ids(self, dirty_shards):
+        """id сущностей каждого из изменившихся шардов"""
+        live = _live_data()
+        ids_by_shard = {shard: [] for shard in dirty_shards}
+        for store_name, store in live.items():
+            if not any(shard.split('.')[0] == store_name for shard in dirty_shards):
+                continue
+            # Список ключей копируется целиком под GIL; записи, появившиеся позже, есть в журнале
+            for entity_id in list(store):
+                shard_ids = ids_by_shard.get(self.shard_of(store_name, entity_id))
+                if shard_ids is not None:
+                    shard_ids.append(entity_id)
+        return ids_by_shard
+
+    def compact(self, upto_generation, dirty_shards):
+        """Записывает изменившиеся шарды из памяти и удаляет вошедшие в снимок поколения журнала"""
+        written = set()
+        try:
+            started = time.time()
+            live = _live_data()
+            for shard, entity_ids in sorted(self._shard_ids(dirty_shards).items()):
+                store_name = shard.split('.')[0]
+                store = live[store_name]
+                shard_started = time.time()
+                items = ((i, self._entity_at_snapshot(store_name, i, store)) for i in entity_ids)
+                self.write_shard(shard, items, upto_generation)
+                self.shard_generations[shard] = upto_generation
+                self.shard_flushes[shard] = (datetime.now(), time.time() - shard_started)
+                written.add(shard)
+            for generation in self.journal_generations():
+                if generation <= upto_generation:
+                    os.remove(self.journal_path(generation))
+            self.last_snapshot_duration = time.time() - started
+            logger.info(f"Снимок данных записан за {self.last_snapshot_duration:.2f} с (шардов: {len(written)})")
+        except Exception as e:
+            logger.error(f"Ошибка при записи снимка данных: {str(e)}")
+        finally:
+            with self.lock:
+                self._snapshot_deltas = None
+                # Незаписанные шарды попадут в следующий снимок
+                self._dirty_shards |= dirty_shards - written
+
+    def shard_size(self, shard):
+        for snapshot_format in (self.snapshot_format, 'binary' if self.snapshot_format == 'json' else 'json'):
+            path = self.shard_path(shard, snapshot_format)
+            if os.path.exists(path):
+                return os.path.getsize(path)
+        return 0
+
+    def stats_lines(self):
+        shards = self.shard_names()
+        lines = [
+            f"Размер снимка: {sum(self.shard_size(s) for s in shards) / 1024:.1f} КБ (шардов: {len(shards)}, формат: {self.snapshot_format})",
+            f"Размер журнала: {self.journal_size() / 1024:.1f} КБ",
+            f"Поколение журнала: {self.generation}",
+            f"Последний снимок: {self.last_snapshot_duration:.2f} с" if self.last_snapshot_duration is not None else "Последний снимок: нет",
+            "Шарды:",
+        ]
+        for shard in shards:
+            flushed = self.shard_flushes.get(shard)
+            flushed_text = f"{flushed[0].strftime('%H:%M:%S')} ({flushed[1]:.2f} с)" if flushed else "не записывался"
+            dirty_text = ", изменён" if shard in self._dirty_shards else ""
+            lines.append(f"• {shard}: {self.shard_size(shard) / 1024:.1f} КБ, {flushed_text}{dirty_text}")
+        return lines
+
+class StreamingJsonReader:
+    """Потоковый разбор JSON-объекта из двоичного файла.
+
+    Объект верхнего уровня и вложенные объекты обходятся по ключам (keys), а значения
+    разбираются по одному (value), поэтому в памяти одновременно находятся только
+    текущий фрагмент файла и одно значение.
+    """
+
+    def __init__(self, f, chunk_size=JSON_STREAM_CHUNK, on_read=None):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.on_read = on_read
+        self.bytes_read = 0
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Дочитывает следующий фрагмент файла. Возвращает False в конце файла"""
+        if self._eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        self.bytes_read += len(chunk)
+        self._eof = not chunk
+        self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(chunk, final=self._eof)
+        self._pos = 0
+        if self.on_read:
+            self.on_read(self.bytes_read)
+        return not self._eof
+
+    def _peek(self):
+        """Следующий значащий символ (пробелы пропускаются)"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("неожиданный конец JSON")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"ожидался '{char}' на позиции {self.bytes_read}")
+        self._pos += 1
+
+    def value(self):
+        """Разбирает следующее значение целиком"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Значение не поместилось во фрагмент - дочитываем файл
+                if not self._fill():
+                    raise
+                continue
+            # Число в конце фрагмента могло оборваться на середине
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def keys(self):
+        """Ключи следующего объекта. Значение каждого ключа вызывающий код
+        обязан прочитать до перехода к следующему: value() или вложенным keys()"""
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            separator = self._peek()
+            self._pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError(f"ожидался ',' или '}}' на позиции {self.bytes_read}")
+
+class LoadProgress:
+    """Сообщения в лог о ходе долгой загрузки, не чаще раза в LOAD_PROGRESS_INTERVAL секунд"""
+
+    def __init__(self, title, total_bytes):
+        self.title = title
+        self.total_bytes = total_bytes
+        self.started = time.time()
+        self._last_report = self.started
+
+    def update(self, bytes_done):
+        now = time.time()
+        if now - self._last_report >= LOAD_PROGRESS_INTERVAL:
+            self._last_report = now
+            logger.info(f"{self.title}: {bytes_done / 1024 / 1024:.0f} из {self.total_bytes / 1024 / 1024:.0f} МБ "
+                        f"({now - self.started:.0f} с)")
+
+def write_json_shard(f, items, upto_generation):
+    """Пишет JSON-шард из пар (id, JSON сущности); удалённые сущности (None) пропускаются"""
+    f.write(f'{{"journal_gen":{upto_generation},"items":{{')
+    first = True
+    for entity_id, entity_json in items:
+        if entity_json is None:
+            continue
+        if not first:
+            f.write(',')
+        f.write(json.dumps(entity_id, ensure_ascii=False) + ':' + entity_json)
+        first = False
+    f.write('}}')
+
+def write_binary_shard(f, items, upto_generation):
+    """Пишет двоичный шард из пар (id, JSON сущности): заголовок с номером поколения и блоки с префиксом длины.
+
+    Каждый блок - JSON-объект из BINARY_BLOCK_SIZE сущностей в UTF-8, поэтому при загрузке
+    на блок приходится один вызов json.loads вместо потокового разбора всего файла.
+    Формат не зависит от версии Python.
+    """
+    f.write(BINARY_SNAPSHOT_MAGIC + struct.pack('<Q', upto_generation))
+    items = ((entity_id, entity_json) for entity_id, entity_json in items if entity_json is not None)
+    while True:
+        block = list(itertools.islice(items, BINARY_BLOCK_SIZE))
+        if not block:
+            break
+        block_bytes = ('{' + ','.join(json.dumps(entity_id, ensure_ascii=False) + ':' + entity_json
+                                      for entity_id, entity_json in block) + '}').encode('utf-8')
+        f.write(struct.pack('<I', len(block_bytes)) + block_bytes)
+
+def binary_shard_decoder(header):
+    """Функция разбора блока для заголовка двоичного шарда"""
+    if header.startswith(BINARY_SNAPSHOT_MAGIC):
+        return json.loads
+    if header.startswith(LEGACY_BINARY_SNAPSHOT_MAGIC):
+        return marshal.loads
+    raise ValueError("неизвестный формат файла")
+
+def iter_binary_shard(path):
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    loads = binary_shard_decoder(buffer)
+    offset = len(BINARY_SNAPSHOT_MAGIC) + 8
+    while offset < len(buffer):
+        block_length, = struct.unpack_from('<I', buffer, offset)
+        offset += 4
+        yield from loads(buffer[offset:offset + block_length]).items()
+        offset += block_length
+
+def iter_json_shard(path):
+    with open(path, 'rb') as f:
+        reader = StreamingJsonReader(f)
+        for key in reader.keys():
+            if key == 'items':
+                for entity_id in reader.keys():
+                    yield entity_id, reader.value()
+            else:
+                reader.value()
+
+def read_shard_generation(path):
+    """Номер последнего поколения журнала, вошедшего в шард (0, если шарда нет или он повреждён).
 
-def load_data():
-    global users, chats, channels
+    Номер записан в начале файла, поэтому сами сущности не читаются.
+    """
     try:
-        with open('data.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            users, chats, channels = data['users'], data['chats'], data['channels']
-        logger.info("Данные успешно загружены")
+        with open(path, 'rb') as f:
+            if path.endswith('.bin'):
+                header = f.read(len(BINARY_SNAPSHOT_MAGIC) + 8)
+                binary_shard_decoder(header)
+                return struct.unpack_from('<Q', header, len(BINARY_SNAPSHOT_MAGIC))[0]
+            reader = StreamingJsonReader(f, chunk_size=4096)
+            for key in reader.keys():
+                if key == 'journal_gen':
+                    return reader.value()
+                reader.value()
     except FileNotFoundError:
-        logger.warning("Файл данных не найден. Создан новый.")
-        save_data()
-    except json.JSONDecodeError:
-        logger.error("Ошибка при чтении файла данных. Создан новый.")
-        save_data()
+        return 0
+    except (ValueError, struct.error):
+        logger.error(f"Ошибка при чтении шарда {path}. Его данные будут восстановлены из журнала.")
+    return 0
+
+# Схема SQLite: основные поля вынесены в колонки, остальные хранятся в extra (JSON)
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    username TEXT,
+    joined_at TEXT,
+    messages_count INTEGER NOT NULL DEFAULT 0,
+    reactions_received INTEGER NOT NULL DEFAULT 0,
+    language TEXT,
+    blocked INTEGER,
+    extra TEXT
+);
+-- Списки и поиск пользователей строятся по индексам в памяти (RecordOrder, SearchIndex);
+-- индексы по именам из прежних версий схемы не используются и только замедляют запись
+DROP INDEX IF EXISTS idx_users_username;
+DROP INDEX IF EXISTS idx_users_first_name;
+DROP INDEX IF EXISTS idx_users_last_name;
+DROP INDEX IF EXISTS idx_users_joined_at;
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    type TEXT,
+    messages_count INTEGER NOT NULL DEFAULT 0,
+    is_active INTEGER,
+    created_at TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS channels (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    username TEXT,
+    posts_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS chat_members (
+    chat_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members(user_id);
+CREATE TABLE IF NOT EXISTS chat_member_messages (
+    chat_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_activity (
+    user_id TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    points INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, hour)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_channels (
+    user_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    PRIMARY KEY (user_id, channel_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_user_channels_channel ON user_channels(channel_id);
+'''
+
+class SqliteStorage(StorageBackend):
+    """Хранилище в SQLite (режим WAL) с индексами по таблицам связей"""
+
+    name = 'sqlite'
+
+    # Колонки таблиц; поля со значением None в колонках-флагах при загрузке пропускаются
+    COLUMNS = {
+        'users': ('first_name', 'last_name', 'username', 'joined_at', 'messages_count',
+                  'reactions_received', 'language', 'blocked'),
+        'chats': ('title', 'type', 'messages_count', 'is_active', 'created_at'),
+        'channels': ('title', 'username', 'posts_count', 'created_at'),
+    }
+    OPTIONAL_COLUMNS = {'blocked', 'is_active'}
+    # Списки связей хранятся в отдельных таблицах
+    RELATION_FIELDS = {'users': ('chats', 'channels'), 'chats': ('members',), 'channels': ()}
+    # Поля-счётчики тоже: (хранилище, поле) -> (таблица, колонка id сущности, колонка ключа, колонка значения)
+    COUNTER_TABLES = {
+        ('chats', 'member_messages'): ('chat_member_messages', 'chat_id', 'user_id', 'count'),
+        ('users', 'activity'): ('user_activity', 'user_id', 'hour', 'points'),
+    }
 
-load_data()
+    def __init__(self, db_file=SQLITE_FILE):
+        super().__init__()
+        self.db_file = db_file
+        self._db_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def _entity_row(self, store_name, entity_id, entity):
+        columns = self.COLUMNS[store_name]
+        skip = set(columns) | set(self.RELATION_FIELDS[store_name]) | {'id'}
+        skip.update(field for counter_store, field in self.COUNTER_TABLES if counter_store == store_name)
+        extra = {k: v for k, v in entity.items() if k not in skip}
+        row = [entity_id] + [entity.get(c) for c in columns]
+        row.append(json.dumps(extra, ensure_ascii=False) if extra else None)
+        return row
+
+    def _upsert(self, store_name, entity_id, entity):
+        columns = ('id',) + self.COLUMNS[store_name] + ('extra',)
+        placeholders = ', '.join('?' for _ in columns)
+        updates = ', '.join(f"{c} = excluded.{c}" for c in columns[1:])
+        self.conn.execute(
+            f"INSERT INTO {store_name} ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}",
+            self._entity_row(store_name, entity_id, entity)
+        )
+        for field in self.RELATION_FIELDS[store_name]:
+            self._replace_relation(store_name, entity_id, field, entity.get(field))
+        for (counter_store, field) in self.COUNTER_TABLES:
+            if counter_store == store_name:
+                self._replace_counters(store_name, entity_id, field, entity.get(field))
+
+    def _replace_relation(self, store_name, entity_id, field, ids):
+        if (store_name, field) == ('users', 'chats'):
+            self.conn.execute("DELETE FROM chat_members WHERE user_id = ?", (entity_id,))
+            self.conn.executemany("INSERT OR IGNORE INTO chat_members VALUES (?, ?)",
+                                  [(c, entity_id) for c in ids or ()])
+        elif (store_name, field) == ('users', 'channels'):
+            self.conn.execute("DELETE FROM user_channels WHERE user_id = ?", (entity_id,))
+            self.conn.executemany("INSERT OR IGNORE INTO user_channels VALUES (?, ?)",
+                                  [(entity_id, c) for c in ids or ()])
+        elif (store_name, field) == ('chats', 'members'):
+            self.conn.execute("DELETE FROM chat_members WHERE chat_id = ?", (entity_id,))
+            self.conn.executemany("INSERT OR IGNORE INTO chat_members VALUES (?, ?)",
+                                  [(entity_id, u) for u in ids or ()])
+
+    def _replace_counters(self, store_name, entity_id, field, counters):
+        table, owner_column, _, _ = self.COUNTER_TABLES[(store_name, field)]
+        self.conn.execute(f"DELETE FROM {table} WHERE {owner_column} = ?", (entity_id,))
+        self.conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?)",
+                              [(entity_id, k, n) for k, n in (counters or {}).items()])
+
+    def _delete(self, store_name, entity_id):
+        self.conn.execute(f"DELETE FROM {store_name} WHERE id = ?", (entity_id,))
+        if store_name == 'users':
+            self.conn.execute("DELETE FROM chat_members WHERE user_id = ?", (entity_id,))
+            self.conn.execute("DELETE FROM user_channels WHERE user_id = ?", (entity_id,))
+        elif store_name == 'chats':
+            self.conn.execute("DELETE FROM chat_members WHERE chat_id = ?", (entity_id,))
+        for (counter_store, _), (table, owner_column, _, _) in self.COUNTER_TABLES.items():
+            if counter_store == store_name:
+                self.conn.execute(f"DELETE FROM {table} WHERE {owner_column} = ?", (entity_id,))
+        if store_name == 'channels':
+            self.conn.execute("DELETE FROM user_channels WHERE channel_id = ?", (entity_id,))
+
+    def _set_field(self, store_name, entity_id, field, value):
+        if field in self.COLUMNS[store_name]:
+            self.conn.execute(f"UPDATE {store_name} SET {field} = ? WHERE id = ?", (value, entity_id))
+            return
+        if field in self.RELATION_FIELDS[store_name] or (store_name, field) in self.COUNTER_TABLES:
+            # Связи и счётчики лежат в своих таблицах; как и в памяти, запись об отсутствующей сущности не действует
+            if self.conn.execute(f"SELECT 1 FROM {store_name} WHERE id = ?", (entity_id,)).fetchone() is None:
+                return
+            if field in self.RELATION_FIELDS[store_name]:
+                self._replace_relation(store_name, entity_id, field, value)
+            else:
+                self._replace_counters(store_name, entity_id, field, value)
+            return
+        row = self.conn.execute(f"SELECT extra FROM {store_name} WHERE id = ?", (entity_id,)).fetchone()
+        if row is None:
+            return
+        extra = json.loads(row[0]) if row[0] else {}
+        extra[field] = value
+        self.conn.execute(f"UPDATE {store_name} SET extra = ? WHERE id = ?",
+                          (json.dumps(extra, ensure_ascii=False), entity_id))
+
+    def _apply_increments(self, increments):
+        for (store_name, field), deltas in increments.items():
+            if field in self.COLUMNS[store_name]:
+                self.conn.executemany(
+                    f"UPDATE {store_name} SET {field} = {field} + ? WHERE id = ?",
+                    [(delta, entity_id) for entity_id, delta in deltas.items()]
+                )
+            else:
+                for entity_id, delta in deltas.items():
+                    row = self.conn.execute(f"SELECT extra FROM {store_name} WHERE id = ?", (entity_id,)).fetchone()
+                    if row is not None:
+                        extra = json.loads(row[0]) if row[0] else {}
+                        self._set_field(store_name, entity_id, field, extra.get(field, 0) + delta)
+        increments.clear()
+
+    def write_lines(self, lines):
+        """Применяет пакет изменений одной транзакцией; счётчики суммируются перед записью"""
+        increments = {}
+        with self._db_lock, self.conn:
+            for line in lines:
+                record = json.loads(line)
+                op = record[0]
+                if op == 'incr' and len(record) > 5:
+                    # Счётчик в поле-словаре; приращения коммутируют, поэтому порядок не важен
+                    counter_table = self.COUNTER_TABLES.get((record[1], record[3]))
+                    if counter_table:
+                        table, owner_column, key_column, value_column = counter_table
+                        self.conn.execute(
+                            f"INSERT INTO {table} VALUES (?, ?, ?) "
+                            f"ON CONFLICT({owner_column}, {key_column}) DO UPDATE SET "
+                            f"{value_column} = {value_column} + excluded.{value_column}",
+                            (record[2], record[5], record[4])
+                        )
+                    continue
+                if op == 'incr':
+                    deltas = increments.setdefault((record[1], record[3]), {})
+                    deltas[record[2]] = deltas.get(record[2], 0) + record[4]
+                    continue
+                # Инкременты коммутируют между собой, но не с остальными операциями
+                self._apply_increments(increments)
+                if op == 'put':
+                    self._upsert(record[1], record[2], record[3])
+                elif op == 'del':
+                    self._delete(record[1], record[2])
+                elif op == 'set':
+                    self._set_field(record[1], record[2], record[3], record[4])
+                elif op == 'join':
+                    self.conn.execute("INSERT OR IGNORE INTO chat_members VALUES (?, ?)", (record[1], record[2]))
+                elif op == 'leave':
+                    self.conn.execute("DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?",
+                                      (record[1], record[2]))
+            self._apply_increments(increments)
+
+    def load(self):
+        data = {'users': {}, 'chats': {}, 'channels': {}}
+        with self._db_lock:
+            for store_name, columns in self.COLUMNS.items():
+                cursor = self.conn.execute(f"SELECT id, {', '.join(columns)}, extra FROM {store_name} ORDER BY rowid")
+                for row in cursor:
+                    entity = {'id': row[0]}
+                    for column, value in zip(columns, row[1:-1]):
+                        if column in self.OPTIONAL_COLUMNS:
+                            if value is not None:
+                                entity[column] = bool(value)
+                        else:
+                            entity[column] = value
+                    if row[-1]:
+                        entity.update(json.loads(row[-1]))
+                    for field in self.RELATION_FIELDS[store_name]:
+                        entity[field] = []
+                    data[store_name][row[0]] = entity
+            for chat_id, user_id in self.conn.execute("SELECT chat_id, user_id FROM chat_members"):
+                if chat_id in data['chats']:
+                    data['chats'][chat_id]['members'].append(user_id)
+                if user_id in data['users']:
+                    data['users'][user_id]['chats'].append(chat_id)
+            for user_id, channel_id in self.conn.execute("SELECT user_id, channel_id FROM user_channels"):
+                if user_id in data['users']:
+                    data['users'][user_id]['channels'].append(channel_id)
+            # Часы, вышедшие из всех окон рейтинга, больше не нужны
+            self.conn.execute("DELETE FROM user_activity WHERE hour < ?", (current_hour() - RATING_WINDOW_HOURS + 1,))
+            self.conn.commit()
+            for (store_name, field), (table, owner_column, key_column, value_column) in self.COUNTER_TABLES.items():
+                entities = data[store_name]
+                # Поле появляется только у сущностей со счётчиками: у большинства пользователей его нет
+                for entity_id, key, value in self.conn.execute(
+                        f"SELECT {owner_column}, {key_column}, {value_column} FROM {table}"):
+                    if entity_id in entities:
+                        entities[entity_id].setdefault(field, {})[key] = value
+        return data
+
+    def import_data(self, data):
+        """Однократный перенос данных (например, из data.json) одной транзакцией"""
+        with self._db_lock, self.conn:
+            for store_name in ('users', 'chats', 'channels'):
+                for entity_id, entity in data.get(store_name, {}).items():
+                    self._upsert(store_name, entity_id, entity)
+            # Участники чатов из обоих списков: в JSON они могли расходиться
+            for user_id, user in data.get('users', {}).items():
+                self.conn.executemany("INSERT OR IGNORE INTO chat_members VALUES (?, ?)",
+                                      [(c, user_id) for c in user.get('chats', [])])
+
+    # Запросы администратора
+
+    def count(self, store_name):
+        with self._db_lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {store_name}").fetchone()[0]
+
+    def stats_lines(self):
+        size = sum(os.path.getsize(p) for p in (self.db_file, self.db_file + '-wal') if os.path.exists(p))
+        return [f"Размер базы SQLite: {size / 1024:.1f} КБ"]
+
+    def close(self):
+        with self._db_lock:
+            self.conn.close()
+
+def create_storage(backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend == 'sqlite':
+        return SqliteStorage()
+    return JsonStorage()
+
+def import_json_to_sqlite(json_file=DATA_FILE, db_file=SQLITE_FILE):
+    """Переносит JSON-хранилище (data.json или его шарды вместе с журналом) в базу SQLite"""
+    data = JsonStorage(legacy_file=json_file).load()
+    target = SqliteStorage(db_file)
+    try:
+        target.import_data(data)
+    finally:
+        target.close()
+    counts = ', '.join(f"{name}: {len(data[name])}" for name in ('users', 'chats', 'channels'))
+    logger.info(f"Импорт {json_file} в {db_file} завершён ({counts})")
+
+# Хранилище открывается при запуске (open_storage), а не при импорте модуля
+storage = None
+data_store = WriteBehindStore(lambda: storage.write_pending())
+
+def open_storage():
+    global storage
+    if storage is None:
+        storage = create_storage()
+    return storage
+
+def _live_data():
+    return {'users': users, 'chats': chats, 'channels': channels}
+
+def journal_change(record):
+    """Применяет изменение к данным в памяти и записывает его в журнал"""
+    with storage.lock:
+        apply_journal_record(_live_data(), record)
+        storage.note_change(record)
+        storage.append(record)
+    data_store.mark_dirty()
+
+def save_entity(store_name, entity_id):
+    """Записывает в журнал текущее состояние сущности (или её удаление, если её больше нет)"""
+    entity_id = str(entity_id)
+    with storage.lock:
+        entity = _live_data()[store_name].get(entity_id)
+        if entity is None:
+            storage.append(['del', store_name, entity_id])
+        else:
+            storage.append(['put', store_name, entity_id, entity.to_dict()])
+    data_store.mark_dirty()
+
+def save_user(user_id):
+    save_entity('users', user_id)
+
+def save_chat(chat_id):
+    save_entity('chats', chat_id)
+
+def save_channel(channel_id):
+    save_entity('channels', channel_id)
+
+def increment_counter(store_name, entity_id, field, delta=1, member_id=None):
+    """Сразу применяет приращение к данным и пишет его в журнал.
+
+    С member_id увеличивается счётчик участника в поле-словаре (например, member_messages чата).
+    """
+    record = ['incr', store_name, str(entity_id), field, delta]
+    if member_id is not None:
+        record.append(str(member_id))
+    journal_change(record)
+
+class ActivityCounters:
+    """Счётчики активности (сообщения, посты) с разбиением на полосы.
+
+    Каждый поток обработчиков пишет дельты в свою полосу со своим замком, поэтому
+    потоки почти не конкурируют. Фоновый поток раз в interval суммирует полосы и
+    применяет к данным одну запись журнала на счётчик вместо записи на каждое сообщение.
+    """
+
+    def __init__(self, apply_func, stripes=COUNTER_STRIPES, interval=COUNTER_MERGE_INTERVAL):
+        self.apply_func = apply_func
+        self.interval = interval
+        self.last_merge_time = None
+        self.merged_increments = 0
+        self.merged_records = 0
+        self._stripes = [({}, threading.Lock()) for _ in range(stripes)]
+        self._stripe_numbers = itertools.count()
+        self._local = threading.local()
+        self._merge_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stripe(self):
+        stripe = getattr(self._local, 'stripe', None)
+        if stripe is None:
+            # Полосы раздаются потокам по кругу: get_ident() выровнены и плохо делятся по модулю
+            stripe = self._stripes[next(self._stripe_numbers) % len(self._stripes)]
+            self._local.stripe = stripe
+        return stripe
+
+    def add(self, store_name, entity_id, field, delta=1, member_id=None):
+        deltas, lock = self._stripe()
+        key = (store_name, entity_id, field, member_id)
+        with lock:
+            entry = deltas.get(key)
+            deltas[key] = (entry[0] + delta, entry[1] + 1) if entry else (delta, 1)
+
+    def pending_count(self):
+        return sum(len(deltas) for deltas, _ in self._stripes)
+
+    def merge(self):
+        """Переносит накопленные дельты в данные. Возвращает число применённых счётчиков"""
+        with self._merge_lock:
+            totals = {}
+            for deltas, lock in self._stripes:
+                with lock:
+                    items = list(deltas.items())
+                    deltas.clear()
+                for key, (delta, count) in items:
+                    total = totals.get(key)
+                    totals[key] = (total[0] + delta, total[1] + count) if total else (delta, count)
+            applied = 0
+            pending = list(totals.items())
+            try:
+                for (store_name, entity_id, field, member_id), (delta, count) in pending:
+                    if delta:
+                        self.apply_func(store_name, entity_id, field, delta, member_id)
+                    applied += 1
+                    self.merged_increments += count
+            except Exception as e:
+                # Неприменённые дельты возвращаем, чтобы не потерять их
+                deltas, lock = self._stripes[0]
+                with lock:
+                    for key, (delta, count) in pending[applied:]:
+                        entry = deltas.get(key)
+                        deltas[key] = (entry[0] + delta, entry[1] + count) if entry else (delta, count)
+                logger.error(f"Ошибка при слиянии счётчиков активности: {str(e)}")
+            self.merged_records += applied
+            self.last_merge_time = datetime.now()
+            return applied
+
+    def merge_entity(self, store_name, entity_id, then=None):
+        """Сразу применяет накопленные дельты одной сущности и под замком слияния вызывает then().
+
+        Нужна перед перезаписью счётчика: иначе ближайшее слияние прибавит
+        ожидающие дельты поверх нового значения.
+        """
+        with self._merge_lock:
+            totals = {}
+            for deltas, lock in self._stripes:
+                with lock:
+                    keys = [key for key in deltas if key[1] == entity_id and key[0] == store_name]
+                    for key in keys:
+                        delta, count = deltas.pop(key)
+                        total = totals.get(key)
+                        totals[key] = (total[0] + delta, total[1] + count) if total else (delta, count)
+            for (store_name, entity_id, field, member_id), (delta, count) in totals.items():
+                if delta:
+                    self.apply_func(store_name, entity_id, field, delta, member_id)
+                self.merged_increments += count
+            self.merged_records += len(totals)
+            return then() if then is not None else None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='counter-merger', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.merge()
+
+    def stop(self):
+        """Останавливает фоновый поток и сливает оставшиеся дельты"""
+        self._stopped.set()
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval + 5)
+        self.merge()
+
+activity_counters = ActivityCounters(increment_counter)
+
+def count_activity(store_name, entity_id, field, delta=1, member_id=None):
+    """Учитывает активность (сообщение, пост); в данных она появится после ближайшего слияния счётчиков"""
+    activity_counters.add(store_name, str(entity_id), field, delta, None if member_id is None else str(member_id))
+
+def count_user_activity(user_id, points=1):
+    """Начисляет очки в корзину текущего часа пользователя (рейтинги за сутки, неделю и месяц)"""
+    count_activity('users', user_id, 'activity', points, member_id=current_hour())
+
+def set_user_rating(user_id, new_rating):
+    """Перезаписывает рейтинг пользователя: messages_count = new_rating, реакции обнуляются.
+
+    Ожидающие счётчики пользователя сначала сливаются, чтобы они вошли в прежний рейтинг
+    и не добавились к новому. Возвращает прежний рейтинг или None, если пользователя нет.
+    """
+    user_id = str(user_id)
+
+    def override():
+        with storage.lock:
+            user = users.get(user_id)
+            if user is None:
+                return None
+            old_rating = calculate_rating(user)
+            set_entity_field('users', user_id, 'messages_count', new_rating)
+            set_entity_field('users', user_id, 'reactions_received', 0)
+            return old_rating
+
+    return activity_counters.merge_entity('users', user_id, override)
+
+def count_reactions(user_id, delta):
+    """Учитывает реакции на сообщения пользователя; как и в calculate_rating, реакция стоит 2 очка"""
+    count_activity('users', user_id, 'reactions_received', delta)
+    if delta > 0:
+        # Активность за окно - это то, что произошло в окне: снятие старой реакции её не уменьшает
+        count_user_activity(user_id, 2 * delta)
+
+class ChatMessageLog:
+    """Последние сообщения одного чата: автор, время и число анонимных реакций.
+
+    Идентификаторы сообщений в чате растут, поэтому записи добавляются в конец
+    массивов, а устаревшие удаляются с начала.
+    """
+
+    __slots__ = ('message_ids', 'authors', 'dates', 'reaction_totals')
+
+    def __init__(self):
+        self.message_ids = array('q')
+        self.authors = array('q')
+        self.dates = array('q')
+        self.reaction_totals = array('q')
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def add(self, message_id, author_id, date):
+        i = len(self.message_ids)
+        if i and self.message_ids[-1] >= message_id:
+            i = bisect.bisect_left(self.message_ids, message_id)
+            if i < len(self.message_ids) and self.message_ids[i] == message_id:
+                return
+        self.message_ids.insert(i, message_id)
+        self.authors.insert(i, author_id)
+        self.dates.insert(i, date)
+        self.reaction_totals.insert(i, 0)
+
+    def drop_oldest(self, count):
+        for column in (self.message_ids, self.authors, self.dates, self.reaction_totals):
+            del column[:count]
+
+    def find(self, message_id):
+        i = bisect.bisect_left(self.message_ids, message_id)
+        return i if i < len(self.message_ids) and self.message_ids[i] == message_id else -1
+
+class MessageAuthorCache:
+    """Кэш id сообщения -> автор для зачёта реакций (Telegram сообщает только id сообщения).
+
+    Память ограничена: в чате хранится не больше per_chat последних сообщений
+    (при переполнении удаляется самая старая четверть) и только за последние
+    ttl секунд; чатов не больше max_chats, вытесняется дольше всех неактивный.
+    На сообщение уходит 32 байта в массивах.
+    """
+
+    def __init__(self, per_chat=MESSAGE_AUTHORS_PER_CHAT, max_chats=MESSAGE_AUTHOR_CHATS, ttl=MESSAGE_AUTHOR_TTL):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def remember(self, chat_id, message_id, author_id, date):
+        with self._lock:
+            log = self._chats.get(chat_id)
+            if log is None:
+                log = self._chats[chat_id] = ChatMessageLog()
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+            log.add(int(message_id), int(author_id), int(date))
+            expired = bisect.bisect_left(log.dates, int(date) - self.ttl)
+            if len(log) - expired > self.per_chat:
+                expired = max(expired, len(log) - self.per_chat * 3 // 4)
+            if expired:
+                log.drop_oldest(expired)
+
+    def _entry(self, chat_id, message_id):
+        log = self._chats.get(chat_id)
+        if log is None:
+            return None, -1
+        i = log.find(int(message_id))
+        if i >= 0 and log.dates[i] < time.time() - self.ttl:
+            return None, -1
+        return log, i
+
+    def author(self, chat_id, message_id):
+        """id автора (строкой) или None, если сообщение неизвестно или слишком старое"""
+        with self._lock:
+            log, i = self._entry(chat_id, message_id)
+            return str(log.authors[i]) if i >= 0 else None
+
+    def set_reaction_total(self, chat_id, message_id, total):
+        """Запоминает новое число анонимных реакций; возвращает (автор, изменение) или None"""
+        with self._lock:
+            log, i = self._entry(chat_id, message_id)
+            if i < 0:
+                return None
+            delta = total - log.reaction_totals[i]
+            log.reaction_totals[i] = total
+            return str(log.authors[i]), delta
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(log) for log in self._chats.values())
+
+message_authors = MessageAuthorCache()
+
+def set_entity_field(store_name, entity_id, field, value):
+    journal_change(['set', store_name, str(entity_id), field, value])
+
+def add_chat_member(chat_id, user_id):
+    journal_change(['join', sys.intern(str(chat_id)), sys.intern(str(user_id))])
+
+def remove_chat_member(chat_id, user_id):
+    journal_change(['leave', str(chat_id), str(user_id)])
+
+def delete_chat(chat_id):
+    """Удаляет чат вместе со связями участников.
+
+    Выходы участников пишутся в журнал, чтобы в сохранённых списках чатов
+    пользователей не осталось ссылок на удалённый чат.
+    """
+    for user_id in tuple(membership.members(chat_id)):
+        remove_chat_member(chat_id, user_id)
+    chats.pop(chat_id, None)
+    save_chat(chat_id)
+
+def rename_chat(old_chat_id, chat_id):
+    """Переносит чат на новый id (например, после преобразования в супергруппу) вместе с участниками"""
+    member_ids = tuple(membership.members(old_chat_id))
+    for user_id in member_ids:
+        remove_chat_member(old_chat_id, user_id)
+    chat = chats.pop(old_chat_id)
+    chat['id'] = chat_id
+    chats[chat_id] = chat
+    save_chat(old_chat_id)
+    save_chat(chat_id)
+    for user_id in member_ids:
+        add_chat_member(chat_id, user_id)
+
+def flush_data():
+    """Немедленно сохраняет все накопленные изменения"""
+    activity_counters.merge()
+    return data_store.flush()
+
+def run_without_gc(func):
+    """Выполняет func с выключенным сборщиком мусора.
+
+    При загрузке создаются миллионы словарей, и сборщик раз за разом обходит их
+    впустую; без него загрузка идёт примерно вдвое быстрее.
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return func()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+class ShardLoader:
+    """Загрузка JSON-хранилища в записи по шардам.
+
+    Чаты и каналы загружаются первыми, затем шарды пользователей по порядку -
+    сразу или в фоновом потоке. Шард пользователя, к которому обратились до его
+    загрузки, загружается вне очереди, поэтому обработчики могут работать, пока
+    остальные пользователи ещё читаются с диска.
+    """
+
+    def __init__(self, source, stores, index):
+        self.source = source
+        self.stores = stores
+        self.index = index
+        shards = source.shard_names()
+        # Чаты нужны раньше пользователей: по ним проверяются списки чатов пользователей
+        self.order = [s for s in shards if s.split('.')[0] != 'users'] + [s for s in shards if s.split('.')[0] == 'users']
+        self.pending = set(shards)
+        self.loaded_entities = 0
+        self.started = time.time()
+        self.done = threading.Event()
+        self._lock = threading.RLock()
+        self._in_progress = set()
+        self._thread = None
+
+    def progress_text(self):
+        return f"{len(self.order) - len(self.pending)}/{len(self.order)} шардов, записей {self.loaded_entities}"
+
+    def ensure_loaded(self, entity_id):
+        """Загружает шард пользователя entity_id, если он ещё не загружен"""
+        if self.pending and isinstance(entity_id, str):
+            shard = self.source.shard_of('users', entity_id)
+            if shard in self.pending:
+                self.load_shard(shard)
+
+    def wait(self):
+        self.done.wait()
+
+    def load_shard(self, shard):
+        with self._lock:
+            # Повторный вход из того же потока - обращения к этому же шарду при применении журнала
+            if shard not in self.pending or shard in self._in_progress:
+                return
+            self._in_progress.add(shard)
+            try:
+                started = time.time()
+                store_name = shard.split('.')[0]
+                store = self.stores[store_name]
+                count = 0
+                for entity_id, entity in self.source.iter_shard(shard):
+                    self.index.add_loaded(store_name, entity_id, entity, self.stores['chats'])
+                    # Мимо проверок LoadingRecordStore: шард ещё числится незагруженным
+                    RecordStore.__setitem__(store, entity_id, entity)
+                    count += 1
+                replayed = self.source.replay_shard(shard, self.stores)
+                self.pending.discard(shard)
+            finally:
+                self._in_progress.discard(shard)
+            self.loaded_entities += count
+            logger.info(f"Загружен шард {shard}: записей {count}, из журнала {replayed} "
+                        f"({self.progress_text()}, {time.time() - started:.2f} с)")
+            if not self.pending:
+                self._finish()
+
+    def _finish(self):
+        for store in self.stores.values():
+            if type(store) is LoadingRecordStore:
+                store.__class__ = RecordStore
+        self.source.finish_loading()
+        logger.info(f"Загрузка данных завершена: записей {self.loaded_entities} за {time.time() - self.started:.1f} с")
+        self.done.set()
+
+    def run(self, shards=None):
+        for shard in self.order if shards is None else shards:
+            self.load_shard(shard)
+
+    def start(self):
+        """Загружает оставшиеся шарды в фоновом потоке"""
+        self._thread = threading.Thread(target=self._run_in_background, name='data-loader', daemon=True)
+        self._thread.start()
+
+    def _run_in_background(self):
+        try:
+            run_without_gc(self.run)
+            # Загруженные данные живут до конца работы: убираем их из обхода сборщиком мусора
+            gc.freeze()
+        except Exception as e:
+            # Снимки остаются выключенными, чтобы не записать неполные шарды;
+            # незагруженные шарды ещё будут загружаться при обращении к ним
+            logger.error(f"Ошибка при фоновой загрузке данных ({self.progress_text()}): {str(e)}")
+            self.done.set()
+
+def _registration_order(item):
+    joined_at = getattr(item[1], 'joined_at', None)
+    return joined_at if type(joined_at) is int else 0
+
+def load_records(source, background=False):
+    """Загружает данные хранилища в компактные записи и строит индекс участия.
+
+    Возвращает (записи, загрузчик). Загрузчик (ShardLoader) возвращается только для
+    JSON-хранилища с background=True: тогда пользователи догружаются в фоне.
+    Индекс сразу становится текущим (membership), так как записи обращаются к нему
+    при применении журнала.
+    """
+    global membership
+    if not isinstance(source, JsonStorage):
+        def load():
+            data = source.load()
+            index = MembershipIndex.from_data(data)
+            records = {store_name: RecordStore.from_loaded(RECORD_TYPES[store_name], store) for store_name, store in data.items()}
+            return records, index
+        records, membership = run_without_gc(load)
+        return records, None
+    membership = MembershipIndex()
+    source.prepare_load()
+    stores = {
+        'users': LoadingRecordStore(UserRecord),
+        'chats': RecordStore(ChatRecord),
+        'channels': RecordStore(ChannelRecord),
+    }
+    loader = ShardLoader(source, stores, membership)
+    stores['users']._loader = loader
+    if background:
+        run_without_gc(lambda: loader.run(['chats', 'channels']))
+        loader.start()
+        return stores, loader
+    run_without_gc(loader.run)
+    # Списки показывают пользователей в порядке регистрации, а шарды его не сохраняют
+    ordered_users = RecordStore(UserRecord)
+    for user_id, user in sorted(stores['users'].items(), key=_registration_order):
+        dict.__setitem__(ordered_users, user_id, user)
+    stores['users'] = ordered_users
+    return stores, None
+
+data_loader = None  # ShardLoader, пока пользователи догружаются в фоне
+
+def load_data(background=False):
+    """Загружает данные в память.
+
+    С background=True пользователи JSON-хранилища догружаются после возврата,
+    и бот может начинать работу сразу после загрузки чатов и каналов.
+    """
+    global users, chats, channels, data_loader
+    for orders in list_orders.values():
+        for order in orders.values():
+            if isinstance(order, RecordOrder):
+                order.reset()
+    list_pages.clear()
+    window_ratings.reset()
+    active_users.reset()
+    channel_users.reset()
+    audience_segments.reset()
+    search_index.reset()
+    channel_search_index.reset()
+    data, data_loader = load_records(open_storage(), background)
+    if data_loader is None:
+        # Загруженные данные живут до конца работы: убираем их из обхода сборщиком мусора
+        gc.freeze()
+    users, chats, channels = data['users'], data['chats'], data['channels']
+    if data_loader is None:
+        logger.info(f"Данные успешно загружены ({storage.name})")
+    else:
+        logger.info(f"Чаты и каналы загружены ({storage.name}), пользователи загружаются в фоне")
+
+# Выборки для администратора: по индексам в памяти при любом хранилище
+
+def query_search_users(search_query, limit, offset=0):
+    """Страница найденных пользователей по убыванию рейтинга и общее число найденных.
+
+    Поиск идёт по индексу в памяти при любом хранилище: индексы SQLite не умеют
+    искать подстроку без учёта ё и алфавита.
+    """
+    found_users = search_index.search(search_query)
+    page = heapq.nsmallest(offset + limit, found_users, key=lambda user: (-calculate_rating(user), user['id']))
+    return page[offset:], len(found_users)
+
+def resolve_usernames(usernames):
+    """Находит id пользователей по списку username (с @ или без, в любом регистре).
+
+    Известные боту пользователи находятся по индексу поиска за один проход;
+    через API (get_chat) параллельно запрашиваются только остальные.
+    Возвращает ({username как во входном списке: id}, [ненайденные username]).
+    """
+    wanted = {}
+    for username in usernames:
+        username = username.strip()
+        if username.lstrip('@'):
+            wanted.setdefault(username.lstrip('@').lower(), username)
+    found = search_index.lookup('username', wanted)
+    resolved = {wanted[name]: record.id for name, record in found.items()}
+    missing = [username for name, username in wanted.items() if name not in found]
+    unresolved = []
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(USERNAME_LOOKUP_WORKERS, len(missing))) as executor:
+            futures = [(username, executor.submit(bot.get_chat, '@' + username.lstrip('@'))) for username in missing]
+            for username, future in futures:
+                try:
+                    resolved[username] = str(future.result().id)
+                except Exception as e:
+                    logger.error(f"Не удалось найти пользователя {username}: {str(e)}")
+                    unresolved.append(username)
+    return resolved, unresolved
+
+def query_users_with_channel(channel_id):
+    return channel_users.users_of(channel_id)
+
+def export_json(path):
+    """Выгружает текущие данные в читаемый JSON-файл (независимо от формата хранилища)"""
+    with storage.lock:
+        # Поверхностные копии словарей, чтобы новые записи не мешали сериализации
+        data = {'users': dict(users), 'chats': dict(chats), 'channels': dict(channels)}
+    for attempt in range(3):
+        try:
+            atomic_write(path, lambda f: json.dump(data, f, ensure_ascii=False, indent=2, default=EntityRecord.to_dict))
+            break
+        except RuntimeError:
+            # Сущность изменилась во время сериализации - повторяем
+            continue
+    else:
+        raise RuntimeError("Данные слишком часто меняются во время выгрузки")
+    logger.info(f"Данные выгружены в {path}")
+    return path
+
+_bot_user = None  # ответ getMe: сам бот (см. get_bot_user)
+_bot_user_lock = threading.Lock()
+
+def get_bot_user(refresh=False):
+    """Пользователь самого бота (getMe).
+
+    Запрашивается один раз за работу: id и username бота не меняются, а имя
+    меняется только через change_bot_name_step, который вызывает refresh=True.
+    """
+    global _bot_user
+    if _bot_user is None or refresh:
+        with _bot_user_lock:
+            if _bot_user is None or refresh:
+                _bot_user = bot.get_me()
+    return _bot_user
 
 def is_user_blocked(user_id):
     return users.get(str(user_id), {}).get('blocked', False)
@@ -102,20 +2525,1287 @@ def update_user_rating(user_id, change):
     user = users.get(str(user_id))
     if user:
         old_rating = calculate_rating(user)
-        user['messages_count'] = user.get('messages_count', 0) + change
+        increment_counter('users', user_id, 'messages_count', change)
         new_rating = calculate_rating(user)
-        save_data()
         return old_rating, new_rating
     return None
 
+class SortedRanking:
+    """Элементы, упорядоченные по очкам: место за O(log n), страница из k за O(log n + k).
+
+    Ключи (-очки, порядковый номер, элемент) хранятся в отсортированных блоках
+    около block_size ключей; дерево Фенвика над длинами блоков даёт место
+    элемента и блок, с которого начинается страница. С descending=False ключи -
+    (очки, номер, элемент), и очками может быть любое сравнимое значение,
+    например строка для порядка по названию. Порядковый номер выдаётся при
+    первом добавлении и сохраняется при смене очков, поэтому при равных очках
+    выше тот, кто добавлен раньше. Блокировок нет - их берут владельцы
+    (RecordOrder, WindowRatings).
+    """
+
+    def __init__(self, block_size=LEADERBOARD_BLOCK_SIZE, descending=True):
+        self.block_size = block_size
+        self.descending = descending
+        self.clear()
+
+    def clear(self):
+        self._blocks = []
+        self._maxes = []
+        self._tree = [0]
+        self._keys = {}
+        self._next_seq = 0
+
+    def _sort_value(self, score):
+        return -score if self.descending else score
+
+    def load(self, entries):
+        """Заполняет рейтинг из [(id, очки, элемент), ...]; порядковые номера - по порядку entries"""
+        sort_value = self._sort_value
+        keys = [(sort_value(score), seq, item) for seq, (_, score, item) in enumerate(entries)]
+        self._keys = {item_id: key for (item_id, _, _), key in zip(entries, keys)}
+        # Сортировка устойчива, поэтому достаточно сравнивать только очки
+        keys.sort(key=lambda key: key[0])
+        self._blocks = [keys[i:i + self.block_size] for i in range(0, len(keys), self.block_size)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._rebuild_tree()
+        self._next_seq = len(entries)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, item_id):
+        """Ключ (-очки, номер, элемент) или None"""
+        return self._keys.get(item_id)
+
+    def score(self, item_id):
+        key = self._keys.get(item_id)
+        return self._sort_value(key[0]) if key is not None else 0
+
+    def ids(self):
+        """id всех элементов (живое представление: копировать под блокировкой владельца)"""
+        return self._keys.keys()
+
+    def set(self, item_id, score, item):
+        """Ставит элемент на место по очкам; False, если ничего не изменилось"""
+        sort_value = self._sort_value(score)
+        key = self._keys.get(item_id)
+        if key is None:
+            seq = self._next_seq
+            self._next_seq += 1
+        else:
+            if key[0] == sort_value and key[2] is item:
+                return False
+            self._remove_key(key)
+            seq = key[1]
+        new_key = (sort_value, seq, item)
+        self._insert_key(new_key)
+        self._keys[item_id] = new_key
+        return True
+
+    def discard(self, item_id):
+        key = self._keys.pop(item_id, None)
+        if key is None:
+            return False
+        self._remove_key(key)
+        return True
+
+    def top(self, n):
+        """[(элемент, очки), ...] для n лучших"""
+        return self.page(0, n)
+
+    def page(self, offset, n):
+        """[(элемент, очки), ...] для мест offset + 1 ... offset + n"""
+        keys = []
+        i, offset = self._tree_find(offset)
+        while i < len(self._blocks) and len(keys) < n:
+            keys.extend(self._blocks[i][offset:offset + n - len(keys)])
+            i += 1
+            offset = 0
+        sort_value = self._sort_value
+        return [(key[2], sort_value(key[0])) for key in keys]
+
+    def rank(self, item_id):
+        """Место (с 1) или None"""
+        key = self._keys.get(item_id)
+        if key is None:
+            return None
+        i = bisect.bisect_left(self._maxes, key)
+        return self._tree_prefix(i) + bisect.bisect_left(self._blocks[i], key) + 1
+
+    def _insert_key(self, key):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._blocks[i].append(key)
+            self._maxes[i] = key
+        else:
+            bisect.insort(self._blocks[i], key)
+        self._tree_add(i, 1)
+        block = self._blocks[i]
+        if len(block) > 2 * self.block_size:
+            self._blocks[i:i + 1] = [block[:self.block_size], block[self.block_size:]]
+            self._maxes[i:i + 1] = [self._blocks[i][-1], self._blocks[i + 1][-1]]
+            self._rebuild_tree()
+
+    def _remove_key(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        block = self._blocks[i]
+        del block[bisect.bisect_left(block, key)]
+        if block:
+            self._maxes[i] = block[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+            self._rebuild_tree()
+
+    def _rebuild_tree(self):
+        tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, i, delta):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _tree_prefix(self, i):
+        """Число ключей в блоках [0, i)"""
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _tree_find(self, offset):
+        """Блок, в котором лежит ключ с номером offset (с 0), и номер ключа в этом блоке"""
+        tree = self._tree
+        i = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if i + step < len(tree) and tree[i + step] <= offset:
+                i += step
+                offset -= tree[i]
+            step >>= 1
+        return i, offset
+
+class LazyIndex:
+    """Индекс по записям хранилища, который строится при первом обращении или в фоне.
+
+    До построения изменения записей ничего не стоят: _change их пропускает.
+    Построение обходит снимок хранилища без блокировки индекса, а изменения,
+    пришедшие за это время, копятся в _changes и применяются после установки
+    построенного. Подклассы задают _build(store) - содержимое индекса по
+    записям, _install(built) - установку его под lock, _apply(*изменение) -
+    одно изменение построенного индекса и _describe(built) - строку для журнала.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Забывает построенный индекс (например, перед загрузкой новых данных)"""
+        with self.lock:
+            self._built = False
+            self._building = False
+            # Изменения, пришедшие во время построения: [(операция, запись, ...), ...]
+            self._changes = []
+
+    def _change(self, *change):
+        if not (self._built or self._building):
+            return
+        with self.lock:
+            if self._built:
+                self._apply(*change)
+            elif self._building:
+                self._changes.append(change)
+
+    def _replay(self, changes):
+        """Применяет изменения, пришедшие во время построения (вызывается под lock)"""
+        for change in changes:
+            self._apply(*change)
+
+    def _ensure_built(self):
+        if self._built:
+            return
+        with self._build_lock:
+            if self._built:
+                return
+            store = self.source()
+            len(store)  # во время фоновой загрузки данных обход ждёт её окончания
+            with self.lock:
+                self._building = True
+                self._changes = []
+            try:
+                built = self._build(store)
+                with self.lock:
+                    self._install(built)
+                    self._built = True
+                    self._replay(self._changes)
+            finally:
+                with self.lock:
+                    self._building = False
+                    self._changes = []
+            logger.info(self._describe(built))
+
+    def build_async(self):
+        """Строит индекс в фоновом потоке, чтобы первый запрос не ждал"""
+        threading.Thread(target=self._ensure_built, name=f"{type(self).__name__}-builder", daemon=True).start()
+
+class RecordOrder(LazyIndex):
+    """Записи хранилища, упорядоченные по score(запись), с обновлением при каждом изменении.
+
+    fields - поля записи, от которых зависит score: их изменения переставляют
+    запись. При равных очках порядок повторяет порядок словаря, то есть такой же,
+    как у sorted(store.values(), key=score, reverse=descending). version
+    меняется при каждой перестановке, добавлении или удалении - по ней кэш
+    страниц (ListPageCache) узнаёт, что страница устарела.
+    """
+
+    def __init__(self, source, score, fields, descending=True, name='рейтинг', block_size=LEADERBOARD_BLOCK_SIZE):
+        self.score = score
+        self.fields = frozenset(fields)
+        self.name = name
+        self._ranking = SortedRanking(block_size, descending)
+        self.version = 0
+        super().__init__(source)
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+            self._ranking.clear()
+            self.version += 1
+
+    def __len__(self):
+        self._ensure_built()
+        return len(self._ranking)
+
+    # Обновления от записей (EntityRecord.ORDERS)
+
+    def add(self, record):
+        """Запись добавлена в хранилище (новая или вместо прежней с тем же id)"""
+        self._change('add', record)
+
+    def update(self, record):
+        """У записи изменилось одно из полей fields"""
+        self._change('update', record)
+
+    def remove(self, record):
+        self._change('remove', record)
+
+    def _apply(self, operation, record):
+        record_id = record.id
+        key = self._ranking.get(record_id)
+        if operation == 'add':
+            changed = self._ranking.set(record_id, self.score(record), record)
+        elif key is not None and key[2] is record:
+            # Записи, уже удалённые из хранилища или заменённые другой, порядок не меняют
+            if operation == 'update':
+                changed = self._ranking.set(record_id, self.score(record), record)
+            else:
+                changed = self._ranking.discard(record_id)
+        else:
+            changed = False
+        if changed:
+            self.version += 1
+
+    def _build(self, store):
+        score = self.score
+        return [(record_id, score(record), record) for record_id, record in list(store.items())]
+
+    def _install(self, entries):
+        self._ranking.load(entries)
+        self.version += 1
+
+    def _describe(self, entries):
+        return f"Порядок «{self.name}» построен: {len(entries)} записей"
+
+    def top(self, n):
+        """n первых записей"""
+        return self.page(0, n)
+
+    def page(self, offset, limit):
+        """Записи с места offset + 1: limit штук или меньше в конце"""
+        self._ensure_built()
+        with self.lock:
+            return [record for record, _ in self._ranking.page(offset, limit)]
+
+    def rank(self, record_id):
+        """Место записи (с 1) или None"""
+        self._ensure_built()
+        with self.lock:
+            return self._ranking.rank(str(record_id))
+
+class WindowRatings(LazyIndex):
+    """Рейтинги активности за скользящие окна RATING_WINDOWS (сутки, неделя, месяц).
+
+    Очки пользователя в окне - сумма его часовых корзин (поле activity), попавших
+    в окно. Приращение корзины сразу меняет сумму во всех окнах, без обхода
+    истории. Когда самый ранний учтённый час пользователя выходит из окна, сумма
+    пересчитывается по его корзинам; моменты выхода лежат в куче, поэтому с
+    наступлением нового часа пересчитываются только те, у кого что-то истекло.
+    """
+
+    def __init__(self, source, windows=RATING_WINDOWS, block_size=LEADERBOARD_BLOCK_SIZE):
+        self.windows = dict(windows)
+        self._rankings = {window: SortedRanking(block_size) for window in self.windows}
+        # Меняется при любом изменении таблиц (см. RecordOrder.version)
+        self.version = 0
+        super().__init__(source)
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+            self.version += 1
+            for ranking in self._rankings.values():
+                ranking.clear()
+            # Куча (час выхода из окна, окно, id) и актуальный час выхода для (окно, id)
+            self._expiry = []
+            self._scheduled = {}
+            self._hour = None
+
+    # Обновления от записей пользователей
+
+    def add(self, record):
+        self._change('add', record)
+
+    def update(self, record):
+        """Поле activity записи заменено целиком"""
+        self._change('update', record)
+
+    def remove(self, record):
+        self._change('remove', record)
+
+    def advance(self):
+        """Исключает из окон истёкшие часы.
+
+        Вызывается под lock до изменения корзин: иначе пересчёт по корзинам,
+        уже содержащим приращение, учёл бы его второй раз.
+        """
+        if self._built:
+            with self.lock:
+                self._advance()
+
+    def add_points(self, record, hour, delta):
+        """В корзину hour пользователя добавлено delta очков (вызывается под lock после advance)"""
+        if not (self._built or self._building):
+            return
+        with self.lock:
+            if self._built:
+                self._add_points(record, hour, delta)
+            elif self._building:
+                self._changes.append(('update', record))
+
+    def _apply(self, operation, record):
+        self._advance()
+        user_id = record.id
+        if operation == 'remove':
+            for window, ranking in self._rankings.items():
+                key = ranking.get(user_id)
+                if key is not None and key[2] is record:
+                    ranking.discard(user_id)
+                    self._scheduled.pop((window, user_id), None)
+                    self.version += 1
+        elif operation == 'add' or self.source().get(user_id) is record:
+            for window in self.windows:
+                self._refresh(window, record)
+
+    def _add_points(self, record, hour, delta):
+        user_id = record.id
+        if self.source().get(user_id) is not record:
+            return
+        for window, hours in self.windows.items():
+            if hour <= self._hour - hours:
+                continue
+            key = self._rankings[window].get(user_id)
+            if key is None or key[2] is not record:
+                self._refresh(window, record)
+            else:
+                self._set(window, record, -key[0] + delta, None)
+
+    def _refresh(self, window, record):
+        """Пересчитывает очки пользователя в окне по его корзинам"""
+        activity = record.get('activity')
+        start = self._hour - self.windows[window] + 1
+        if activity:
+            self._set(window, record, activity.points_since(start), activity.first_hour_since(start))
+        else:
+            self._set(window, record, 0, None)
+
+    def _set(self, window, record, points, first_hour):
+        user_id = record.id
+        if points <= 0:
+            if self._rankings[window].discard(user_id):
+                self.version += 1
+            self._scheduled.pop((window, user_id), None)
+            return
+        if self._rankings[window].set(user_id, points, record):
+            self.version += 1
+        if first_hour is not None:
+            expire_hour = first_hour + self.windows[window]
+        elif (window, user_id) not in self._scheduled:
+            # Пользователь только что попал в окно: учтён лишь текущий час
+            expire_hour = self._hour + self.windows[window]
+        else:
+            return
+        if self._scheduled.get((window, user_id)) != expire_hour:
+            self._scheduled[(window, user_id)] = expire_hour
+            heapq.heappush(self._expiry, (expire_hour, window, user_id))
+
+    def _advance(self):
+        """Исключает из окон часы, которые из них вышли"""
+        hour = current_hour()
+        if hour == self._hour:
+            return
+        self._hour = hour
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= hour:
+            expire_hour, window, user_id = heapq.heappop(expiry)
+            if self._scheduled.get((window, user_id)) != expire_hour:
+                continue  # запись устарела: время выхода с тех пор сдвинулось
+            del self._scheduled[(window, user_id)]
+            key = self._rankings[window].get(user_id)
+            if key is not None:
+                self._refresh(window, key[2])
+
+    def _build(self, store):
+        hour = current_hour()
+        entries = {window: [] for window in self.windows}
+        expiry = []
+        for user_id, record in list(store.items()):
+            activity = record.get('activity')
+            if not activity:
+                continue
+            for window, hours in self.windows.items():
+                start = hour - hours + 1
+                points = activity.points_since(start)
+                if points > 0:
+                    entries[window].append((user_id, points, record))
+                    expiry.append((activity.first_hour_since(start) + hours, window, user_id))
+        heapq.heapify(expiry)
+        return hour, entries, expiry
+
+    def _install(self, built):
+        hour, entries, expiry = built
+        for window, ranking in self._rankings.items():
+            ranking.load(entries[window])
+        self._expiry = expiry
+        self._scheduled = {(window, user_id): expire_hour for expire_hour, window, user_id in expiry}
+        self._hour = hour
+        self.version += 1
+        self._advance()
+
+    def _describe(self, built):
+        _, entries, _ = built
+        return f"Рейтинги активности построены: {', '.join(f'{window} - {len(entries[window])}' for window in self.windows)}"
+
+    def top(self, window, n):
+        """n самых активных за окно: [(запись пользователя, очки), ...]"""
+        self._ensure_built()
+        with self.lock:
+            self._advance()
+            return self._rankings[window].top(n)
+
+    def page(self, window, offset, limit):
+        """Страница самых активных за окно с места offset + 1: [(запись пользователя, очки), ...]"""
+        self._ensure_built()
+        with self.lock:
+            self._advance()
+            return self._rankings[window].page(offset, limit)
+
+    def rank(self, window, user_id):
+        """Место пользователя в окне (с 1) или None, если активности в окне не было"""
+        self._ensure_built()
+        with self.lock:
+            self._advance()
+            return self._rankings[window].rank(str(user_id))
+
+    def points(self, window, user_id):
+        self._ensure_built()
+        with self.lock:
+            self._advance()
+            return self._rankings[window].score(str(user_id))
+
+    def count(self, window):
+        """Число пользователей с активностью в окне"""
+        self._ensure_built()
+        with self.lock:
+            self._advance()
+            return len(self._rankings[window])
+
+    def members(self, window):
+        """Множество id пользователей с активностью в окне"""
+        self._ensure_built()
+        with self.lock:
+            self._advance()
+            return set(self._rankings[window].ids())
+
+# Транслитерация для поиска: кириллица и латиница сводятся к одному написанию,
+# поэтому «Иван» находится по «ivan», а «Alexey» - по «Алексей»
+SEARCH_TRANSLITERATE = True
+_SEARCH_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': None, 'ы': 'i', 'ь': None, 'э': 'e', 'ю': 'iu', 'я': 'ia',
+    # Разные латинские написания одних и тех же звуков
+    'y': 'i', 'x': 'ks', 'w': 'v',
+})
+
+def normalize_search_text(text):
+    """Текст для поиска: casefold, ё -> е и, если включено, транслитерация в латиницу"""
+    text = text.casefold().replace('ё', 'е')
+    if SEARCH_TRANSLITERATE:
+        text = text.translate(_SEARCH_TRANSLIT).replace('kh', 'h').replace('ts', 'c')
+    return text
+
+class TrigramIndex:
+    """Индекс подстрок: триграмма нормализованного текста -> отсортированный массив id записей.
+
+    Кандидаты для запроса - пересечение списков его самых редких триграмм;
+    затем каждый кандидат проверяется по тексту (см. matches). Id хранятся
+    числами в array('q'), около 8 байт на триграмму поля. Блокировок нет -
+    их берёт SearchIndex.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._postings = {}
+
+    def texts(self, record):
+        texts = []
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if isinstance(value, str) and value:
+                texts.append(normalize_search_text(value))
+        return texts
+
+    def trigrams(self, record):
+        return {text[i:i + 3] for text in self.texts(record) for i in range(len(text) - 2)}
+
+    def add(self, record):
+        record_id = int(record.id)
+        for trigram in self.trigrams(record):
+            posting = self._postings.get(trigram)
+            if posting is None:
+                self._postings[trigram] = array('q', [record_id])
+                continue
+            i = bisect.bisect_left(posting, record_id)
+            if i == len(posting) or posting[i] != record_id:
+                posting.insert(i, record_id)
+
+    def remove(self, record):
+        record_id = int(record.id)
+        for trigram in self.trigrams(record):
+            posting = self._postings.get(trigram)
+            if posting is None:
+                continue
+            i = bisect.bisect_left(posting, record_id)
+            if i < len(posting) and posting[i] == record_id:
+                del posting[i]
+                if not posting:
+                    del self._postings[trigram]
+
+    def build(self, records):
+        postings = {}
+        for record in records:
+            record_id = int(record.id)
+            for trigram in self.trigrams(record):
+                posting = postings.get(trigram)
+                if posting is None:
+                    postings[trigram] = [record_id]
+                else:
+                    posting.append(record_id)
+        self._postings = {trigram: array('q', sorted(ids)) for trigram, ids in postings.items()}
+
+    def discard_ids(self, record_ids):
+        """Убирает id из всех списков (полный проход - для записей, изменённых во время построения)"""
+        record_ids = {int(record_id) for record_id in record_ids}
+        for trigram in list(self._postings):
+            posting = self._postings[trigram]
+            if any(record_id in record_ids for record_id in posting):
+                posting = array('q', (record_id for record_id in posting if record_id not in record_ids))
+                if posting:
+                    self._postings[trigram] = posting
+                else:
+                    del self._postings[trigram]
+
+    def candidates(self, query):
+        """Id записей, текст которых может содержать query (уже нормализованный, от 3 символов)"""
+        postings = []
+        for trigram in {query[i:i + 3] for i in range(len(query) - 2)}:
+            posting = self._postings.get(trigram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        result = postings[0]
+        # Двух-трёх самых редких триграмм обычно хватает, остальное отсеет проверка текста
+        for posting in postings[1:3]:
+            result = [record_id for record_id in result if self._contains(posting, record_id)]
+        return result
+
+    @staticmethod
+    def _contains(posting, record_id):
+        i = bisect.bisect_left(posting, record_id)
+        return i < len(posting) and posting[i] == record_id
+
+    def matches(self, record, query):
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if isinstance(value, str) and query in normalize_search_text(value):
+                return True
+        return False
+
+    def posting_count(self):
+        return sum(len(posting) for posting in self._postings.values())
+
+class SearchIndex(LazyIndex):
+    """Индекс поиска записей администратором: по началу полей и по подстроке имени.
+
+    Для каждого поля из prefix_fields - список записей, отсортированный по
+    (значение в нижнем регистре, id): поиск по префиксу - два bisect и срез, без
+    обхода всех записей, по 8 байт на заполненное поле. Поля substring_fields
+    дополнительно попадают в TrigramIndex - так находятся фрагменты имени без
+    учёта регистра, ё и алфавита. Запись убирается из индекса по старым
+    значениям до изменения поля и возвращается после (см. UserRecord.__setitem__).
+    """
+
+    def __init__(self, source, prefix_fields, substring_fields):
+        # По 'id' находится прежняя запись, если её заменили новой с тем же id
+        self.prefix_fields = tuple(prefix_fields) + ('id',)
+        self.substring_fields = tuple(substring_fields)
+        super().__init__(source)
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+            self._lists = {field: [] for field in self.prefix_fields}
+            self._trigrams = TrigramIndex(self.substring_fields)
+
+    @staticmethod
+    def _value(record, field):
+        value = getattr(record, field, None)
+        return value.lower() if isinstance(value, str) and value else None
+
+    @classmethod
+    def _sort_key(cls, field):
+        return lambda record: (cls._value(record, field) or '', record.id)
+
+    def add(self, record):
+        """Запись добавлена в хранилище или изменила поле поиска"""
+        self._change('add', record)
+
+    def remove(self, record):
+        """Запись удаляется из хранилища или сейчас изменит поле поиска"""
+        self._change('remove', record)
+
+    def _apply(self, operation, record):
+        if operation == 'remove':
+            self._delete(record)
+        elif self.source().get(record.id) is record:
+            self._insert(record)
+
+    def _position(self, field, record):
+        """Место записи в списке поля: (список, индекс, найдена ли запись с тем же id)"""
+        records = self._lists[field]
+        key = (self._value(record, field), record.id)
+        i = bisect.bisect_left(records, key, key=self._sort_key(field))
+        return records, i, i < len(records) and records[i].id == record.id and self._value(records[i], field) == key[0]
+
+    def _insert(self, record):
+        records, i, found = self._position('id', record)
+        if found:
+            if records[i] is record:
+                return
+            # Запись заменили другой с тем же id: прежняя уходит из индекса
+            self._delete(records[i])
+        for field in self.prefix_fields:
+            if self._value(record, field) is not None:
+                records, i, found = self._position(field, record)
+                records.insert(i, record)
+        self._trigrams.add(record)
+
+    def _delete(self, record):
+        records, i, found = self._position('id', record)
+        if not (found and records[i] is record):
+            return
+        for field in self.prefix_fields:
+            if self._value(record, field) is not None:
+                records, i, found = self._position(field, record)
+                if found and records[i] is record:
+                    del records[i]
+        self._trigrams.remove(record)
+
+    def _build(self, store):
+        records = list(store.values())
+        lists = {
+            field: sorted((r for r in records if self._value(r, field) is not None), key=self._sort_key(field))
+            for field in self.prefix_fields
+        }
+        trigrams = TrigramIndex(self.substring_fields)
+        trigrams.build(records)
+        return records, lists, trigrams
+
+    def _install(self, built):
+        _, self._lists, self._trigrams = built
+
+    def _replay(self, changes):
+        # Записи, изменённые во время построения, могли попасть в списки по старым значениям:
+        # они убираются целиком и добавляются заново в текущем виде
+        changed = {record.id for _, record in changes}
+        if not changed:
+            return
+        for field_records in self._lists.values():
+            field_records[:] = [r for r in field_records if r.id not in changed]
+        self._trigrams.discard_ids(changed)
+        store = self.source()
+        for record_id in changed:
+            record = store.get(record_id)
+            if record is not None:
+                self._insert(record)
+
+    def _describe(self, built):
+        records, _, trigrams = built
+        return f"Индекс поиска построен: {len(records)} записей, {trigrams.posting_count()} вхождений триграмм"
+
+    def lookup(self, field, values):
+        """Точный поиск без учёта регистра сразу для многих значений поля: {значение: запись}.
+
+        Значения сортируются, и список поля проходится один раз вперёд: каждый
+        bisect начинается с места предыдущего.
+        """
+        self._ensure_built()
+        found = {}
+        store = self.source()
+        with self.lock:
+            records = self._lists[field]
+            sort_key = self._sort_key(field)
+            i = 0
+            for value in sorted({value.lower() for value in values if value}):
+                i = bisect.bisect_left(records, (value,), lo=i, key=sort_key)
+                j = i
+                # При равных значениях (устаревшие записи) берётся та, что сейчас в хранилище
+                while j < len(records) and self._value(records[j], field) == value:
+                    if store.get(records[j].id) is records[j]:
+                        found[value] = records[j]
+                        break
+                    j += 1
+        return found
+
+    def search(self, query):
+        """Записи, у которых поле начинается с query или имя содержит его как подстроку.
+
+        "@" в начале запроса ищет только по username.
+        """
+        self._ensure_built()
+        query = query.strip()
+        fields = self.prefix_fields
+        if query.startswith('@'):
+            query, fields = query[1:], ('username',)
+        prefix = query.lower()
+        if not prefix:
+            return []
+        substring = normalize_search_text(query) if fields is self.prefix_fields else ''
+        found = {}
+        with self.lock:
+            for field in fields:
+                records = self._lists[field]
+                sort_key = self._sort_key(field)
+                start = bisect.bisect_left(records, (prefix,), key=sort_key)
+                end = bisect.bisect_left(records, (prefix + '\uffff',), key=sort_key)
+                for record in records[start:end]:
+                    found[record.id] = record
+            if len(substring) >= 3:
+                store = self.source()
+                for record_id in self._trigrams.candidates(substring):
+                    record = store.get(str(record_id))
+                    if record is not None and record.id not in found and self._trigrams.matches(record, substring):
+                        found[record.id] = record
+        return list(found.values())
+
+class WindowRatingOrder:
+    """Окно WindowRatings в виде порядка для списков администратора (page, len, version)"""
+
+    def __init__(self, ratings, window):
+        self.ratings = ratings
+        self.window = window
+
+    @property
+    def version(self):
+        return self.ratings.version
+
+    def __len__(self):
+        return self.ratings.count(self.window)
+
+    def page(self, offset, limit):
+        return [record for record, _ in self.ratings.page(self.window, offset, limit)]
+
+class ListPageCache:
+    """Готовые страницы списков администратора: (текст, разметка) по (список, порядок, страница).
+
+    Страница хранится вместе с версиями, на которых она построена: версией
+    порядка (меняется, когда записи в нём переставляются, добавляются или
+    удаляются) и версией списка (меняется при добавлении и удалении записей и
+    при изменении полей LIST_FIELDS, показанных в строках). Пока обе прежние,
+    листание отдаёт готовую страницу, не обращаясь к данным.
+    """
+
+    def __init__(self, size=LIST_PAGE_CACHE_SIZE):
+        self.size = size
+        self._pages = OrderedDict()
+        self._versions = {}
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def invalidate(self, store_name):
+        """Записи списка store_name изменились; вызывается без блокировки на каждое изменение"""
+        self._versions[store_name] = next(self._counter)
+
+    def version(self, store_name):
+        return self._versions.get(store_name, 0)
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._pages.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, page):
+        with self._lock:
+            self._pages[key] = (version, page)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+def time_order_score(field):
+    """Очки порядка по времени: число секунд (записи без даты - в конце)"""
+    def score(record):
+        value = getattr(record, field, None)
+        return value if isinstance(value, int) else 0
+    return score
+
+def name_order_score(*fields):
+    """Очки порядка по алфавиту: поля через пробел без учёта регистра"""
+    def score(record):
+        return ' '.join(record.get(field) or '' for field in fields).strip().casefold()
+    return score
+
+# Измерения сегментов аудитории: имя -> (поля записи, значение пользователя, значение большинства)
+AUDIENCE_DIMENSIONS = {
+    'language': (frozenset({'language'}), lambda user: user.get('language', 'ru'), 'ru'),
+    'tier': (UserRecord.RATING_FIELDS, lambda user: get_rank_emoji(calculate_rating(user)), EMOJI['medal_bronze']),
+    'notifications': (frozenset({'notifications'}), lambda user: bool(user.get('notifications', True)), True),
+}
+
+class AudienceSegments(LazyIndex):
+    """Сегменты пользователей для адресной рассылки: пересечение условий без прохода по всем.
+
+    По каждому измерению AUDIENCE_DIMENSIONS хранятся множества id для всех
+    значений, кроме значения большинства: его сегмент - все пользователи за
+    вычетом остальных значений, поэтому обычный пользователь места в сегментах
+    не занимает. Множества обновляются при изменении полей записи (UserRecord).
+    Кроме измерений, условием может быть активность за окно RATING_WINDOWS
+    (из window_ratings) и участие в чате (из membership). Пересечение считается
+    встроенными операциями множеств начиная с самого маленького сегмента.
+    """
+
+    def __init__(self, source, dimensions=AUDIENCE_DIMENSIONS):
+        self.dimensions = dimensions
+        self.fields = frozenset().union(*(fields for fields, _, _ in dimensions.values()))
+        super().__init__(source)
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+            # Измерение -> {значение: множество id}; значения большинства здесь нет
+            self._sets = {name: {} for name in self.dimensions}
+
+    # Обновления от записей пользователей
+
+    def add(self, record):
+        self._change('add', record, tuple(self.dimensions))
+
+    def update(self, record, field):
+        """У записи изменилось поле field (одно из fields)"""
+        names = tuple(name for name, (fields, _, _) in self.dimensions.items() if field in fields)
+        self._change('update', record, names)
+
+    def remove(self, record):
+        self._change('remove', record, tuple(self.dimensions))
+
+    def _apply(self, operation, record, names):
+        user_id = record.id
+        if operation == 'update' and self.source().get(user_id) is not record:
+            return  # запись уже удалена или заменена другой
+        for name in names:
+            _, value_of, default = self.dimensions[name]
+            value = value_of(record) if operation != 'remove' else _MISSING
+            segments = self._sets[name]
+            for segment_value, members in segments.items():
+                if segment_value != value:
+                    members.discard(user_id)
+            if value is not _MISSING and value != default:
+                segments.setdefault(value, set()).add(user_id)
+
+    def _build(self, store):
+        records = list(store.items())
+        sets = {name: {} for name in self.dimensions}
+        for user_id, record in records:
+            for name, (_, value_of, default) in self.dimensions.items():
+                value = value_of(record)
+                if value != default:
+                    sets[name].setdefault(value, set()).add(user_id)
+        return len(records), sets
+
+    def _install(self, built):
+        self._sets = built[1]
+
+    def _describe(self, built):
+        return f"Сегменты аудитории построены: {built[0]} пользователей"
+
+    def values(self, name):
+        """Значения измерения, у которых есть пользователи (значение большинства - первым)"""
+        self._ensure_built()
+        with self.lock:
+            present = sorted(value for value, members in self._sets[name].items() if members)
+        return [self.dimensions[name][2], *present]
+
+    def _resolve(self, selection):
+        """Подходящие пользователи: (множество id или None, множество id, которые нужно вычесть).
+
+        None вместо первого множества означает «все пользователи»: так сегмент
+        значения большинства считается без обхода хранилища.
+        """
+        # Сегменты других индексов берутся до блокировки: построение окна может быть долгим
+        included = []
+        for name, value in selection.items():
+            if name == 'active':
+                included.append(window_ratings.members(value))
+            elif name == 'chat':
+                included.append(set(membership.members(value)))
+        excluded = []
+        with self.lock:
+            for name, value in selection.items():
+                if name not in self.dimensions:
+                    continue
+                segments = self._sets[name]
+                if value == self.dimensions[name][2]:
+                    excluded.extend(members for segment_value, members in segments.items() if segment_value != value)
+                else:
+                    included.append(segments.get(value, set()))
+            excluded = set().union(*excluded)
+            if not included:
+                return None, excluded
+            included.sort(key=len)
+            result = set(included[0])
+            result.intersection_update(*included[1:])
+        result -= excluded
+        return result, excluded
+
+    def count(self, selection):
+        """Число пользователей, подходящих под все условия selection: {измерение: значение}.
+
+        Измерения - из AUDIENCE_DIMENSIONS, а также 'active' (окно RATING_WINDOWS)
+        и 'chat' (id чата).
+        """
+        self._ensure_built()
+        result, excluded = self._resolve(selection)
+        if result is None:
+            return len(self.source()) - len(excluded)
+        return len(result)
+
+    def select(self, selection):
+        """id пользователей, подходящих под все условия selection (см. count)"""
+        self._ensure_built()
+        result, excluded = self._resolve(selection)
+        if result is None:
+            return [user_id for user_id in list(self.source().keys()) if user_id not in excluded]
+        return list(result)
+
+class ActiveUsers(LazyIndex):
+    """id пользователей, написавших хотя бы одно сообщение (messages_count > 0), для общей статистики"""
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+            self._ids = set()
+
+    # Обновления от записей пользователей
+
+    def add(self, record):
+        self._change(record)
+
+    def update(self, record):
+        """Изменилось поле messages_count"""
+        self._change(record)
+
+    def remove(self, record):
+        self._change(record)
+
+    def _apply(self, record):
+        current = self.source().get(record.id)
+        if current is None:
+            self._ids.discard(record.id)
+        elif current is not record:
+            return  # запись заменена другой: её учтёт добавление новой
+        elif (record.get('messages_count') or 0) > 0:
+            self._ids.add(record.id)
+        else:
+            self._ids.discard(record.id)
+
+    def _build(self, store):
+        return {user_id for user_id, record in list(store.items()) if (record.get('messages_count') or 0) > 0}
+
+    def _install(self, ids):
+        self._ids = ids
+
+    def _describe(self, ids):
+        return f"Активные пользователи подсчитаны: {len(ids)}"
+
+    def __len__(self):
+        self._ensure_built()
+        return len(self._ids)
+
+class ChannelUsers(LazyIndex):
+    """Обратный индекс каналов из списков пользователей: канал -> id пользователей.
+
+    Наборы хранятся так же, как в MembershipIndex (кортежи для небольших, иначе
+    множества). Для каждого пользователя запоминается, с какими каналами он
+    учтён: так изменение поля channels снимается с индекса без старого значения,
+    даже если список изменили на месте.
+    """
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+            self._users = {}
+            self._channels = {}
+
+    # Обновления от записей пользователей
+
+    def add(self, record):
+        self._change(record)
+
+    def update(self, record):
+        """Поле channels записи заменено"""
+        self._change(record)
+
+    def remove(self, record):
+        self._change(record)
+
+    def _apply(self, record):
+        user_id = record.id
+        current = self.source().get(user_id)
+        if current is not None and current is not record:
+            return  # запись заменена другой: её учтёт добавление новой
+        channel_ids = set(record.get('channels') or ()) if current is not None else set()
+        indexed = set(self._channels.get(user_id, ()))
+        for channel_id in indexed - channel_ids:
+            _bucket_discard(self._users, channel_id, user_id)
+        for channel_id in channel_ids - indexed:
+            _bucket_add(self._users, channel_id, user_id)
+        if channel_ids:
+            self._channels[user_id] = tuple(channel_ids)
+        else:
+            self._channels.pop(user_id, None)
+
+    def _build(self, store):
+        channels_of = {user_id: tuple(set(record.get('channels') or ()))
+                       for user_id, record in list(store.items()) if record.get('channels')}
+        user_ids = {}
+        for user_id, channel_ids in channels_of.items():
+            for channel_id in channel_ids:
+                _bucket_add(user_ids, channel_id, user_id)
+        return channels_of, user_ids
+
+    def _install(self, built):
+        self._channels, self._users = built
+
+    def _describe(self, built):
+        return f"Индекс подписок на каналы построен: {len(built[0])} пользователей, {len(built[1])} каналов"
+
+    def users_of(self, channel_id):
+        """Список id пользователей, у которых канал есть в списке channels"""
+        self._ensure_built()
+        with self.lock:
+            return list(self._users.get(channel_id, ()))
+
+leaderboard = RecordOrder(lambda: users, calculate_rating, UserRecord.RATING_FIELDS)
+window_ratings = WindowRatings(lambda: users)
+active_users = ActiveUsers(lambda: users)
+channel_users = ChannelUsers(lambda: users)
+audience_segments = AudienceSegments(lambda: users)
+search_index = SearchIndex(lambda: users, ('username', 'first_name', 'last_name'), ('first_name', 'last_name', 'username'))
+channel_search_index = SearchIndex(lambda: channels, ('username', 'title'), ('title', 'username'))
+list_pages = ListPageCache()
+
+# Порядки списков администратора: {список: {порядок: объект с page, len и version}}.
+# Кроме рейтинга, они строятся при первом открытии списка в этом порядке.
+list_orders = {
+    'users': {
+        'rating': leaderboard,
+        'joined': RecordOrder(lambda: users, time_order_score('joined_at'), {'joined_at'}, name='новые пользователи'),
+        'activity': WindowRatingOrder(window_ratings, LIST_ACTIVITY_WINDOW),
+        'name': RecordOrder(lambda: users, name_order_score('first_name', 'last_name'), {'first_name', 'last_name'},
+                            descending=False, name='пользователи по имени'),
+    },
+    'chats': {
+        'created': RecordOrder(lambda: chats, time_order_score('created_at'), {'created_at'}, name='новые чаты'),
+        'messages': RecordOrder(lambda: chats, lambda chat: chat.get('messages_count') or 0, {'messages_count'},
+                                name='чаты по сообщениям'),
+        'title': RecordOrder(lambda: chats, name_order_score('title'), {'title'}, descending=False, name='чаты по названию'),
+    },
+    'channels': {
+        'created': RecordOrder(lambda: channels, time_order_score('created_at'), {'created_at'}, name='новые каналы'),
+        'posts': RecordOrder(lambda: channels, lambda channel: channel.get('posts_count') or 0, {'posts_count'},
+                             name='каналы по публикациям'),
+        'title': RecordOrder(lambda: channels, name_order_score('title'), {'title'}, descending=False,
+                             name='каналы по названию'),
+    },
+}
+for record_type in RECORD_TYPES.values():
+    record_type.ORDERS = tuple(order for order in list_orders[record_type.STORE_NAME].values() if isinstance(order, RecordOrder))
+
 def get_top_users(n=10):
-    sorted_users = sorted(users.values(), key=lambda x: calculate_rating(x), reverse=True)
-    return sorted_users[:n]
+    return leaderboard.top(n)
+
+class DeliveryHealth:
+    """Состояние доставки сообщений получателям: когда дошло в последний раз и почему не доходит.
+
+    _last_success: id -> время последней успешной отправки (секунды).
+    _failures: id -> [состояние, ошибок подряд, время последней ошибки]; состояние -
+    'blocked' (403: бот заблокирован или удалён из чата), 'not_found' (чат не
+    найден или аккаунт удалён) или 'failing' (прочие ошибки Bot API).
+    Недоступны получатели в состояниях blocked и not_found, а в состоянии
+    failing - после DELIVERY_MAX_FAILURES ошибок подряд. Проверка - поиск в
+    словаре, поэтому отбор получателей рассылки не дороже обхода их списка.
+    Снимок пишется в DELIVERY_FILE отложенно (delivery_store).
+    """
+
+    def __init__(self, path=DELIVERY_FILE):
+        self.path = path
+        self._last_success = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать состояние доставки {self.path}: {e}")
+            return
+        with self._lock:
+            self._last_success = {sys.intern(key): value for key, value in data.get('success', {}).items()}
+            self._failures = {sys.intern(key): value for key, value in data.get('failures', {}).items()}
+        logger.info(f"Состояние доставки загружено: недоступных получателей {self.unreachable_count()}")
+
+    def save(self):
+        with self._lock:
+            data = {'success': dict(self._last_success), 'failures': {key: list(value) for key, value in self._failures.items()}}
+        try:
+            atomic_write(self.path, lambda f: json.dump(data, f, separators=(',', ':')))
+            return True
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении состояния доставки: {e}")
+            return False
+
+    @staticmethod
+    def classify(error):
+        """Состояние получателя по ошибке Bot API"""
+        if getattr(error, 'error_code', None) == 403:
+            return 'blocked'
+        description = str(getattr(error, 'description', None) or error).lower()
+        if any(text in description for text in DELIVERY_NOT_FOUND_ERRORS):
+            return 'not_found'
+        return 'failing'
+
+    def record_success(self, recipient_id):
+        recipient_id = str(recipient_id)
+        with self._lock:
+            self._last_success[recipient_id] = int(time.time())
+            self._failures.pop(recipient_id, None)
+        delivery_store.mark_dirty()
+
+    def record_failure(self, recipient_id, error):
+        """Учитывает ошибку отправки; возвращает новое состояние получателя"""
+        recipient_id = str(recipient_id)
+        state = self.classify(error)
+        with self._lock:
+            failure = self._failures.get(recipient_id)
+            count = failure[1] + 1 if failure is not None else 1
+            self._failures[recipient_id] = [state, count, int(time.time())]
+        delivery_store.mark_dirty()
+        return state
+
+    def mark_reachable(self, chat_id):
+        """Из чата пришло сообщение: бот в нём снова доступен"""
+        if chat_id in self._failures:
+            with self._lock:
+                self._failures.pop(chat_id, None)
+            delivery_store.mark_dirty()
+
+    def is_reachable(self, recipient_id):
+        failure = self._failures.get(recipient_id)
+        return failure is None or (failure[0] == 'failing' and failure[1] < DELIVERY_MAX_FAILURES)
+
+    def status(self, recipient_id):
+        """(состояние или None, ошибок подряд, время последней успешной отправки или None)"""
+        recipient_id = str(recipient_id)
+        with self._lock:
+            failure = self._failures.get(recipient_id)
+            last_success = self._last_success.get(recipient_id)
+        if failure is None:
+            return None, 0, last_success
+        return failure[0], failure[1], last_success
+
+    def unreachable_count(self):
+        with self._lock:
+            failures = list(self._failures)
+        return sum(1 for recipient_id in failures if not self.is_reachable(recipient_id))
+
+    def stale_unreachable(self, older_than=DELIVERY_REPROBE_AFTER):
+        """Недоступные получатели, последняя ошибка которых была больше older_than секунд назад"""
+        border = time.time() - older_than
+        with self._lock:
+            failures = list(self._failures.items())
+        return [recipient_id for recipient_id, failure in failures
+                if failure[2] <= border and not self.is_reachable(recipient_id)]
+
+delivery_health = DeliveryHealth()
+delivery_store = WriteBehindStore(delivery_health.save, interval=DELIVERY_SAVE_INTERVAL,
+                                  dirty_threshold=DELIVERY_SAVE_THRESHOLD)
 
 def safe_send_message(chat_id, text, reply_markup=None, parse_mode=None):
     try:
-        return bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        message = bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        delivery_health.record_success(chat_id)
+        return message
     except telebot.apihelper.ApiException as e:
+        if isinstance(e, telebot.apihelper.ApiTelegramException) and retry_after_seconds(e) is None:
+            delivery_health.record_failure(chat_id, e)
         if e.result.status_code == 403:
             logger.warning(f"Бот заблокирован пользователем {chat_id}")
         elif e.result.status_code == 400:
@@ -150,12 +3840,14 @@ def scan_chat_members(chat_id):
         
         # Получаем актуальный список участников через администратора чата
         members = []
+        member_set = set()
         for admin in admins:
             if admin.can_invite_users:  # Ищем админа с правами просмотра участников
                 try:
                     for member in bot.get_chat_members(chat_id):
                         member_id = str(member.user.id)
-                        if member_id not in members:
+                        if member_id not in member_set:
+                            member_set.add(member_id)
                             members.append(member_id)
                             
                             # Добавляем пользователя в базу данных
@@ -172,15 +3864,19 @@ def scan_chat_members(chat_id):
                                     'channels': [],
                                     'language': 'ru'
                                 }
-                            elif chat_id not in users[member_id]['chats']:
-                                users[member_id]['chats'].append(chat_id)
+                                save_user(member_id)
                 except Exception as e:
                     logger.error(f"Ошибка при получении участников через админа: {e}")
                 break
         
-        # Обновляем список участников в чате
-        chats[chat_id]['members'] = members
-        save_data()
+        # Обновляем список участников в чате: изменения пишутся в журнал как входы и выходы
+        for member_id in tuple(membership.members(chat_id)):
+            if member_id not in member_set:
+                remove_chat_member(chat_id, member_id)
+        for member_id in members:
+            if not membership.contains(chat_id, member_id):
+                add_chat_member(chat_id, member_id)
+        save_chat(chat_id)
         
         return len(members)
     except Exception as e:
@@ -192,6 +3888,7 @@ def handle_start(message):
     user_id = str(message.from_user.id)
     if is_user_blocked(user_id):
         return
+    delivery_health.mark_reachable(str(message.chat.id))
 
     if user_id not in users:
         users[user_id] = {
@@ -212,7 +3909,7 @@ def handle_start(message):
             'last_name': message.from_user.last_name,
             'username': message.from_user.username,
         })
-    save_data()
+    save_user(user_id)
     
     welcome_text = get_localized_text('welcome_message', user_id).format(name=message.from_user.first_name)
 
@@ -255,6 +3952,15 @@ def get_localized_text(key, user_id):
             'notifications_off': "Выключены",
             'user_stats': f"{EMOJI['stats']} Ваша статистика:",
             'rating_info': f"{EMOJI['trophy']} Топ-10 пользователей по рейтингу:",
+            'rating_place': "Место в рейтинге: {rank} из {total}",
+            'rating_day': "За сутки",
+            'rating_week': "За неделю",
+            'rating_month': "За месяц",
+            'rating_all': "За всё время",
+            'rating_info_day': f"{EMOJI['trophy']} Самые активные за последние 24 часа:",
+            'rating_info_week': f"{EMOJI['trophy']} Самые активные за последние 7 дней:",
+            'rating_info_month': f"{EMOJI['trophy']} Самые активные за последние 30 дней:",
+            'rating_empty': "Пока никого нет.",
             'feedback_request': f"{EMOJI['edit']} Пожалуйста, напишите ваш отзыв или сообщение:",
             'feedback_sent': f"{EMOJI['success']} Спасибо за ваш отзыв! Он был отправлен администратору.",
             'feedback_error': f"{EMOJI['error']} Произошла ошибка при отправке отзыва. Попробуйте позже.",
@@ -289,6 +3995,15 @@ def get_localized_text(key, user_id):
             'notifications_off': "Disabled",
             'user_stats': f"{EMOJI['stats']} Your statistics:",
             'rating_info': f"{EMOJI['trophy']} Top 10 users by rating:",
+            'rating_place': "Rating place: {rank} of {total}",
+            'rating_day': "Day",
+            'rating_week': "Week",
+            'rating_month': "Month",
+            'rating_all': "All time",
+            'rating_info_day': f"{EMOJI['trophy']} Most active in the last 24 hours:",
+            'rating_info_week': f"{EMOJI['trophy']} Most active in the last 7 days:",
+            'rating_info_month': f"{EMOJI['trophy']} Most active in the last 30 days:",
+            'rating_empty': "Nobody yet.",
             'feedback_request': f"{EMOJI['edit']} Please write your feedback or message:",
             'feedback_sent': f"{EMOJI['success']} Thank you for your feedback! It has been sent to the administrator.",
             'feedback_error': f"{EMOJI['error']} An error occurred while sending feedback. Please try again later.",
@@ -384,7 +4099,7 @@ def handle_notifications_settings(call):
     current_status = user.get('notifications', True)
     new_status = not current_status
     user['notifications'] = new_status
-    save_data()
+    save_user(user_id)
     
     status_text = get_localized_text('notifications_on', user_id) if new_status else get_localized_text('notifications_off', user_id)
     bot.answer_callback_query(call.id, f"{EMOJI['success']} {get_localized_text('notifications', user_id)}: {status_text}")
@@ -462,7 +4177,10 @@ def change_username_step(message, entity_type, entity_id):
         else:
             bot.reply_to(message, f"{EMOJI['error']} Чат не найден")
     
-    save_data()
+    if entity_type == 'channel':
+        save_channel(entity_id)
+    elif entity_id in chats:
+        save_chat(entity_id)
 
     try:
         fake_call = types.CallbackQuery(
@@ -507,7 +4225,7 @@ def change_name_step(message):
         return
     
     users[user_id]['first_name'] = new_name
-    save_data()
+    save_user(user_id)
     
     bot.reply_to(message, get_localized_text('name_changed', user_id).format(name=new_name))
     logger.info(f"Пользователь {user_id} изменил свое имя на {new_name}")
@@ -538,7 +4256,7 @@ def handle_set_language(call):
     language = call.data.split(":")[1]
     
     users[user_id]['language'] = language
-    save_data()
+    save_user(user_id)
     
     bot.answer_callback_query(call.id, get_localized_text('language_changed', user_id))
     logger.info(f"Пользователь {user_id} изменил язык на {language}")
@@ -555,6 +4273,7 @@ def handle_super_admin(message):
         types.InlineKeyboardButton(f"{EMOJI['chats']} Чаты", callback_data="manage_chats"),
         types.InlineKeyboardButton(f"{EMOJI['channels']} Каналы", callback_data="manage_channels"),
         types.InlineKeyboardButton(f"{EMOJI['rocket']} Рассылка", callback_data="send_broadcast"),
+        types.InlineKeyboardButton("⏰ Расписание", callback_data="schedule"),
         types.InlineKeyboardButton(f"{EMOJI['settings']} Настройки бота", callback_data="bot_settings")
     )
     
@@ -574,13 +4293,15 @@ def handle_overall_stats(call):
     total_users = len(users)
     total_chats = len(chats)
     total_channels = len(channels)
-    active_users = sum(1 for user in users.values() if user.get('messages_count', 0) > 0)
+    active_count = len(active_users)
+    active_month = window_ratings.count('month')
     
-    top_users = sorted(users.values(), key=lambda x: calculate_rating(x), reverse=True)[:5]
+    top_users = get_top_users(5)
     
     text = f"{EMOJI['stats']} Общая статистика:\n\n"
     text += f"Всего пользователей: {total_users}\n"
-    text += f"Активных пользователей: {active_users}\n"
+    text += f"Активных пользователей: {active_count}\n"
+    text += f"Активных за 30 дней: {active_month}\n"
     text += f"Всего чатов: {total_chats}\n"
     text += f"Всего каналов: {total_channels}\n\n"
     text += f"Топ-5 пользователей по рейтингу:\n"
@@ -633,6 +4354,7 @@ def show_super_admin_menu(chat_id):
         types.InlineKeyboardButton(f"{EMOJI['chats']} Чаты", callback_data="manage_chats"),
         types.InlineKeyboardButton(f"{EMOJI['channels']} Каналы", callback_data="manage_channels"),
         types.InlineKeyboardButton(f"{EMOJI['rocket']} Рассылка", callback_data="send_broadcast"),
+        types.InlineKeyboardButton("⏰ Расписание", callback_data="schedule"),
         types.InlineKeyboardButton(f"{EMOJI['settings']} Настройки бота", callback_data="bot_settings")
     )
     
@@ -652,105 +4374,118 @@ def callback_super_admin(call):
     show_super_admin_menu(call.message.chat.id)
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "list_users")
-@super_admin_required
-def handle_list_users(call):
-    page = 0
-    users_per_page = 10
-    total_users = len(users)
-    total_pages = (total_users - 1) // users_per_page + 1
-
-    def get_user_list_markup(page):
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        start = page * users_per_page
-        end = min(start + users_per_page, total_users)
-        for user in list(users.values())[start:end]:
-            user_info = f"{user['first_name']} {user['last_name'] or ''} (@{user['username'] or 'нет username'})"
-            markup.add(types.InlineKeyboardButton(user_info, callback_data=f"user:{user['id']}"))
-        
-        nav_markup = types.InlineKeyboardMarkup(row_width=3)
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"user_list_page:{page-1}"))
-        nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="ignore"))
-        if page < total_pages - 1:
-            nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"user_list_page:{page+1}"))
-        nav_markup.add(*nav_buttons)
-        
-        markup.add(*nav_markup.keyboard[0])
-        markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="manage_users"))
-        return markup
+# Списки администратора: заголовок, подписи и порядки (ключи list_orders) с кнопками выбора
+LIST_VIEWS = {
+    'users': {
+        'title': f"{EMOJI['users']} Список пользователей",
+        'total': "Всего пользователей",
+        'hint': "Нажмите на пользователя для подробной информации",
+        'back': 'manage_users',
+        'orders': (('rating', "⭐ Рейтинг"), ('joined', "🆕 Новые"), ('activity', "🔥 Активные"), ('name', "🔤 Имя")),
+    },
+    'chats': {
+        'title': f"{EMOJI['chats']} Список чатов",
+        'total': "Всего чатов",
+        'hint': "Нажмите на чат для подробной информации",
+        'back': 'manage_chats',
+        'orders': (('created', "🆕 Новые"), ('messages', "💬 Сообщения"), ('title', "🔤 Название")),
+    },
+    'channels': {
+        'title': f"{EMOJI['channels']} Список каналов",
+        'total': "Всего каналов",
+        'hint': "Нажмите на канал для подробной информации",
+        'back': 'manage_channels',
+        'orders': (('created', "🆕 Новые"), ('posts', "📢 Публикации"), ('title', "🔤 Название")),
+    },
+}
 
-    text = f"{EMOJI['users']} Список пользователей (страница {page+1}/{total_pages}):\n\n"
-    text += f"{EMOJI['info']} Всего пользователей: {total_users}\n"
-    text += f"{EMOJI['info']} Нажмите на пользователя для подробной информации"
-    
-    bot.edit_message_text(chat_id=call.message.chat.id, 
-                          message_id=call.message.message_id, 
-                          text=text, 
-                          reply_markup=get_user_list_markup(page))
-    logger.info(f"Суперадминистратор {call.from_user.id} просмотрел список пользователей")
+list_sort_choices = {}  # (id администратора, список) -> выбранный порядок (для возврата к списку)
+
+def list_entry_button(store_name, record):
+    if store_name == 'users':
+        user_info = f"{record['first_name']} {record['last_name'] or ''} (@{record['username'] or 'нет username'})"
+        return types.InlineKeyboardButton(user_info, callback_data=f"user:{record['id']}")
+    if store_name == 'chats':
+        return types.InlineKeyboardButton(f"{record['title']} ({record['id']})", callback_data=f"chat_info:{record['id']}")
+    return types.InlineKeyboardButton(f"{record['title']} (@{record['username']})", callback_data=f"channel_info:{record['id']}")
+
+def get_list_page(store_name, order_name, page):
+    """Текст и разметка страницы списка администратора.
+
+    Страница берётся из упорядоченного индекса за O(log n + размер страницы), а
+    готовый результат кэшируется (list_pages) до изменения показанных записей.
+    """
+    view = LIST_VIEWS[store_name]
+    order = list_orders[store_name][order_name]
+    len(order)  # строит порядок до того, как взять версии: иначе построение сразу устарило бы страницу
+    version = (order.version, list_pages.version(store_name))
+    key = (store_name, order_name, page)
+    cached = list_pages.get(key, version)
+    if cached is not None:
+        return cached
+
+    total = len(_live_data()[store_name])
+    ordered_total = len(order)
+    total_pages = max((ordered_total - 1) // LIST_PAGE_SIZE + 1, 1)
+    page = min(max(page, 0), total_pages - 1)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("user_list_page:"))
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.row(*[
+        types.InlineKeyboardButton(f"• {label}" if name == order_name else label, callback_data=f"list_page:{store_name}:{name}:0")
+        for name, label in view['orders']
+    ])
+    for record in order.page(page * LIST_PAGE_SIZE, LIST_PAGE_SIZE):
+        markup.add(list_entry_button(store_name, record))
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"list_page:{store_name}:{order_name}:{page-1}"))
+    nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="ignore"))
+    if page < total_pages - 1:
+        nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"list_page:{store_name}:{order_name}:{page+1}"))
+    markup.row(*nav_buttons)
+    markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data=view['back']))
+
+    order_label = dict(view['orders'])[order_name]
+    text = f"{view['title']} (страница {page+1}/{total_pages}):\n\n"
+    text += f"{EMOJI['info']} {view['total']}: {total}\n"
+    # В порядок «Активные» попадают не все: только те, у кого была активность за окно
+    text += f"{EMOJI['info']} Порядок: {order_label}" + (f" ({ordered_total})" if ordered_total != total else "") + "\n"
+    text += f"{EMOJI['info']} {view['hint']}"
+
+    result = (text, markup)
+    list_pages.put(key, version, result)
+    return result
+
+@bot.callback_query_handler(func=lambda call: call.data in ("list_users", "list_chats", "list_channels")
+                            or call.data.startswith("list_page:"))
 @super_admin_required
-def handle_user_list_page(call):
-    try:
-        page = int(call.data.split(':')[1])
-        users_per_page = 10
-        total_users = len(users)
-        total_pages = (total_users - 1) // users_per_page + 1
-
-        def get_user_list_markup(page):
-            markup = types.InlineKeyboardMarkup(row_width=1)
-            start = page * users_per_page
-            end = min(start + users_per_page, total_users)
-            
-            # Получаем список пользователей для текущей страницы
-            current_users = list(users.values())[start:end]
-            
-            for user in current_users:
-                user_info = f"{user['first_name']} {user['last_name'] or ''} (@{user['username'] or 'нет username'})"
-                markup.add(types.InlineKeyboardButton(user_info, callback_data=f"user:{user['id']}"))
-            
-            # Добавляем кнопки навигации
-            nav_buttons = []
-            if page > 0:
-                nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"user_list_page:{page-1}"))
-            nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="ignore"))
-            if page < total_pages - 1:
-                nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"user_list_page:{page+1}"))
-            
-            markup.add(*nav_buttons)
-            markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="manage_users"))
-            return markup
-
-        text = f"{EMOJI['users']} Список пользователей (страница {page+1}/{total_pages}):\n\n"
-        text += f"{EMOJI['info']} Всего пользователей: {total_users}\n"
-        text += f"{EMOJI['info']} Нажмите на пользователя для подробной информации"
-
-        try:
-            # Пробуем отредактировать сообщение
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=text,
-                reply_markup=get_user_list_markup(page)
-            )
-        except telebot.apihelper.ApiTelegramException as e:
-            if "message is not modified" in str(e):
-                # Если сообщение не изменилось, просто игнорируем ошибку
-                pass
-            else:
-                raise
+def handle_list_page(call):
+    admin_id = str(call.from_user.id)
+    if call.data.startswith("list_page:"):
+        _, store_name, order_name, page = call.data.split(':')
+        page = int(page)
+        list_sort_choices[(admin_id, store_name)] = order_name
+    else:
+        # Открытие списка из меню или возврат к нему: порядок, выбранный администратором последним
+        store_name = call.data[len("list_"):]
+        order_name = list_sort_choices.get((admin_id, store_name), LIST_VIEWS[store_name]['orders'][0][0])
+        page = 0
+    if order_name not in list_orders.get(store_name, {}):
+        bot.answer_callback_query(call.id, f"{EMOJI['error']} Неизвестный список.")
+        return
 
-        bot.answer_callback_query(call.id)
-        
-    except Exception as e:
-        logger.error(f"Ошибка при переключении страницы: {e}")
-        bot.answer_callback_query(
-            call.id,
-            f"{EMOJI['error']} Ошибка при переключении страницы"
-        )
+    text, markup = get_list_page(store_name, order_name, page)
+    try:
+        bot.edit_message_text(chat_id=call.message.chat.id,
+                              message_id=call.message.message_id,
+                              text=text,
+                              reply_markup=markup)
+    except telebot.apihelper.ApiTelegramException as e:
+        # Повторное нажатие на уже выбранный порядок не меняет сообщение
+        if "message is not modified" not in str(e):
+            raise
+    bot.answer_callback_query(call.id)
+    logger.info(f"Суперадминистратор {call.from_user.id} просмотрел список {store_name} (порядок {order_name}, страница {page+1})")
 
 @bot.callback_query_handler(func=lambda call: call.data == "search_user")
 @super_admin_required
@@ -760,28 +4495,58 @@ def handle_search_user(call):
     bot.register_next_step_handler(msg, search_user_step)
     logger.info(f"Суперадминистратор {call.from_user.id} начал поиск пользователя")
 
+user_searches = {}  # id администратора -> последний поисковый запрос (для листания результатов)
+
 def search_user_step(message):
-    search_query = message.text.lower()
-    found_users = []
-    for user_id, user in users.items():
-        if (search_query in (user['username'] or '').lower() or 
-            search_query in (user['first_name'] or '').lower() or 
-            search_query in (user['last_name'] or '').lower() or
-            search_query == user['id']):
-            found_users.append(user)
-    
-    if not found_users:
+    search_query = (message.text or '').strip()
+    text, markup = get_search_results(search_query, 0)
+    if markup is None:
         bot.reply_to(message, f"{EMOJI['error']} Пользователи не найдены.")
         return
+    user_searches[str(message.from_user.id)] = search_query
+
+    bot.send_message(message.chat.id, text, reply_markup=markup)
+    logger.info(f"Суперадминистратор {message.from_user.id} выполнил поиск пользователей")
+
+def get_search_results(search_query, page):
+    """Текст и разметка страницы результатов поиска; (None, None), если ничего не найдено"""
+    found_users, total = query_search_users(search_query, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE)
+    if not total:
+        return None, None
+    total_pages = (total - 1) // SEARCH_PAGE_SIZE + 1
 
     markup = types.InlineKeyboardMarkup(row_width=1)
-    for user in found_users[:10]:  # Ограничиваем результаты поиска до 10
+    for user in found_users:
         user_info = f"{user['first_name']} {user['last_name'] or ''} (@{user['username'] or 'нет username'})"
         markup.add(types.InlineKeyboardButton(user_info, callback_data=f"user:{user['id']}"))
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"search_page:{page-1}"))
+    nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="ignore"))
+    if page < total_pages - 1:
+        nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"search_page:{page+1}"))
+    markup.add(*nav_buttons)
     markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="manage_users"))
 
-    bot.send_message(message.chat.id, f"{EMOJI['success']} Найденные пользователи:", reply_markup=markup)
-    logger.info(f"Суперадминистратор {message.from_user.id} выполнил поиск пользователей")
+    text = f"{EMOJI['success']} Найденные пользователи (по рейтингу): {total}"
+    return text, markup
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("search_page:"))
+@super_admin_required
+def handle_search_page(call):
+    search_query = user_searches.get(str(call.from_user.id))
+    if search_query is None:
+        bot.answer_callback_query(call.id, f"{EMOJI['error']} Поиск устарел, выполните его заново.")
+        return
+    text, markup = get_search_results(search_query, int(call.data.split(':')[1]))
+    if markup is None:
+        bot.answer_callback_query(call.id, f"{EMOJI['error']} Пользователи не найдены.")
+        return
+    bot.edit_message_text(chat_id=call.message.chat.id,
+                          message_id=call.message.message_id,
+                          text=text,
+                          reply_markup=markup)
+    bot.answer_callback_query(call.id)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("user:"))
 @super_admin_required
@@ -842,7 +4607,7 @@ def handle_toggle_block_user(call):
         user['blocked'] = False
         status = "разблокирован"
     
-    save_data()
+    save_user(user_id)
     bot.answer_callback_query(call.id, f"{EMOJI['success']} Пользователь успешно {status}.")
     
     handle_user_info(types.CallbackQuery(
@@ -873,16 +4638,11 @@ def process_edit_rating(message, user_id):
         if new_rating < 0:
             raise ValueError
         
-        user = users.get(user_id)
-        if not user:
+        old_rating = set_user_rating(user_id, new_rating)  # messages_count - основа рейтинга, реакции обнуляются
+        if old_rating is None:
             bot.reply_to(message, f"{EMOJI['error']} Пользователь не найден.")
             return
         
-        old_rating = calculate_rating(user)
-        user['messages_count'] = new_rating  # Используем messages_count как основу для рейтинга
-        user['reactions_received'] = 0  # Сбрасываем reactions_received
-        save_data()
-        
         bot.reply_to(message, f"{EMOJI['success']} Рейтинг пользователя успешно изменен с {old_rating} на {new_rating}")
         logger.info(f"Суперадминистратор {message.from_user.id} изменил рейтинг пользователя {user_id} с {old_rating} на {new_rating}")
     except ValueError:
@@ -958,6 +4718,7 @@ def handle_manage_chat(call):
             ("🔔 Уведомления", f"chat_notifications:{chat_id}"),
             ("ℹ️ Информация", f"chat_info_user:{chat_id}"),
             ("📊 Статистика", f"chat_stats_user:{chat_id}"),
+            ("🏆 Рейтинг чата", f"chat_rating:{chat_id}"),
             ("👋 Приветствие", f"welcome_settings:{chat_id}"),
             ("📝 Отправить сообщение", f"send_message:{chat_id}"),
             ("🔙 Назад", "my_chats")
@@ -1029,7 +4790,7 @@ def handle_set_welcome_template(call):
     
     if chat_id in chats:
         chats[chat_id]['welcome_message'] = templates[template_type]
-        save_data()
+        save_chat(chat_id)
         
         bot.answer_callback_query(
             call.id,
@@ -1060,7 +4821,7 @@ def handle_custom_welcome(call):
 def save_custom_welcome(message, chat_id):
     if chat_id in chats:
         chats[chat_id]['welcome_message'] = message.text
-        save_data()
+        save_chat(chat_id)
         
         bot.reply_to(
             message,
@@ -1206,7 +4967,11 @@ def handle_chat_stats_user(call):
             
         text = f"{EMOJI['stats']} Статистика чата:\n\n"
         text += f"Всего сообщений: {chat.get('messages_count', 0)}\n"
-        text += f"Участников: {len(chat.get('members', []))}\n"
+        text += f"Участников: {membership.member_count(chat_id)}\n"
+        member_messages = chat.get('member_messages')
+        if member_messages:
+            text += f"Писали в чат: {len(member_messages)}\n"
+            text += f"Ваших сообщений: {member_messages.get(str(call.from_user.id), 0)}\n"
         
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data=f"manage_chat:{chat_id}"))
@@ -1223,6 +4988,44 @@ def handle_chat_stats_user(call):
         logger.error(f"Ошибка при показе статистики чата: {e}")
         bot.answer_callback_query(call.id, "Произошла ошибка")
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("chat_rating:"))
+def handle_chat_rating(call):
+    """Самые активные участники чата"""
+    try:
+        chat_id = call.data.split(":")[1]
+        chat = chats.get(chat_id)
+        
+        if not chat:
+            bot.answer_callback_query(call.id, "Чат не найден")
+            return
+        
+        member_messages = chat.get('member_messages')
+        text = f"{EMOJI['trophy']} Самые активные участники чата {chat.get('title', chat_id)}:\n\n"
+        if not member_messages:
+            text += "Сообщений пока нет"
+        else:
+            for i, (member_id, count) in enumerate(member_messages.top(CHAT_TOP_SIZE), 1):
+                member = users.get(member_id)
+                name = f"{member['first_name']} {member['last_name'] or ''}".strip() if member else member_id
+                text += f"{i}. {name} - {count} сообщ.\n"
+            own_count = member_messages.get(str(call.from_user.id), 0)
+            text += f"\nВаших сообщений: {own_count}"
+        
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data=f"manage_chat:{chat_id}"))
+        
+        bot.edit_message_text(
+            text,
+            call.message.chat.id,
+            call.message.message_id,
+            reply_markup=markup
+        )
+        bot.answer_callback_query(call.id)
+        
+    except Exception as e:
+        logger.error(f"Ошибка при показе рейтинга чата: {e}")
+        bot.answer_callback_query(call.id, "Произошла ошибка")
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("chat_notifications:"))
 def handle_chat_notifications(call):
     """Управление уведомлениями чата"""
@@ -1235,7 +5038,7 @@ def handle_chat_notifications(call):
         
         current_status = users[user_id]['chat_notifications'].get(chat_id, True)
         users[user_id]['chat_notifications'][chat_id] = not current_status
-        save_data()
+        save_user(user_id)
         
         new_status = users[user_id]['chat_notifications'][chat_id]
         bot.answer_callback_query(
@@ -1257,45 +5060,6 @@ def handle_chat_notifications(call):
         logger.error(f"Ошибка при управлении уведомлениями: {e}")
         bot.answer_callback_query(call.id, "Произошла ошибка")
 
-@bot.callback_query_handler(func=lambda call: call.data == "list_chats")
-@super_admin_required
-def handle_list_chats(call):
-    page = 0
-    chats_per_page = 10
-    total_chats = len(chats)
-    total_pages = (total_chats - 1) // chats_per_page + 1
-
-    def get_chat_list_markup(page):
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        start = page * chats_per_page
-        end = min(start + chats_per_page, total_chats)
-        for chat in list(chats.values())[start:end]:
-            chat_info = f"{chat['title']} ({chat['id']})"
-            markup.add(types.InlineKeyboardButton(chat_info, callback_data=f"chat_info:{chat['id']}"))
-        
-        nav_markup = types.InlineKeyboardMarkup(row_width=3)
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"chat_list_page:{page-1}"))
-        nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="ignore"))
-        if page < total_pages - 1:
-            nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"chat_list_page:{page+1}"))
-        nav_markup.add(*nav_buttons)
-        
-        markup.add(*nav_markup.keyboard[0])
-        markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="manage_chats"))
-        return markup
-
-    text = f"{EMOJI['chats']} Список чатов (страница {page+1}/{total_pages}):\n\n"
-    text += f"{EMOJI['info']} Всего чатов: {total_chats}\n"
-    text += f"{EMOJI['info']} Нажмите на чат для подробной информации"
-    
-    bot.edit_message_text(chat_id=call.message.chat.id, 
-                          message_id=call.message.message_id, 
-                          text=text, 
-                          reply_markup=get_chat_list_markup(page))
-    logger.info(f"Суперадминистратор {call.from_user.id} просмотрел список чатов")
-
 @bot.callback_query_handler(func=lambda call: call.data.startswith("chat_info:"))
 @super_admin_required
 def handle_chat_info(call):
@@ -1322,7 +5086,7 @@ def handle_chat_info(call):
     chat_info += f"Название: {chat['title']}\n"
     chat_info += f"Описание: {chat.get('description', 'Не задано')}\n"
     chat_info += f"Владелец: {chat.get('owner_id', 'Не задан')}\n"
-    chat_info += f"Количество участников: {len(chat.get('members', []))}\n"
+    chat_info += f"Количество участников: {membership.member_count(chat_id)}\n"
     chat_info += f"Дата создания: {chat.get('created_at', 'Неизвестно')}\n"
     chat_info += f"Активность: {'Активен' if chat.get('is_active', True) else 'Неактивен'}\n\n"
     chat_info += f"{EMOJI['thinking']} Выберите действие:"
@@ -1348,12 +5112,10 @@ def handle_rename_chat(call):
             chat_id = str(chat_info.id)
             # Обновляем ID в базе данных
             if old_chat_id in chats:
-                chats[chat_id] = chats.pop(old_chat_id)
-                chats[chat_id]['id'] = chat_id
-                save_data()
+                rename_chat(old_chat_id, chat_id)
         
         # Проверяем права бота
-        bot_member = bot.get_chat_member(chat_id, bot.get_me().id)
+        bot_member = bot.get_chat_member(chat_id, get_bot_user().id)
         
         # Логируем информацию о правах для отладки
         logger.info(f"Права бота в чате {chat_id}:")
@@ -1399,7 +5161,7 @@ def rename_chat_step(message, chat_id):
             # Обновляем локальные данные
             if chat_id in chats:
                 chats[chat_id]['title'] = new_title
-                save_data()
+                save_chat(chat_id)
             
             bot.reply_to(
                 message,
@@ -1413,7 +5175,7 @@ def rename_chat_step(message, chat_id):
         if "not enough rights" in error_text:
             # Проверяем текущие права бота
             try:
-                bot_member = bot.get_chat_member(chat_id, bot.get_me().id)
+                bot_member = bot.get_chat_member(chat_id, get_bot_user().id)
                 rights_info = (
                     f"\n\nТекущие права бота:\n"
                     f"Статус: {bot_member.status}\n"
@@ -1488,10 +5250,10 @@ def handle_chat_members(call):
         bot.answer_callback_query(call.id, f"{EMOJI['error']} Чат не найден.")
         return
     
-    members = chat.get('members', [])
+    members = membership.members(chat_id)
     members_text = f"{EMOJI['users']} Участники чата {chat['title']}:\n\n"
     
-    for member_id in members[:10]:  # Показываем только первых 10 участников
+    for member_id in itertools.islice(members, 10):  # Показываем только первых 10 участников
         user = users.get(member_id, {})
         members_text += f"- {user.get('first_name', 'Unknown')} {user.get('last_name', '')} (@{user.get('username', 'N/A')})\n"
     
@@ -1515,7 +5277,7 @@ def handle_set_chat_description(call):
     
     try:
         # Проверяем права бота
-        bot_member = bot.get_chat_member(chat_id, bot.get_me().id)
+        bot_member = bot.get_chat_member(chat_id, get_bot_user().id)
         if not bot_member.can_change_info:
             bot.answer_callback_query(
                 call.id,
@@ -1548,7 +5310,7 @@ def set_chat_description_step(message, chat_id):
         # Обновляем локальные данные
         if chat_id in chats:
             chats[chat_id]['description'] = new_description
-            save_data()
+            save_chat(chat_id)
         
         bot.reply_to(message, f"{EMOJI['success']} Описание чата успешно изменено.")
         logger.info(f"Суперадминистратор {message.from_user.id} изменил описание чата {chat_id}")
@@ -1623,7 +5385,7 @@ def handle_channel_detailed_stats(call):
             stats_text += f"Привязанная группа: Есть\n"
         
         # Добавляем информацию о правах бота
-        bot_member = bot.get_chat_member(channel_id, bot.get_me().id)
+        bot_member = bot.get_chat_member(channel_id, get_bot_user().id)
         stats_text += f"\nПрава бота в канале:\n"
         stats_text += f"• Изменение информации: {'✅' if bot_member.can_change_info else '❌'}\n"
         stats_text += f"• Публикация сообщений: {'✅' if bot_member.can_post_messages else '❌'}\n"
@@ -1657,7 +5419,7 @@ def handle_channel_subscribers(call):
     
     try:
         # Проверяем права бота
-        bot_member = bot.get_chat_member(channel_id, bot.get_me().id)
+        bot_member = bot.get_chat_member(channel_id, get_bot_user().id)
         if not bot_member.can_invite_users:
             bot.answer_callback_query(
                 call.id,
@@ -1758,16 +5520,14 @@ def handle_block_channel_users(call):
     bot.register_next_step_handler(msg, process_block_channel_users, channel_id)
 
 def process_block_channel_users(message, channel_id):
-    usernames = [username.strip() for username in message.text.split(',')]
+    resolved, unresolved = resolve_usernames((message.text or '').split(','))
     blocked_count = 0
-    errors_count = 0
+    errors_count = len(unresolved)
     
-    for username in usernames:
+    for username, user_id in resolved.items():
         try:
-            # Получаем информацию о пользователе
-            user_info = bot.get_chat(username)
             # Блокируем пользователя
-            bot.ban_chat_member(channel_id, user_info.id)
+            bot.ban_chat_member(channel_id, user_id)
             blocked_count += 1
         except Exception as e:
             errors_count += 1
@@ -1825,13 +5585,14 @@ def handle_confirm_delete_channel(call):
         channel_info = channels[channel_id]
         
         # Удаляем канал из списков у всех пользователей
-        for user_id in users:
-            if 'channels' in users[user_id] and channel_id in users[user_id]['channels']:
-                users[user_id]['channels'].remove(channel_id)
+        for user_id in query_users_with_channel(channel_id):
+            user = users.get(user_id)
+            if user is not None:
+                set_entity_field('users', user_id, 'channels', [c for c in user.get('channels', []) if c != channel_id])
         
         # Удаляем канал из базы
         del channels[channel_id]
-        save_data()
+        save_channel(channel_id)
         
         # Отправляем подтверждение
         success_text = f"{EMOJI['success']} Канал {channel_info.get('title', 'Неизвестный')} успешно удален из базы данных."
@@ -1870,18 +5631,18 @@ def handle_channel_post(message):
                 'posts_count': 0,
                 'views_count': 0
             }
+            save_channel(channel_id)
         except Exception as e:
             logger.error(f"Ошибка при добавлении нового канала: {str(e)}")
             return
     
     # Обновляем статистику
-    channels[channel_id]['posts_count'] = channels[channel_id].get('posts_count', 0) + 1
-    save_data()
+    count_activity('channels', channel_id, 'posts_count')
 
 # Добавим функцию для проверки прав бота в канале
 def check_bot_channel_rights(channel_id):
     try:
-        bot_member = bot.get_chat_member(channel_id, bot.get_me().id)
+        bot_member = bot.get_chat_member(channel_id, get_bot_user().id)
         rights = {
             'can_change_info': bot_member.can_change_info,
             'can_post_messages': bot_member.can_post_messages,
@@ -1896,8 +5657,10 @@ def check_bot_channel_rights(channel_id):
         return None
 
 # Добавим функцию периодического обновления статистики каналов
-def update_channels_stats():
-    for channel_id in channels.keys():
+def update_channels_stats(progress=None):
+    """Обновляет сведения о каналах; progress(обработано, всего) вызывается после каждого канала"""
+    channel_ids = list(channels.keys())
+    for done, channel_id in enumerate(channel_ids, 1):
         try:
             chat_info = bot.get_chat(channel_id)
             member_count = bot.get_chat_member_count(channel_id)
@@ -1909,11 +5672,12 @@ def update_channels_stats():
                 'member_count': member_count,
                 'last_updated': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             })
+            save_channel(channel_id)
         except Exception as e:
             logger.error(f"Ошибка при обновлении статистики канала {channel_id}: {str(e)}")
-            continue
+        if progress is not None:
+            progress(done, len(channel_ids))
     
-    save_data()
     logger.info("Статистика каналов обновлена")
 
 # Добавим команду для ручного обновления статистики
@@ -1921,9 +5685,12 @@ def update_channels_stats():
 @super_admin_required
 def handle_update_stats(message):
     try:
-        bot.reply_to(message, f"{EMOJI['info']} Начинаю обновление статистики каналов...")
-        update_channels_stats()
-        bot.reply_to(message, f"{EMOJI['success']} Статистика каналов успешно обновлена!")
+        status_msg = bot.reply_to(message, f"{EMOJI['info']} Начинаю обновление статистики каналов...")
+        reporter = ProgressReporter(status_msg.chat.id, status_msg.message_id)
+        update_channels_stats(
+            lambda done, total: reporter.update(f"{EMOJI['info']} Обновление статистики каналов: {done} из {total}")
+        )
+        reporter.finish(f"{EMOJI['success']} Статистика каналов успешно обновлена!")
     except Exception as e:
         bot.reply_to(message, f"{EMOJI['error']} Ошибка при обновлении статистики: {str(e)}")
 
@@ -1947,49 +5714,42 @@ def handle_remove_by_username(call):
     bot.register_next_step_handler(msg, process_remove_by_username, chat_id)
 
 def process_remove_by_username(message, chat_id):
-    usernames = [username.strip() for username in message.text.split(',')]
+    # Все username ищутся разом: по индексу, а ненайденные - через API
+    resolved, unresolved = resolve_usernames((message.text or '').split(','))
     removed = 0
     
-    for username in usernames:
+    for username, user_id in resolved.items():
         try:
-            # Ищем пользователя в базе
-            user_id = None
-            for uid, user in users.items():
-                if user.get('username') == username.replace('@', ''):
-                    user_id = uid
-                    break
-                    
-            if user_id:
-                # Применяем тот же агрессивный метод
-                bot.restrict_chat_member(
-                    chat_id, 
-                    user_id,
-                    permissions=types.ChatPermissions(
-                        can_send_messages=False,
-                        can_send_media_messages=False,
-                        can_send_polls=False,
-                        can_send_other_messages=False,
-                        can_add_web_page_previews=False,
-                        can_invite_users=False
-                    ),
-                    until_date=int(time.time()) + 31536000
-                )
-                bot._MakeRequest('banChatMember', {
-                    'chat_id': chat_id,
-                    'user_id': user_id,
-                    'revoke_messages': True
-                })
-                
-                # Удаляем из базы
-                if user_id in chats[str(chat_id)]['members']:
-                    chats[str(chat_id)]['members'].remove(user_id)
-                removed += 1
-                
-        except Exception as e:
-            continue
+            # Применяем тот же агрессивный метод
+            bot.restrict_chat_member(
+                chat_id, 
+                user_id,
+                permissions=types.ChatPermissions(
+                    can_send_messages=False,
+                    can_send_media_messages=False,
+                    can_send_polls=False,
+                    can_send_other_messages=False,
+                    can_add_web_page_previews=False,
+                    can_invite_users=False
+                ),
+                until_date=int(time.time()) + 31536000
+            )
+            bot._MakeRequest('banChatMember', {
+                'chat_id': chat_id,
+                'user_id': user_id,
+                'revoke_messages': True
+            })
             
-    save_data()
-    bot.reply_to(message, f"✅ Удалено пользователей: {removed}")
+            # Удаляем из базы
+            remove_chat_member(chat_id, user_id)
+            removed += 1
+        except Exception as e:
+            logger.error(f"Не удалось удалить пользователя {username} из чата {chat_id}: {str(e)}")
+
+    report = f"✅ Удалено пользователей: {removed}"
+    if unresolved:
+        report += f"\nНе найдены: {', '.join(unresolved)}"
+    bot.reply_to(message, report)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("remove_all:"))
 @super_admin_required
@@ -2014,7 +5774,7 @@ def handle_remove_all(call):
 
         # Проверяем права бота
         try:
-            bot_member = bot.get_chat_member(chat_id, bot.get_me().id)
+            bot_member = bot.get_chat_member(chat_id, get_bot_user().id)
             if not bot_member.can_restrict_members:
                 raise Exception("У бота нет прав на ограничение участников")
         except Exception as e:
@@ -2032,14 +5792,11 @@ def handle_remove_all(call):
             raise Exception("Не удалось получить список администраторов")
 
         # Создаём сообщение о прогрессе
-        progress_msg = bot.edit_message_text(
-            f"{EMOJI['info']} Начинаю удаление участников...",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton("🛑 Отмена", callback_data=f"cancel_remove:{raw_chat_id}")
-            )
+        cancel_markup = types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton("🛑 Отмена", callback_data=f"cancel_remove:{raw_chat_id}")
         )
+        progress = ProgressReporter(call.message.chat.id, call.message.message_id)
+        progress.update(f"{EMOJI['info']} Начинаю удаление участников...", cancel_markup)
 
         # Получаем текущее количество участников
         try:
@@ -2089,31 +5846,24 @@ def handle_remove_all(call):
             logger.error(f"Ошибка при сборе участников: {e}")
 
         # Удаляем участников
+        bot_id = str(get_bot_user().id)
         for user_id in member_ids:
             try:
                 str_user_id = str(user_id)
-                if str_user_id not in admins and str_user_id != str(bot.get_me().id):
+                if str_user_id not in admins and str_user_id != bot_id:
                     bot.ban_chat_member(chat_id, user_id)
                     bot.unban_chat_member(chat_id, user_id)
                     removed += 1
 
-                    # Обновляем прогресс
-                    if removed % 5 == 0:
-                        try:
-                            bot.edit_message_text(
-                                f"{EMOJI['info']} Удаление участников...\n\n"
-                                f"Удалено: {removed}\n"
-                                f"Пропущено: {skipped}\n"
-                                f"Ошибок: {failed}\n"
-                                f"Прогресс: {min(100, int(removed * 100 / (member_count - skipped)))}%",
-                                progress_msg.chat.id,
-                                progress_msg.message_id,
-                                reply_markup=types.InlineKeyboardMarkup().add(
-                                    types.InlineKeyboardButton("🛑 Отмена", callback_data=f"cancel_remove:{raw_chat_id}")
-                                )
-                            )
-                        except Exception as e:
-                            logger.error(f"Ошибка обновления прогресса: {e}")
+                    # Обновляем прогресс (ProgressReporter сам решает, пора ли править сообщение)
+                    progress.update(
+                        f"{EMOJI['info']} Удаление участников...\n\n"
+                        f"Удалено: {removed}\n"
+                        f"Пропущено: {skipped}\n"
+                        f"Ошибок: {failed}\n"
+                        f"Прогресс: {min(100, int(removed * 100 / max(member_count - skipped, 1)))}%",
+                        cancel_markup
+                    )
 
             except Exception as e:
                 if "USER_NOT_FOUND" not in str(e) and "USER_ID_INVALID" not in str(e):
@@ -2129,16 +5879,11 @@ def handle_remove_all(call):
             f"Ошибок: {failed}"
         )
 
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data=f"chat_members:{raw_chat_id}"))
-        
-        bot.edit_message_text(
-            final_text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
-        )
-
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data=f"chat_members:{raw_chat_id}"))
+        
+        progress.finish(final_text, markup)
+
     except Exception as e:
         error_msg = f"Критическая ошибка при массовом удалении: {str(e)}"
         logger.error(error_msg)
@@ -2190,14 +5935,10 @@ def mass_remove_step(message, chat_id):
     removed_count = 0
     
     for user_id in user_ids:
-        if user_id in chats[chat_id]['members']:
-            chats[chat_id]['members'].remove(user_id)
-            if chat_id in users[user_id]['chats']:
-                users[user_id]['chats'].remove(chat_id)
+        if membership.contains(chat_id, user_id):
+            remove_chat_member(chat_id, user_id)
             removed_count += 1
     
-    save_data()
-    
     bot.reply_to(message, f"{EMOJI['success']} Удалено {removed_count} участников из чата.")
     
     fake_call = types.CallbackQuery(
@@ -2236,11 +5977,12 @@ def handle_edit_user_rating(call):
     bot.register_next_step_handler(msg, get_user_for_rating_edit)
 
 def get_user_for_rating_edit(message):
-    username = message.text.strip()
-    user_id = next((uid for uid, user in users.items() if user.get('username') == username), None)
-    if not user_id:
+    username = message.text.strip().lstrip('@')
+    user = search_index.lookup('username', [username]).get(username.lower())
+    if not user:
         bot.reply_to(message, f"{EMOJI['error']} Пользователь с таким ником не найден.")
         return
+    user_id = user.id
     msg = bot.reply_to(message, f"{EMOJI['edit']} Введите новое значение рейтинга:")
     bot.register_next_step_handler(msg, edit_user_rating, user_id)
 
@@ -2250,11 +5992,10 @@ def edit_user_rating(message, user_id):
         if new_rating < 0:
             raise ValueError
         
-        user = users.get(user_id)
-        old_rating = calculate_rating(user)
-        user['messages_count'] = new_rating
-        user['reactions_received'] = 0
-        save_data()
+        old_rating = set_user_rating(user_id, new_rating)
+        if old_rating is None:
+            bot.reply_to(message, f"{EMOJI['error']} Пользователь не найден.")
+            return
         
         bot.reply_to(message, f"{EMOJI['success']} Рейтинг пользователя успешно изменен с {old_rating} на {new_rating}")
         logger.info(f"Суперадминистратор {message.from_user.id} изменил рейтинг пользователя {user_id} с {old_rating} на {new_rating}")
@@ -2266,15 +6007,11 @@ def edit_user_rating_step(message):
         user_id, new_rating = message.text.split()
         new_rating = int(new_rating)
         
-        if user_id not in users:
+        old_rating = set_user_rating(user_id, new_rating)
+        if old_rating is None:
             bot.reply_to(message, f"{EMOJI['error']} Пользователь не найден.")
             return
         
-        old_rating = calculate_rating(users[user_id])
-        users[user_id]['messages_count'] = new_rating
-        users[user_id]['reactions_received'] = 0
-        save_data()
-        
         bot.reply_to(message, f"{EMOJI['success']} Рейтинг пользователя изменен с {old_rating} на {new_rating}")
         logger.info(f"Суперадминистратор {message.from_user.id} изменил рейтинг пользователя {user_id} с {old_rating} на {new_rating}")
     except ValueError:
@@ -2341,9 +6078,11 @@ def handle_message_user(call):
 def send_message_to_user(message, user_id):
     try:
         bot.send_message(user_id, f"{EMOJI['info']} Сообщение от администрации:\n\n{message.text}")
+        delivery_health.record_success(user_id)
         bot.reply_to(message, f"{EMOJI['success']} Сообщение успешно отправлено пользователю.")
         logger.info(f"Суперадминистратор {message.from_user.id} отправил сообщение пользователю {user_id}")
     except telebot.apihelper.ApiTelegramException as e:
+        delivery_health.record_failure(user_id, e)
         if e.error_code == 403:
             bot.reply_to(message, f"{EMOJI['error']} Пользователь заблокировал бота.")
         else:
@@ -2374,16 +6113,11 @@ def process_edit_rating(message, user_id):
         if new_rating < 0:
             raise ValueError
         
-        user = users.get(user_id)
-        if not user:
+        old_rating = set_user_rating(user_id, new_rating)
+        if old_rating is None:
             bot.reply_to(message, f"{EMOJI['error']} Пользователь не найден.")
             return
         
-        old_rating = calculate_rating(user)
-        user['messages_count'] = new_rating
-        user['reactions_received'] = 0
-        save_data()
-        
         bot.reply_to(message, f"{EMOJI['success']} Рейтинг пользователя успешно изменен с {old_rating} на {new_rating}")
         logger.info(f"Суперадминистратор {message.from_user.id} изменил рейтинг пользователя {user_id} с {old_rating} на {new_rating}")
     except ValueError:
@@ -2430,11 +6164,7 @@ def handle_search_channel(call):
     logger.info(f"Суперадминистратор {call.from_user.id} начал поиск канала")
 
 def search_channel_step(message):
-    search_query = message.text.lower()
-    found_channels = []
-    for channel_id, channel in channels.items():
-        if search_query in channel['title'].lower() or search_query in channel['username'].lower():
-            found_channels.append(channel)
+    found_channels = channel_search_index.search(message.text or '')
     
     if not found_channels:
         bot.reply_to(message, f"{EMOJI['error']} Каналы не найдены.")
@@ -2514,8 +6244,7 @@ def handle_confirm_delete_chat(call):
     chat_id = call.data.split(":")[1]
     
     if chat_id in chats:
-        del chats[chat_id]
-        save_data()
+        delete_chat(chat_id)
         bot.edit_message_text(
             f"{EMOJI['success']} Чат успешно удален.",
             call.message.chat.id,
@@ -2550,45 +6279,6 @@ def handle_manage_channels(call):
                           reply_markup=markup)
     logger.info(f"Суперадминистратор {call.from_user.id} открыл меню управления каналами")
 
-@bot.callback_query_handler(func=lambda call: call.data == "list_channels")
-@super_admin_required
-def handle_list_channels(call):
-    page = 0
-    channels_per_page = 10
-    total_channels = len(channels)
-    total_pages = (total_channels - 1) // channels_per_page + 1
-
-    def get_channel_list_markup(page):
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        start = page * channels_per_page
-        end = min(start + channels_per_page, total_channels)
-        for channel in list(channels.values())[start:end]:
-            channel_info = f"{channel['title']} (@{channel['username']})"
-            markup.add(types.InlineKeyboardButton(channel_info, callback_data=f"channel_info:{channel['id']}"))
-        
-        nav_markup = types.InlineKeyboardMarkup(row_width=3)
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"channel_list_page:{page-1}"))
-        nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="ignore"))
-        if page < total_pages - 1:
-            nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"channel_list_page:{page+1}"))
-        nav_markup.add(*nav_buttons)
-        
-        markup.add(*nav_markup.keyboard[0])
-        markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="manage_channels"))
-        return markup
-
-    text = f"{EMOJI['channels']} Список каналов (страница {page+1}/{total_pages}):\n\n"
-    text += f"{EMOJI['info']} Всего каналов: {total_channels}\n"
-    text += f"{EMOJI['info']} Нажмите на канал для подробной информации"
-    
-    bot.edit_message_text(chat_id=call.message.chat.id, 
-                          message_id=call.message.message_id, 
-                          text=text, 
-                          reply_markup=get_channel_list_markup(page))
-    logger.info(f"Суперадминистратор {call.from_user.id} просмотрел список каналов")
-
 @bot.callback_query_handler(func=lambda call: call.data == "bot_settings")
 @super_admin_required
 def handle_bot_settings(call):
@@ -2613,7 +6303,7 @@ def handle_bot_settings(call):
 @bot.callback_query_handler(func=lambda call: call.data == "bot_info")
 @super_admin_required
 def handle_bot_info(call):
-    bot_info = bot.get_me()
+    bot_info = get_bot_user()
     info_text = f"{EMOJI['robot']} Информация о боте:\n\n"
     info_text += f"ID: {bot_info.id}\n"
     info_text += f"Имя: {bot_info.first_name}\n"
@@ -2646,6 +6336,7 @@ def change_bot_name_step(message):
     
     try:
         bot.set_my_name(new_name)
+        get_bot_user(refresh=True)
         bot.reply_to(message, f"{EMOJI['success']} Имя бота успешно изменено на «{new_name}»")
         logger.info(f"Суперадминистратор {message.from_user.id} изменил имя бота на {new_name}")
     except telebot.apihelper.ApiException as e:
@@ -2758,16 +6449,36 @@ def handle_view_logs(call):
     markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="bot_settings"))
     bot.send_message(call.message.chat.id, "Выберите действие:", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "show_rating")
+@bot.callback_query_handler(func=lambda call: call.data == "show_rating" or call.data.startswith("show_rating:"))
 def handle_show_rating(call):
-    top_users = get_top_users(10)
-    rating_text = get_localized_text('rating_info', str(call.from_user.id)) + "\n\n"
-    for i, user in enumerate(top_users, 1):
-        rating = calculate_rating(user)
-        rating_text += f"{i}. {user['first_name']} {user['last_name'] or ''} - {rating} {get_localized_text('points', str(call.from_user.id))}\n"
+    user_id = str(call.from_user.id)
+    period = call.data.split(':', 1)[1] if ':' in call.data else 'all'
+    if period not in RATING_WINDOWS:
+        period = 'all'
+    if period == 'all':
+        top_users = [(user, calculate_rating(user)) for user in get_top_users(10)]
+        rating_text = get_localized_text('rating_info', user_id) + "\n\n"
+        rank, total = leaderboard.rank(user_id), len(leaderboard)
+    else:
+        top_users = window_ratings.top(period, 10)
+        rating_text = get_localized_text(f'rating_info_{period}', user_id) + "\n\n"
+        rank, total = window_ratings.rank(period, user_id), window_ratings.count(period)
+    for i, (user, rating) in enumerate(top_users, 1):
+        rating_text += f"{i}. {user['first_name']} {user['last_name'] or ''} - {rating} {get_localized_text('points', user_id)}\n"
+    if not top_users:
+        rating_text += get_localized_text('rating_empty', user_id) + "\n"
+    if rank:
+        rating_text += "\n" + get_localized_text('rating_place', user_id).format(rank=rank, total=total) + "\n"
     
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton(get_localized_text('back_to_menu', str(call.from_user.id)), callback_data="menu"))
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*[
+        types.InlineKeyboardButton(
+            ("• " if key == period else "") + get_localized_text(f'rating_{key}', user_id),
+            callback_data=f"show_rating:{key}"
+        )
+        for key in (*RATING_WINDOWS, 'all')
+    ])
+    markup.add(types.InlineKeyboardButton(get_localized_text('back_to_menu', user_id), callback_data="menu"))
     
     bot.edit_message_text(chat_id=call.message.chat.id, 
                           message_id=call.message.message_id, 
@@ -2787,6 +6498,7 @@ def handle_user_stats(call):
     stats_text += f"{get_localized_text('messages_count', user_id)}: {user.get('messages_count', 0)}\n"
     stats_text += f"{get_localized_text('reactions_received', user_id)}: {user.get('reactions_received', 0)}\n"
     stats_text += f"{get_localized_text('rating', user_id)}: {calculate_rating(user)}\n"
+    stats_text += get_localized_text('rating_place', user_id).format(rank=leaderboard.rank(user_id), total=len(leaderboard)) + "\n"
     stats_text += f"{get_localized_text('chats_count', user_id)}: {len(user.get('chats', []))}\n"
     stats_text += f"{get_localized_text('channels_count', user_id)}: {len(user.get('channels', []))}\n"
     
@@ -2798,6 +6510,714 @@ def handle_user_stats(call):
                           text=stats_text, 
                           reply_markup=markup)
 
+# Рассылка
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate разрешений в секунду, всплеск до capacity.
+
+    acquire ждёт, пока накопится разрешение, и забирает его под блокировкой,
+    поэтому несколько потоков вместе не превышают rate. После ответа 429
+    throttle приостанавливает выдачу на retry_after и снижает частоту в
+    BROADCAST_BACKOFF раз (не ниже min_rate); каждая успешная отправка (recover) понемногу
+    возвращает её к max_rate.
+    """
+
+    def __init__(self, rate, capacity=1, min_rate=1):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()  # до этого момента разрешения не копятся (пауза после 429)
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def acquire(self):
+        """Ждёт разрешения; возвращает время ожидания в секундах"""
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1 and self._updated <= now:
+                    self._tokens -= 1
+                    return waited
+                wait = max(self._updated - now, 0) + (1 - self._tokens) / self.rate
+            # Разрешение не резервируется заранее: пауза после 429, начавшаяся во время ожидания, тоже учитывается
+            time.sleep(wait)
+            waited += wait
+
+    def throttle(self, retry_after):
+        """Telegram ответил 429: пауза на retry_after секунд и снижение частоты"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            resume = now + retry_after
+            if resume <= self._updated:
+                return  # пауза уже назначена другим потоком по тому же всплеску
+            if self._updated <= now:
+                self.rate = max(self.min_rate, self.rate * BROADCAST_BACKOFF)
+            self._tokens = min(self._tokens, 0)
+            self._updated = resume
+
+    def recover(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * BROADCAST_RECOVERY)
+
+def retry_after_seconds(error):
+    """Пауза из ответа 429 Too Many Requests; None, если ошибка другая"""
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+class ProgressReporter:
+    """Сообщение о ходе долгой операции, которое правится не чаще раза в interval секунд.
+
+    update() можно вызывать на каждом шаге: правка уходит, только если с
+    предыдущей прошло interval секунд, а промежуточные состояния пропадают.
+    Состояние, совпадающее с уже показанным, не отправляется - Telegram ответил
+    бы «message is not modified». После ответа 429 правки откладываются на
+    указанное в нём время. finish() показывает итог всегда, дождавшись, если
+    нужно, окончания паузы 429; пауза пережидается без замка, поэтому update()
+    из других потоков её не ждёт. Пока правку отправляет другой поток, update()
+    своё состояние пропускает.
+    """
+
+    def __init__(self, chat_id, message_id, interval=PROGRESS_EDIT_INTERVAL):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self._shown = None  # (текст, разметка) в сообщении сейчас
+        self._next_edit = 0  # раньше этого момента (time.monotonic) промежуточные правки не отправляются
+        self._retry_at = 0  # до этого момента Telegram просил не отправлять запросы (429)
+        self._finishes = itertools.count(1)
+        self._last_finish = 0  # номер последнего вызова finish: более ранние, дождавшись паузы, не правят
+        self._lock = threading.Lock()
+
+    def update(self, text, reply_markup=None):
+        """Показывает промежуточное состояние, если пора; True, если сообщение его показывает"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if time.monotonic() < max(self._next_edit, self._retry_at):
+                return False
+            return self._edit(text, reply_markup)
+        finally:
+            self._lock.release()
+
+    def finish(self, text, reply_markup=None, wait=True):
+        """Показывает итоговое состояние операции; True, если сообщение его показывает.
+
+        С wait=False паузу 429 пережидает фоновый поток, а вызов сразу возвращает
+        False - так обработчики бота не простаивают.
+        """
+        number = self._last_finish = next(self._finishes)
+        for _ in range(BROADCAST_MAX_RETRIES):
+            delay = self._retry_at - time.monotonic()
+            if delay > 0:
+                if not wait:
+                    threading.Thread(target=self._finish_later, args=(number, text, reply_markup),
+                                     name='progress-finish', daemon=True).start()
+                    return False
+                time.sleep(delay)
+            with self._lock:
+                if number != self._last_finish:
+                    return False  # пока ждали, показать попросили более новое состояние
+                if self._retry_at > time.monotonic():
+                    continue  # пока ждали, пришёл новый ответ 429
+                if self._edit(text, reply_markup):
+                    return True
+                if self._retry_at <= time.monotonic():
+                    return False  # ошибка не 429: повтор не поможет
+        return False
+
+    def _finish_later(self, number, text, reply_markup):
+        if number == self._last_finish:
+            self.finish(text, reply_markup)
+
+    def _edit(self, text, reply_markup):
+        state = (text, reply_markup.to_json() if reply_markup is not None else None)
+        if state == self._shown:
+            return True
+        try:
+            bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, reply_markup=reply_markup)
+        except telebot.apihelper.ApiTelegramException as e:
+            retry_after = retry_after_seconds(e)
+            if retry_after is not None:
+                self._retry_at = time.monotonic() + retry_after
+                return False
+            if "message is not modified" not in str(e):
+                logger.warning(f"Не удалось обновить сообщение о ходе операции в чате {self.chat_id}: {str(e)}")
+                return False
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение о ходе операции в чате {self.chat_id}: {str(e)}")
+            return False
+        self._shown = state
+        self._next_edit = time.monotonic() + self.interval
+        return True
+
+class BroadcastEngine:
+    """Рассылка пулом потоков в пределах ограничений Telegram.
+
+    Общая частота ограничена TokenBucket (BROADCAST_RATE сообщений в секунду),
+    частота в один чат - промежутками BROADCAST_PRIVATE_INTERVAL для личных
+    чатов и BROADCAST_GROUP_INTERVAL для групп и каналов. Сообщение, на которое
+    пришёл ответ 429, отправляется повторно после retry_after (не больше
+    BROADCAST_MAX_RETRIES раз), а общая частота на это время снижается.
+    send(id получателя) отправляет одно сообщение и бросает исключение при ошибке;
+    on_result(id получателя, исход) вызывается после каждого получателя, исход -
+    'sent', 'failed' или 'blocked'. Получатели, до которых не дошла очередь к
+    моменту cancel, исхода не получают.
+    """
+
+    def __init__(self, send, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS, max_retries=BROADCAST_MAX_RETRIES,
+                 on_result=None, stats=None):
+        self.send = send
+        self.on_result = on_result
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.cancelled = threading.Event()
+        self.stats = {'sent': 0, 'failed': 0, 'blocked': 0, 'retries': 0}
+        if stats:
+            self.stats.update(stats)
+        self._chat_ready = {}  # id чата -> момент, с которого в него можно отправлять
+        self._lock = threading.Lock()
+
+    def run(self, recipients, progress=None):
+        """Рассылает всем recipients; progress(stats) вызывается раз в BROADCAST_PROGRESS_INTERVAL секунд"""
+        recipients = iter(recipients)
+        threads = [
+            threading.Thread(target=self._worker, args=(recipients,), name=f'broadcast-{i}', daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while True:
+                thread.join(BROADCAST_PROGRESS_INTERVAL)
+                if not thread.is_alive():
+                    break
+                if progress is not None:
+                    progress(dict(self.stats))
+        return dict(self.stats)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _finish(self, recipient_id, outcome):
+        self._count(outcome)
+        if self.on_result is not None:
+            self.on_result(recipient_id, outcome)
+
+    def _worker(self, recipients):
+        while not self.cancelled.is_set():
+            with self._lock:
+                recipient_id = next(recipients, None)
+            if recipient_id is None:
+                return
+            self._deliver(recipient_id)
+
+    def _wait_for_chat(self, chat_id, delay=0):
+        """Соблюдает промежуток между сообщениями в один чат (delay - дополнительная пауза после 429)"""
+        interval = BROADCAST_PRIVATE_INTERVAL if int(chat_id) > 0 else BROADCAST_GROUP_INTERVAL
+        with self._lock:
+            now = time.monotonic()
+            start = max(now + delay, self._chat_ready.get(chat_id, 0))
+            self._chat_ready[chat_id] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+    def _deliver(self, recipient_id):
+        delay = 0
+        for attempt in range(self.max_retries + 1):
+            if self.cancelled.is_set():
+                return
+            self._wait_for_chat(recipient_id, delay)
+            self.bucket.acquire()
+            try:
+                self.send(recipient_id)
+            except telebot.apihelper.ApiTelegramException as e:
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    state = delivery_health.record_failure(recipient_id, e)
+                    self._finish(recipient_id, 'blocked' if state == 'blocked' else 'failed')
+                    logger.error(f"Ошибка при отправке сообщения {recipient_id}: {str(e)}")
+                    return
+                self.bucket.throttle(delay)
+                self._count('retries')
+                logger.warning(f"Рассылка: превышен лимит Telegram, повтор для {recipient_id} через {delay} с")
+            except Exception as e:
+                self._finish(recipient_id, 'failed')
+                logger.error(f"Неожиданная ошибка при отправке {recipient_id}: {str(e)}")
+                return
+            else:
+                delivery_health.record_success(recipient_id)
+                self._finish(recipient_id, 'sent')
+                self.bucket.recover()
+                return
+        self._finish(recipient_id, 'failed')
+        logger.error(f"Сообщение {recipient_id} не отправлено: лимит Telegram превышен {self.max_retries + 1} раз подряд")
+
+class BroadcastJob:
+    """Задание рассылки, которое переживает перезапуск бота.
+
+    Файлы задания лежат в BROADCAST_DIR:
+    - <id>.json - параметры, состояние и курсор (все получатели до него обработаны);
+    - <id>.recipients.json - получатели, выбранные при создании задания;
+    - <id>.log - журнал доставки, строка «id<TAB>исход» на каждого обработанного
+      получателя.
+    Строка журнала пишется сразу после отправки, поэтому продолжение пропускает
+    всех, кто в нём есть, и повторно сообщение получают разве что те, кому оно
+    уходило в самый момент остановки процесса.
+    Состояния: running (выполняется или ждёт очереди), paused, cancelled, done.
+    """
+
+    FIELDS = ('id', 'broadcast_type', 'message_type', 'text', 'chat_id', 'progress_message_id',
+              'status', 'cursor', 'total', 'skipped', 'created_at', 'stats')
+
+    def __init__(self, directory, values):
+        self.directory = directory
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+        self.cursor = self.cursor or 0
+        self.stats = self.stats or {}
+        self.engine = None
+        self.reporter = None  # ProgressReporter сообщения о ходе рассылки
+        self._stop_requested = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, directory, broadcast_type, message_type, text, recipients, chat_id, progress_message_id, skipped=0):
+        os.makedirs(directory, exist_ok=True)
+        job_id = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        suffix = 1
+        while os.path.exists(os.path.join(directory, f"{job_id}.json")):
+            suffix += 1
+            job_id = f"{job_id.split('.')[0]}.{suffix}"
+        job = cls(directory, {
+            'id': job_id, 'broadcast_type': broadcast_type, 'message_type': message_type, 'text': text,
+            'chat_id': chat_id, 'progress_message_id': progress_message_id, 'status': 'running',
+            'total': len(recipients), 'skipped': skipped, 'created_at': time.strftime(TIMESTAMP_FORMAT),
+        })
+        atomic_write(job._path('recipients.json'), lambda f: json.dump(recipients, f))
+        job.save()
+        return job
+
+    def _path(self, suffix):
+        return os.path.join(self.directory, f"{self.id}.{suffix}")
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def save(self):
+        with self._lock:
+            data = self.to_dict()
+            atomic_write(self._path('json'), lambda f: json.dump(data, f, ensure_ascii=False))
+
+    def remove_files(self):
+        for suffix in ('json', 'recipients.json', 'log'):
+            try:
+                os.remove(self._path(suffix))
+            except FileNotFoundError:
+                pass
+
+    def processed(self):
+        return sum(self.stats.get(outcome, 0) for outcome in ('sent', 'failed', 'blocked'))
+
+    def _read_log(self):
+        """Уже обработанные получатели и счётчики исходов по журналу доставки"""
+        delivered = set()
+        stats = {'sent': 0, 'failed': 0, 'blocked': 0}
+        try:
+            with open(self._path('log'), encoding='utf-8') as f:
+                for line in f:
+                    recipient_id, _, outcome = line.rstrip('\n').partition('\t')
+                    # Последняя строка могла записаться не полностью
+                    if outcome in stats and recipient_id not in delivered:
+                        delivered.add(recipient_id)
+                        stats[outcome] += 1
+        except FileNotFoundError:
+            pass
+        return delivered, stats
+
+    def _send(self, recipient_id):
+        if self.message_type == "probe":
+            # Проверка доступности: действие «печатает» видно недолго и не оставляет сообщения
+            bot.send_chat_action(recipient_id, 'typing')
+        elif self.message_type == "html":
+            bot.send_message(recipient_id, self.text, parse_mode='HTML', disable_web_page_preview=True)
+        else:
+            bot.send_message(recipient_id, self.text)
+
+    def run(self, progress=None):
+        """Отправляет оставшимся получателям, пока они не кончатся или задание не остановят (stop)"""
+        with open(self._path('recipients.json'), encoding='utf-8') as f:
+            recipients = json.load(f)
+        delivered, stats = self._read_log()
+        in_flight = {}  # выданные движку получатели -> их номер в recipients
+        finished = set()  # номера обработанных получателей после курсора
+        lock = threading.Lock()
+
+        def mark_finished(index):
+            finished.add(index)
+            while self.cursor in finished:
+                finished.discard(self.cursor)
+                self.cursor += 1
+
+        def pending():
+            for index in range(self.cursor, len(recipients)):
+                recipient_id = recipients[index]
+                with lock:
+                    if recipient_id in delivered:
+                        mark_finished(index)
+                        continue
+                    in_flight[recipient_id] = index
+                yield recipient_id
+
+        with open(self._path('log'), 'a', encoding='utf-8') as log:
+            def on_result(recipient_id, outcome):
+                with lock:
+                    log.write(f"{recipient_id}\t{outcome}\n")
+                    log.flush()
+                    mark_finished(in_flight.pop(recipient_id))
+
+            def checkpoint(engine_stats):
+                with lock:
+                    os.fsync(log.fileno())
+                    self.stats = engine_stats
+                    self.save()
+                if progress is not None:
+                    progress(self)
+
+            engine = BroadcastEngine(self._send, on_result=on_result, stats=stats)
+            with self._lock:
+                self.engine = engine
+                if self._stop_requested:
+                    engine.cancel()
+            self.stats = engine.run(pending(), checkpoint)
+            with lock:
+                os.fsync(log.fileno())
+        with self._lock:
+            self.engine = None
+            self._stop_requested = False
+        stopped = engine.cancelled.is_set()
+        if not stopped:
+            self.status = 'done'
+        if self.status in ('done', 'cancelled'):
+            self.remove_files()
+        else:
+            self.save()
+
+    def stop(self, status=None):
+        """Останавливает выполнение; status - новое состояние (None - оставить, например при выключении бота)"""
+        with self._lock:
+            if status is not None:
+                self.status = status
+            self._stop_requested = True
+            engine = self.engine
+        if engine is not None:
+            engine.cancel()
+
+class BroadcastJobs:
+    """Задания рассылки: выполняются по одному в фоновом потоке, в порядке постановки.
+
+    Одновременно идёт только одна рассылка, иначе несколько пулов вместе
+    превысили бы общий лимит Telegram.
+    """
+
+    def __init__(self, directory=BROADCAST_DIR):
+        self.directory = directory
+        self.jobs = {}
+        self.current = None
+        self._queue = []
+        self._thread = None
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Читает задания с диска и ставит в очередь незавершённые (вызывается при запуске бота)"""
+        if not os.path.isdir(self.directory):
+            return []
+        resumed = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json') or name.endswith('.recipients.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    job = BroadcastJob(self.directory, json.load(f))
+            except (OSError, ValueError) as e:
+                logger.error(f"Не удалось прочитать задание рассылки {name}: {e}")
+                continue
+            self.jobs[job.id] = job
+            if job.status == 'running':
+                resumed.append(job)
+                self._enqueue(job)
+        logger.info(f"Заданий рассылки: {len(self.jobs)}, продолжаются после перезапуска: {len(resumed)}")
+        return resumed
+
+    def create(self, broadcast_type, message_type, text, recipients, chat_id, progress_message_id, skipped=0):
+        job = BroadcastJob.create(self.directory, broadcast_type, message_type, text, recipients, chat_id,
+                                  progress_message_id, skipped)
+        with self._lock:
+            self.jobs[job.id] = job
+        self._enqueue(job)
+        return job
+
+    def unfinished(self):
+        with self._lock:
+            return [job for job in self.jobs.values() if job.status in ('running', 'paused')]
+
+    def pause(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status != 'running':
+            return None
+        job.stop('paused')
+        if job is not self.current:
+            job.save()
+        return job
+
+    def resume(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status != 'paused':
+            return None
+        job.status = 'running'
+        job.save()
+        self._enqueue(job)
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in ('running', 'paused'):
+            return None
+        job.stop('cancelled')
+        if job is not self.current:
+            job.remove_files()
+            self._forget(job)
+        return job
+
+    def stop(self):
+        """Останавливает текущую рассылку при выключении бота; она продолжится после запуска"""
+        with self._lock:
+            self._stopping = True
+            job, thread = self.current, self._thread
+        if job is not None:
+            job.stop()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=30)
+
+    def _forget(self, job):
+        with self._lock:
+            self.jobs.pop(job.id, None)
+
+    def _enqueue(self, job):
+        with self._lock:
+            if job in self._queue:
+                return
+            job._stop_requested = False
+            self._queue.append(job)
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name='broadcast-jobs', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._queue or self._stopping:
+                    self._thread = None
+                    return
+                job = self._queue.pop(0)
+                if job.status != 'running':
+                    continue
+                self.current = job
+            try:
+                logger.info(f"Рассылка {job.id}: начало с получателя {job.cursor + 1} из {job.total}")
+                job.run(report_broadcast_progress)
+                logger.info(f"Рассылка {job.id}: {job.status}, {job.stats}")
+            except Exception as e:
+                # Задание остаётся на диске, его можно продолжить кнопкой «Продолжить»
+                job.status = 'paused'
+                job.engine = None
+                logger.error(f"Ошибка при выполнении рассылки {job.id}: {str(e)}")
+                try:
+                    job.save()
+                except OSError:
+                    pass
+            finally:
+                with self._lock:
+                    self.current = None
+                if job.status in ('done', 'cancelled'):
+                    self._forget(job)
+            report_broadcast_progress(job)
+
+broadcast_jobs = BroadcastJobs()
+
+class Scheduler:
+    """Отложенные и повторяющиеся задания: рассылки, обновление статистики каналов, проверка чатов.
+
+    Задание - словарь {'id', 'action', 'params', 'run_at', 'interval', 'chat_id',
+    'created_at'}: action - ключ SCHEDULED_ACTIONS, run_at - время запуска
+    (секунды от начала эпохи), interval - период повтора в секундах или None.
+    Ближайшие запуски лежат в куче (run_at, id), поэтому постановка и выбор
+    очередного задания стоят O(log n) при любом числе заданий; отмена только
+    убирает задание из словаря, а его запись в куче пропускается, когда до неё
+    дойдёт очередь. Задания сохраняются в SCHEDULE_FILE отложенно
+    (schedule_store); запуски, пропущенные, пока бот не работал, выполняются
+    один раз сразу после запуска.
+    """
+
+    def __init__(self, path=SCHEDULE_FILE):
+        self.path = path
+        self.tasks = {}
+        self._heap = []
+        self._next_id = 1
+        self._running = set()  # id заданий, которые выполняются сейчас
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                tasks = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать расписание {self.path}: {e}")
+            return
+        with self._condition:
+            self.tasks = {task['id']: task for task in tasks}
+            self._heap = [(task['run_at'], task['id']) for task in tasks]
+            heapq.heapify(self._heap)
+            self._next_id = max((int(task_id) for task_id in self.tasks), default=0) + 1
+            self._condition.notify()
+        logger.info(f"Расписание загружено: заданий {len(self.tasks)}")
+
+    def save(self):
+        with self._condition:
+            tasks = list(self.tasks.values())
+        try:
+            atomic_write(self.path, lambda f: json.dump(tasks, f, ensure_ascii=False))
+            return True
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении расписания: {e}")
+            return False
+
+    def add(self, action, params, run_at, interval=None, chat_id=None):
+        with self._condition:
+            task = {
+                'id': str(self._next_id), 'action': action, 'params': params, 'run_at': run_at,
+                'interval': interval, 'chat_id': chat_id, 'created_at': time.strftime(TIMESTAMP_FORMAT),
+            }
+            self._next_id += 1
+            self.tasks[task['id']] = task
+            heapq.heappush(self._heap, (run_at, task['id']))
+            if self._heap[0][1] == task['id']:
+                # Новое задание - ближайшее: поток должен проснуться раньше, чем собирался
+                self._condition.notify()
+        schedule_store.mark_dirty()
+        return task
+
+    def cancel(self, task_id):
+        with self._condition:
+            task = self.tasks.pop(task_id, None)
+        if task is not None:
+            schedule_store.mark_dirty()
+        return task
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def upcoming(self, offset, limit):
+        """Задания по времени запуска с места offset + 1: limit штук или меньше в конце"""
+        with self._condition:
+            tasks = list(self.tasks.values())
+        return heapq.nsmallest(offset + limit, tasks, key=lambda task: (task['run_at'], int(task['id'])))[offset:]
+
+    def start(self):
+        with self._condition:
+            self._stopping = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            thread = self._thread
+            self._condition.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+    def _next_due(self):
+        """Задание, время которого пришло, или (None, секунд до ближайшего); вызывается под блокировкой"""
+        heap = self._heap
+        while heap:
+            run_at, task_id = heap[0]
+            task = self.tasks.get(task_id)
+            if task is None or task['run_at'] != run_at:
+                heapq.heappop(heap)  # задание отменено или перенесено
+                continue
+            delay = run_at - time.time()
+            if delay > 0:
+                return None, delay
+            heapq.heappop(heap)
+            if task['interval']:
+                # Следующий запуск - ближайший в будущем по сетке периода: пропущенные не наверстываем
+                missed = int((time.time() - run_at) // task['interval']) + 1
+                task['run_at'] = run_at + missed * task['interval']
+                heapq.heappush(heap, (task['run_at'], task_id))
+            else:
+                del self.tasks[task_id]
+            return task, None
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopping:
+                        self._thread = None
+                        return
+                    task, delay = self._next_due()
+                    if task is not None:
+                        break
+                    self._condition.wait(delay)
+                if task['id'] in self._running:
+                    logger.warning(f"Задание {task['id']} ещё выполняется, запуск пропущен")
+                    task = None
+                else:
+                    self._running.add(task['id'])
+            schedule_store.mark_dirty()
+            if task is not None:
+                # Статистика и проверка чатов идут долго: очередь заданий не должна их ждать
+                threading.Thread(target=self._execute, args=(task,), name='scheduled-task', daemon=True).start()
+
+    def _execute(self, task):
+        title = SCHEDULED_ACTIONS[task['action']][0]
+        try:
+            logger.info(f"Задание {task['id']} ({title}): запуск")
+            SCHEDULED_ACTIONS[task['action']][1](task)
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении задания {task['id']} ({title}): {str(e)}")
+        finally:
+            with self._condition:
+                self._running.discard(task['id'])
+
+scheduler = Scheduler()
+schedule_store = WriteBehindStore(scheduler.save, interval=SCHEDULE_SAVE_INTERVAL, dirty_threshold=1)
+
 @bot.callback_query_handler(func=lambda call: call.data == "send_broadcast")
 @super_admin_required
 def handle_send_broadcast(call):
@@ -2806,13 +7226,27 @@ def handle_send_broadcast(call):
         types.InlineKeyboardButton(f"{EMOJI['users']} Всем пользователям", callback_data="broadcast_all_users"),
         types.InlineKeyboardButton(f"{EMOJI['chats']} В чаты", callback_data="broadcast_chats"),
         types.InlineKeyboardButton(f"{EMOJI['channels']} В каналы", callback_data="broadcast_channels"),
-        types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="super_admin")
+        types.InlineKeyboardButton("🎯 Выбранной аудитории", callback_data="audience"),
     )
+    unfinished = broadcast_jobs.unfinished()
+    for job in unfinished:
+        state = "⏸" if job.status == 'paused' else "▶️"
+        markup.add(types.InlineKeyboardButton(f"{state} Рассылка {job.id}: {job.processed()}/{job.total}",
+                                              callback_data=f"show_broadcast:{job.id}"))
+    stale = len(delivery_health.stale_unreachable())
+    if stale:
+        markup.add(types.InlineKeyboardButton(f"🔄 Перепроверить недоступных ({stale})", callback_data="probe_unreachable"))
+    markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="super_admin"))
     
     text = f"{EMOJI['rocket']} Выберите тип рассылки:\n\n"
     text += "• Всем пользователям - отправка в личные сообщения\n"
     text += "• В чаты - отправка во все чаты с ботом\n"
-    text += "• В каналы - отправка во все каналы с ботом"
+    text += "• В каналы - отправка во все каналы с ботом\n"
+    text += "• Выбранной аудитории - пользователям по языку, рангу, активности или чату"
+    text += f"\n\nНедоступные получатели ({delivery_health.unreachable_count()}) пропускаются; "
+    text += f"не получавших сообщений дольше {DELIVERY_REPROBE_AFTER // 86400} дней можно перепроверить."
+    if unfinished:
+        text += "\n\nНезавершённые рассылки - ниже: их можно приостановить, продолжить или отменить."
     
     bot.edit_message_text(
         text=text,
@@ -2821,16 +7255,93 @@ def handle_send_broadcast(call):
         reply_markup=markup
     )
 
+# Условия выбора аудитории: (измерение, подпись, допустимые значения, подпись значения)
+AUDIENCE_FILTERS = (
+    ('language', "🌐 Язык", lambda: audience_segments.values('language'), str),
+    ('tier', "🏅 Ранг", lambda: [EMOJI['medal_bronze'], EMOJI['medal_silver'], EMOJI['medal_gold'], EMOJI['trophy']], str),
+    ('notifications', "🔔 Уведомления", lambda: [True, False], lambda value: "включены" if value else "выключены"),
+    ('active', "🔥 Активность", lambda: list(RATING_WINDOWS),
+     lambda window: {'day': "за 24 часа", 'week': "за 7 дней", 'month': "за 30 дней"}[window]),
+)
+
+audience_selections = {}  # id администратора -> {измерение: значение} (см. AudienceSegments.count)
+
+def audience_view(admin_id):
+    """Текст и разметка выбора аудитории с числом подходящих пользователей"""
+    selection = audience_selections.setdefault(admin_id, {})
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    for name, label, _, value_label in AUDIENCE_FILTERS:
+        value = selection.get(name)
+        buttons.append(types.InlineKeyboardButton(f"{label}: {'любой' if value is None else value_label(value)}",
+                                                  callback_data=f"audience_set:{name}"))
+    chat_id = selection.get('chat')
+    chat_title = chats[chat_id]['title'] if chat_id in chats else "любой"
+    buttons.append(types.InlineKeyboardButton(f"{EMOJI['chats']} Чат: {chat_title}", callback_data="audience_chat"))
+    markup.add(*buttons)
+    count = audience_segments.count(selection)
+    markup.add(types.InlineKeyboardButton(f"{EMOJI['edit']} Написать сообщение ({count})", callback_data="broadcast_segment"))
+    markup.add(
+        types.InlineKeyboardButton("🔄 Сбросить", callback_data="audience_reset"),
+        types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="send_broadcast"),
+    )
+    text = "🎯 Аудитория рассылки\n\n"
+    text += "Нажимайте на условия, чтобы перебрать значения; пользователи должны подходить под все.\n\n"
+    text += f"{EMOJI['users']} Получателей: {count} из {len(users)}\n"
+    text += f"{EMOJI['info']} Недоступные получатели при отправке будут пропущены"
+    return text, markup
+
+@bot.callback_query_handler(func=lambda call: call.data in ("audience", "audience_reset", "audience_chat")
+                            or call.data.startswith("audience_set:"))
+@super_admin_required
+def handle_audience(call):
+    admin_id = str(call.from_user.id)
+    selection = audience_selections.setdefault(admin_id, {})
+    if call.data == "audience_reset":
+        selection.clear()
+    elif call.data == "audience_chat":
+        if 'chat' in selection:
+            del selection['chat']
+        else:
+            bot.answer_callback_query(call.id)
+            msg = bot.send_message(call.message.chat.id, f"{EMOJI['chats']} Введите ID чата, участникам которого отправить рассылку:")
+            bot.register_next_step_handler(msg, audience_chat_step)
+            return
+    elif call.data.startswith("audience_set:"):
+        name = call.data.split(":", 1)[1]
+        values = next(values for filter_name, _, values, _ in AUDIENCE_FILTERS if filter_name == name)()
+        # Следующее значение по кругу; после последнего - снова «любой»
+        current = selection.get(name)
+        position = values.index(current) + 1 if current in values else 0
+        if position < len(values):
+            selection[name] = values[position]
+        else:
+            selection.pop(name, None)
+
+    text, markup = audience_view(admin_id)
+    bot.edit_message_text(text=text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+def audience_chat_step(message):
+    chat_id = message.text.strip() if message.text else ''
+    if chat_id not in chats:
+        bot.reply_to(message, f"{EMOJI['error']} Чат {chat_id} не найден.")
+        return
+    admin_id = str(message.from_user.id)
+    audience_selections.setdefault(admin_id, {})['chat'] = chat_id
+    text, markup = audience_view(admin_id)
+    bot.send_message(message.chat.id, text, reply_markup=markup)
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("broadcast_"))
 @super_admin_required
 def handle_broadcast_type(call):
-    broadcast_type = call.data.split("_")[1]
+    broadcast_type = call.data.split("_", 1)[1]
     
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(
         types.InlineKeyboardButton(f"{EMOJI['edit']} Обычное сообщение", callback_data=f"compose_broadcast:{broadcast_type}:text"),
         types.InlineKeyboardButton(f"{EMOJI['magic']} С форматированием", callback_data=f"compose_broadcast:{broadcast_type}:html"),
-        types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="send_broadcast")
+        types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="audience" if broadcast_type == "segment" else "send_broadcast")
     )
     
     text = f"{EMOJI['edit']} Выберите тип сообщения для рассылки:\n\n"
@@ -2868,6 +7379,24 @@ def handle_compose_broadcast(call):
     msg = bot.send_message(call.message.chat.id, help_text)
     bot.register_next_step_handler(msg, process_broadcast_message, broadcast_type, message_type)
 
+def start_broadcast(broadcast_type, message_type, text, progress_msg, selection=None):
+    """Ставит рассылку в очередь; ход показывается в сообщении progress_msg"""
+    if broadcast_type == "all_users":
+        candidates = list(users.keys())
+    elif broadcast_type == "chats":
+        candidates = list(chats.keys())
+    elif broadcast_type == "segment":
+        candidates = audience_segments.select(selection or {})
+    else:  # channels
+        candidates = list(channels.keys())
+    # Тех, до кого сообщения заведомо не доходят (заблокировали бота, удалены), не тратим лимит
+    recipients = [recipient_id for recipient_id in candidates if delivery_health.is_reachable(recipient_id)]
+    # Рассылка идёт в фоне (BroadcastJobs) и продолжается после перезапуска бота
+    job = broadcast_jobs.create(broadcast_type, message_type, text, recipients,
+                                progress_msg.chat.id, progress_msg.message_id, len(candidates) - len(recipients))
+    report_broadcast_progress(job, wait=False)
+    return job
+
 def process_broadcast_message(message, broadcast_type, message_type):
     broadcast_text = message.text.strip()
     if not broadcast_text:
@@ -2875,93 +7404,12 @@ def process_broadcast_message(message, broadcast_type, message_type):
         return
     
     # Создаем прогресс-сообщение
-    progress_msg = bot.reply_to(
-        message, 
-        f"{EMOJI['info']} Подготовка к рассылке...",
-        reply_markup=types.InlineKeyboardMarkup().add(
-            types.InlineKeyboardButton(f"{EMOJI['error']} Отменить", callback_data="cancel_broadcast")
-        )
-    )
+    progress_msg = bot.reply_to(message, f"{EMOJI['info']} Подготовка к рассылке...")
     
     try:
-        successful = 0
-        failed = 0
-        blocked = 0
-        total = 0
-        
-        if broadcast_type == "all_users":
-            recipients = users.keys()
-            total = len(users)
-        elif broadcast_type == "chats":
-            recipients = chats.keys()
-            total = len(chats)
-        else:  # channels
-            recipients = channels.keys()
-            total = len(channels)
-        
-        for i, recipient_id in enumerate(recipients, 1):
-            try:
-                if message_type == "html":
-                    bot.send_message(
-                        recipient_id,
-                        broadcast_text,
-                        parse_mode='HTML',
-                        disable_web_page_preview=True
-                    )
-                else:
-                    bot.send_message(recipient_id, broadcast_text)
-                successful += 1
-                
-                # Обновляем прогресс каждые 10 отправок
-                if i % 10 == 0:
-                    progress = (i / total) * 100
-                    update_text = (
-                        f"{EMOJI['info']} Прогресс рассылки: {progress:.1f}%\n"
-                        f"Отправлено: {successful}\n"
-                        f"Ошибок: {failed}\n"
-                        f"Заблокировали: {blocked}"
-                    )
-                    try:
-                        bot.edit_message_text(
-                            update_text,
-                            chat_id=progress_msg.chat.id,
-                            message_id=progress_msg.message_id,
-                            reply_markup=types.InlineKeyboardMarkup().add(
-                                types.InlineKeyboardButton(f"{EMOJI['error']} Отменить", callback_data="cancel_broadcast")
-                            )
-                        )
-                    except:
-                        pass
-                    
-                time.sleep(0.05)  # Небольшая задержка между отправками
-                
-            except telebot.apihelper.ApiException as e:
-                if "Forbidden" in str(e):
-                    blocked += 1
-                else:
-                    failed += 1
-                logger.error(f"Ошибка при отправке сообщения {recipient_id}: {str(e)}")
-            except Exception as e:
-                failed += 1
-                logger.error(f"Неожиданная ошибка при отправке {recipient_id}: {str(e)}")
-        
-        # Финальный отчет
-        report = (
-            f"{EMOJI['success']} Рассылка завершена!\n\n"
-            f"Всего получателей: {total}\n"
-            f"Успешно отправлено: {successful}\n"
-            f"Ошибок доставки: {failed}\n"
-            f"Заблокировали бота: {blocked}"
-        )
-        
-        try:
-            bot.edit_message_text(
-                report,
-                chat_id=progress_msg.chat.id,
-                message_id=progress_msg.message_id
-            )
-        except:
-            bot.reply_to(message, report)
+        selection = audience_selections.get(str(message.from_user.id), {})
+        job = start_broadcast(broadcast_type, message_type, broadcast_text, progress_msg, selection)
+        logger.info(f"Суперадминистратор {message.from_user.id} создал рассылку {job.id} ({broadcast_type}, получателей: {job.total})")
         
     except Exception as e:
         error_text = f"{EMOJI['error']} Ошибка при выполнении рассылки: {str(e)}"
@@ -2975,36 +7423,313 @@ def process_broadcast_message(message, broadcast_type, message_type):
             bot.reply_to(message, error_text)
         logger.error(f"Ошибка при выполнении рассылки: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_broadcast")
+BROADCAST_STATUS_TITLES = {
+    'running': f"{EMOJI['info']} {{name}} {{id}} выполняется",
+    'paused': f"{EMOJI['info']} {{name}} {{id}} приостановлена",
+    'cancelled': f"{EMOJI['error']} {{name}} {{id}} отменена",
+    'done': f"{EMOJI['success']} {{name}} {{id}} завершена!",
+}
+
+def broadcast_progress_view(job):
+    """Текст и кнопки сообщения о ходе рассылки"""
+    stats = job.stats
+    processed = job.processed()
+    progress = (processed / job.total) * 100 if job.total else 100
+    if job.message_type == "probe":
+        name, sent_label = "Проверка недоступных", "Снова доступны"
+    else:
+        name, sent_label = "Рассылка", "Успешно отправлено"
+    text = (
+        f"{BROADCAST_STATUS_TITLES[job.status].format(name=name, id=job.id)}\n\n"
+        f"Прогресс: {progress:.1f}% ({processed} из {job.total})\n"
+        f"{sent_label}: {stats.get('sent', 0)}\n"
+        f"Ошибок доставки: {stats.get('failed', 0)}\n"
+        f"Заблокировали бота: {stats.get('blocked', 0)}"
+    )
+    if job.skipped:
+        text += f"\nПропущено недоступных: {job.skipped}"
+    markup = None
+    if job.status == 'running':
+        markup = types.InlineKeyboardMarkup(row_width=2).add(
+            types.InlineKeyboardButton("⏸ Пауза", callback_data=f"pause_broadcast:{job.id}"),
+            types.InlineKeyboardButton(f"{EMOJI['error']} Отменить", callback_data=f"cancel_broadcast:{job.id}")
+        )
+    elif job.status == 'paused':
+        markup = types.InlineKeyboardMarkup(row_width=2).add(
+            types.InlineKeyboardButton("▶️ Продолжить", callback_data=f"resume_broadcast:{job.id}"),
+            types.InlineKeyboardButton(f"{EMOJI['error']} Отменить", callback_data=f"cancel_broadcast:{job.id}")
+        )
+    return text, markup
+
+def report_broadcast_progress(job, force=False, wait=True):
+    """Обновляет сообщение о ходе рассылки (вызывается при каждом сохранении хода и при смене состояния).
+
+    Смена состояния (force или рассылка остановлена) показывается всегда, ход - не чаще PROGRESS_EDIT_INTERVAL.
+    Обработчики бота передают wait=False, чтобы не ждать паузы 429 (см. ProgressReporter.finish).
+    """
+    reporter = job.reporter
+    if reporter is None or (reporter.chat_id, reporter.message_id) != (job.chat_id, job.progress_message_id):
+        reporter = job.reporter = ProgressReporter(job.chat_id, job.progress_message_id)
+    text, markup = broadcast_progress_view(job)
+    if force or job.status != 'running':
+        reporter.finish(text, markup, wait=wait)
+    else:
+        reporter.update(text, markup)
+
+def resume_broadcast_jobs():
+    """Продолжает рассылки, прерванные перезапуском бота"""
+    for job in broadcast_jobs.load():
+        safe_send_message(job.chat_id, f"{EMOJI['info']} Рассылка {job.id} продолжается после перезапуска бота "
+                                       f"(обработано {job.processed()} из {job.total}).")
+
+@bot.callback_query_handler(func=lambda call: call.data == "probe_unreachable")
+@super_admin_required
+def handle_probe_unreachable(call):
+    recipients = delivery_health.stale_unreachable()
+    if not recipients:
+        bot.answer_callback_query(call.id, f"{EMOJI['info']} Перепроверять некого")
+        return
+    # Проверка идёт тем же заданием рассылки, поэтому делит с рассылками общий лимит Telegram
+    job = broadcast_jobs.create('probe', 'probe', '', recipients, call.message.chat.id, call.message.message_id)
+    report_broadcast_progress(job, wait=False)
+    bot.answer_callback_query(call.id)
+    logger.info(f"Суперадминистратор {call.from_user.id} запустил проверку недоступных получателей ({len(recipients)})")
+
+@bot.callback_query_handler(func=lambda call: call.data.split(":")[0] in ("pause_broadcast", "resume_broadcast", "cancel_broadcast", "show_broadcast"))
 @super_admin_required
-def handle_cancel_broadcast(call):
-    # Здесь можно добавить логику отмены рассылки
-    bot.answer_callback_query(call.id, f"{EMOJI['error']} Функция отмены рассылки пока не реализована")
+def handle_broadcast_job(call):
+    action, _, job_id = call.data.partition(":")
+    if action == "pause_broadcast":
+        job = broadcast_jobs.pause(job_id)
+        done_text = "Рассылка приостановлена"
+    elif action == "resume_broadcast":
+        job = broadcast_jobs.resume(job_id)
+        done_text = "Рассылка продолжается"
+    elif action == "cancel_broadcast":
+        job = broadcast_jobs.cancel(job_id)
+        done_text = "Рассылка отменена"
+    else:
+        job = broadcast_jobs.jobs.get(job_id)
+        done_text = None
+    if job is None:
+        bot.answer_callback_query(call.id, f"{EMOJI['error']} Рассылка уже завершена или изменена")
+        return
+    # Ход рассылки дальше показывается в сообщении, где нажата кнопка
+    job.chat_id, job.progress_message_id = call.message.chat.id, call.message.message_id
+    if job.status != 'cancelled' and job is not broadcast_jobs.current:
+        job.save()
+    report_broadcast_progress(job, force=True, wait=False)
+    bot.answer_callback_query(call.id, f"{EMOJI['success']} {done_text}" if done_text else None)
+    if done_text:
+        logger.info(f"Суперадминистратор {call.from_user.id}: {done_text.lower()} ({job.id})")
+
+def run_scheduled_broadcast(task):
+    params = task['params']
+    progress_msg = bot.send_message(task['chat_id'], f"{EMOJI['info']} Запланированная рассылка {task['id']}: подготовка...")
+    job = start_broadcast(params['broadcast_type'], params['message_type'], params['text'], progress_msg, params.get('selection'))
+    logger.info(f"Задание {task['id']}: создана рассылка {job.id} (получателей: {job.total})")
+
+# Действия планировщика: имя -> (название, функция от задания)
+SCHEDULED_ACTIONS = {
+    'broadcast': ("Рассылка", run_scheduled_broadcast),
+    'channel_stats': ("Статистика каналов", lambda task: update_channels_stats()),
+    'verify_chats': ("Проверка чатов", lambda task: verify_chats()),
+}
+
+SCHEDULE_UNITS = {'мин': 60, 'ч': 3600, 'д': 86400}
+SCHEDULE_BROADCAST_TARGETS = {
+    'all_users': f"{EMOJI['users']} Всем пользователям",
+    'chats': f"{EMOJI['chats']} В чаты",
+    'channels': f"{EMOJI['channels']} В каналы",
+    'segment': "🎯 Выбранной аудитории",
+}
+
+def parse_schedule(text):
+    """Время первого запуска (секунды) и период повтора (секунды или None) из строки расписания.
+
+    Понимает «2025-05-01 09:00», «09:00» (ближайшее такое время), «через 30 мин»
+    и добавку «каждые 24 ч» (мин, ч, д); одна добавка означает повтор с этого
+    момента. ValueError с причиной, если строку не разобрать или указанная
+    дата уже прошла.
+    """
+    text = ' '.join(text.lower().split())
+    interval = None
+    match = re.search(r'(?:^| )кажд\w* (\d+) ?(мин|ч|д)\w*$', text)
+    if match:
+        interval = int(match.group(1)) * SCHEDULE_UNITS[match.group(2)]
+        if interval < SCHEDULE_MIN_INTERVAL:
+            raise ValueError(f"период меньше {SCHEDULE_MIN_INTERVAL} секунд")
+        text = text[:match.start()].strip()
+    now = datetime.now()
+    match = re.fullmatch(r'через (\d+) ?(мин|ч|д)\w*', text)
+    if match:
+        run_at = now + timedelta(seconds=int(match.group(1)) * SCHEDULE_UNITS[match.group(2)])
+    elif re.fullmatch(r'\d{1,2}:\d{2}', text):
+        moment = datetime.strptime(text, '%H:%M')
+        run_at = now.replace(hour=moment.hour, minute=moment.minute, second=0, microsecond=0)
+        if run_at <= now:
+            run_at += timedelta(days=1)
+    elif not text and interval:
+        run_at = now + timedelta(seconds=interval)
+    else:
+        try:
+            run_at = datetime.strptime(text, '%Y-%m-%d %H:%M')
+        except ValueError:
+            raise ValueError("не удалось разобрать время") from None
+        if run_at <= now:
+            raise ValueError("указанное время уже прошло")
+    return run_at.timestamp(), interval
+
+def format_period(seconds):
+    for unit, size in sorted(SCHEDULE_UNITS.items(), key=lambda item: -item[1]):
+        if seconds % size == 0:
+            return f"{seconds // size} {unit}"
+    return f"{seconds} с"
+
+def describe_task(task):
+    title = SCHEDULED_ACTIONS[task['action']][0]
+    if task['action'] == 'broadcast':
+        target = SCHEDULE_BROADCAST_TARGETS[task['params']['broadcast_type']]
+        title += f" ({target.split(' ', 1)[1].lower()})"
+    when = time.strftime('%Y-%m-%d %H:%M', time.localtime(task['run_at']))
+    period = f", каждые {format_period(task['interval'])}" if task['interval'] else ""
+    return f"{when}{period} - {title}"
+
+def get_schedule_page(page):
+    total = len(scheduler)
+    total_pages = max((total - 1) // SCHEDULE_PAGE_SIZE + 1, 1)
+    page = min(max(page, 0), total_pages - 1)
+
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for task in scheduler.upcoming(page * SCHEDULE_PAGE_SIZE, SCHEDULE_PAGE_SIZE):
+        markup.add(types.InlineKeyboardButton(f"❌ {describe_task(task)}", callback_data=f"schedule_cancel:{task['id']}:{page}"))
+    if total_pages > 1:
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"schedule_page:{page-1}"))
+        nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="ignore"))
+        if page < total_pages - 1:
+            nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"schedule_page:{page+1}"))
+        markup.row(*nav_buttons)
+    markup.add(
+        types.InlineKeyboardButton(f"➕ {SCHEDULED_ACTIONS['broadcast'][0]}", callback_data="schedule_add:broadcast"),
+        types.InlineKeyboardButton(f"➕ {SCHEDULED_ACTIONS['channel_stats'][0]}", callback_data="schedule_add:channel_stats"),
+        types.InlineKeyboardButton(f"➕ {SCHEDULED_ACTIONS['verify_chats'][0]}", callback_data="schedule_add:verify_chats"),
+        types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="super_admin"),
+    )
+
+    text = f"⏰ Расписание (заданий: {total})\n\n"
+    if total:
+        text += "Задания перечислены по времени запуска; нажмите на задание, чтобы отменить его."
+    else:
+        text += "Запланированных заданий нет."
+    return text, markup
+
+@bot.callback_query_handler(func=lambda call: call.data == "schedule" or call.data.startswith(("schedule_page:", "schedule_cancel:")))
+@super_admin_required
+def handle_schedule(call):
+    page = 0
+    answer = None
+    if call.data.startswith("schedule_page:"):
+        page = int(call.data.split(":")[1])
+    elif call.data.startswith("schedule_cancel:"):
+        _, task_id, page = call.data.split(":")
+        page = int(page)
+        task = scheduler.cancel(task_id)
+        if task is None:
+            answer = f"{EMOJI['error']} Задание уже выполнено или отменено"
+        else:
+            answer = f"{EMOJI['success']} Задание отменено"
+            logger.info(f"Суперадминистратор {call.from_user.id} отменил задание {task_id} ({describe_task(task)})")
+
+    text, markup = get_schedule_page(page)
+    try:
+        bot.edit_message_text(text=text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" not in str(e):
+            raise
+    bot.answer_callback_query(call.id, answer)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(("schedule_add:", "schedule_broadcast:")))
+@super_admin_required
+def handle_schedule_add(call):
+    action, _, argument = call.data.partition(":")
+    if action == "schedule_add" and argument == "broadcast":
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        for broadcast_type, label in SCHEDULE_BROADCAST_TARGETS.items():
+            markup.add(types.InlineKeyboardButton(label, callback_data=f"schedule_broadcast:{broadcast_type}"))
+        markup.add(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="schedule"))
+        text = f"{EMOJI['rocket']} Кому отправить запланированную рассылку?\n\n"
+        text += "Для выбранной аудитории берутся условия, заданные в меню «Рассылка» (на момент постановки)."
+        bot.edit_message_text(text=text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+        bot.answer_callback_query(call.id)
+        return
+
+    if action == "schedule_broadcast":
+        task_action = 'broadcast'
+        params = {'broadcast_type': argument, 'message_type': 'text'}
+        if argument == 'segment':
+            params['selection'] = dict(audience_selections.get(str(call.from_user.id), {}))
+    else:
+        task_action, params = argument, {}
+    if task_action not in SCHEDULED_ACTIONS:
+        bot.answer_callback_query(call.id, f"{EMOJI['error']} Неизвестное задание")
+        return
+    bot.answer_callback_query(call.id)
+    help_text = (
+        f"⏰ Когда выполнить «{SCHEDULED_ACTIONS[task_action][0]}»? Например:\n"
+        "• 2025-05-01 09:00\n"
+        "• 09:00 - ближайшее такое время\n"
+        "• через 30 мин\n"
+        "Для повтора добавьте период: «09:00 каждые 1 д» или просто «каждые 6 ч»."
+    )
+    msg = bot.send_message(call.message.chat.id, help_text)
+    bot.register_next_step_handler(msg, schedule_time_step, task_action, params)
+
+def schedule_time_step(message, task_action, params):
+    try:
+        run_at, interval = parse_schedule(message.text or '')
+    except ValueError as e:
+        bot.reply_to(message, f"{EMOJI['error']} {str(e).capitalize()}. Задание не создано.")
+        return
+    if task_action == 'broadcast':
+        msg = bot.reply_to(message, f"{EMOJI['edit']} Введите текст сообщения для рассылки:")
+        bot.register_next_step_handler(msg, schedule_broadcast_text_step, params, run_at, interval)
+        return
+    add_scheduled_task(message, task_action, params, run_at, interval)
+
+def schedule_broadcast_text_step(message, params, run_at, interval):
+    text = (message.text or '').strip()
+    if not text:
+        bot.reply_to(message, f"{EMOJI['error']} Сообщение не может быть пустым.")
+        return
+    add_scheduled_task(message, 'broadcast', dict(params, text=text), run_at, interval)
+
+def add_scheduled_task(message, task_action, params, run_at, interval):
+    task = scheduler.add(task_action, params, run_at, interval, message.chat.id)
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("⏰ Расписание", callback_data="schedule"))
+    bot.reply_to(message, f"{EMOJI['success']} Задание {task['id']} запланировано: {describe_task(task)}", reply_markup=markup)
+    logger.info(f"Суперадминистратор {message.from_user.id} запланировал задание {task['id']} ({describe_task(task)})")
 
 def send_broadcast_step(message):
     broadcast_message = message.text.strip()
-    successful = 0
-    failed = 0
     
     progress_msg = bot.reply_to(message, f"{EMOJI['info']} Начинаем рассылку...")
-    
-    for user_id in users.keys():
-        try:
-            bot.send_message(user_id, f"{EMOJI['info']} Сообщение от администрации:\n\n{broadcast_message}")
-            successful += 1
-            if successful % 10 == 0:  # Обновляем прогресс каждые 10 успешных отправок
-                bot.edit_message_text(f"{EMOJI['info']} Отправлено: {successful}, Ошибок: {failed}", 
-                                      chat_id=message.chat.id, 
-                                      message_id=progress_msg.message_id)
-        except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {str(e)}")
-            failed += 1
+    reporter = ProgressReporter(message.chat.id, progress_msg.message_id)
+
+    def report_progress(stats):
+        reporter.update(f"{EMOJI['info']} Отправлено: {stats['sent']}, Ошибок: {stats['failed'] + stats['blocked']}")
+
+    engine = BroadcastEngine(lambda user_id: bot.send_message(user_id, f"{EMOJI['info']} Сообщение от администрации:\n\n{broadcast_message}"))
+    stats = engine.run([user_id for user_id in users.keys() if delivery_health.is_reachable(user_id)], report_progress)
+    successful, failed = stats['sent'], stats['failed'] + stats['blocked']
     
     report = f"{EMOJI['success']} Рассылка завершена:\n\n"
     report += f"Успешно отправлено: {successful}\n"
     report += f"Ошибок при отправке: {failed}"
     
-    bot.edit_message_text(report, chat_id=message.chat.id, message_id=progress_msg.message_id)
+    reporter.finish(report)
     logger.info(f"Суперадминистратор {message.from_user.id} завершил рассылку. Успешно: {successful}, Ошибок: {failed}")
     
     handle_super_admin(message)
@@ -3028,6 +7753,7 @@ def handle_all_messages(message):
     
     if is_user_blocked(user_id):
         return
+    delivery_health.mark_reachable(chat_id)
 
     if user_id not in users:
         users[user_id] = {
@@ -3042,9 +7768,10 @@ def handle_all_messages(message):
             'channels': [],
             'language': 'ru'
         }
-        save_data()
+        save_user(user_id)
 
-    users[user_id]['messages_count'] += 1
+    count_activity('users', user_id, 'messages_count')
+    count_user_activity(user_id)
 
     if message.chat.type in ['group', 'supergroup']:
         if chat_id not in chats:
@@ -3055,18 +7782,41 @@ def handle_all_messages(message):
                 'messages_count': 0,
                 'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
+            save_chat(chat_id)
         
-        if user_id not in chats[chat_id]['members']:
-            chats[chat_id]['members'].append(user_id)
+        if not membership.contains(chat_id, user_id):
+            add_chat_member(chat_id, user_id)
         
-        chats[chat_id]['messages_count'] += 1
+        count_activity('chats', chat_id, 'messages_count')
+        count_activity('chats', chat_id, 'member_messages', member_id=user_id)
+        message_authors.remember(chat_id, message.message_id, user_id, message.date)
 
-    save_data()
     logger.info(f"Получено сообщение от пользователя {user_id} в чате {chat_id}")
 
     if message.chat.type == 'private':
         safe_send_message(message.chat.id, get_localized_text('unknown_command', user_id))
 
+@bot.message_reaction_handler(func=lambda update: True)
+def handle_message_reaction(update):
+    """Реакция пользователя на сообщение в чате (приходит, если бот - администратор чата)"""
+    delta = len(update.new_reaction or []) - len(update.old_reaction or [])
+    if not delta:
+        return
+    author_id = message_authors.author(str(update.chat.id), update.message_id)
+    if author_id is None:
+        return  # сообщение старше кэша или написано до запуска бота
+    if update.user is not None and str(update.user.id) == author_id:
+        return  # реакции на свои сообщения не засчитываются
+    count_reactions(author_id, delta)
+
+@bot.message_reaction_count_handler(func=lambda update: True)
+def handle_message_reaction_count(update):
+    """Изменилось число анонимных реакций на сообщение: приходит общее число, а не изменение"""
+    total = sum(reaction.total_count for reaction in update.reactions or [])
+    change = message_authors.set_reaction_total(str(update.chat.id), update.message_id, total)
+    if change is not None and change[1]:
+        count_reactions(*change)
+
 @bot.message_handler(content_types=['new_chat_members'])
 def handle_new_chat_members(message):
     chat_id = str(message.chat.id)
@@ -3080,7 +7830,7 @@ def handle_new_chat_members(message):
         user_id = str(new_member.id)
         
         # Пропускаем бота
-        if new_member.is_bot and new_member.username == bot.get_me().username:
+        if new_member.is_bot and new_member.username == get_bot_user().username:
             continue
         
         # Добавляем пользователя в базу
@@ -3097,14 +7847,11 @@ def handle_new_chat_members(message):
                 'channels': [],
                 'language': 'ru'
             }
-        elif chat_id not in users[user_id]['chats']:
-            users[user_id]['chats'].append(chat_id)
+            save_user(user_id)
         
         # Добавляем пользователя в список участников чата
-        if user_id not in chats[chat_id]['members']:
-            chats[chat_id]['members'].append(user_id)
+        add_chat_member(chat_id, user_id)
     
-    save_data()
     logger.info(f"Новые участники добавлены в базу данных чата {chat_id}")
 
 # Добавляем команду для принудительного сканирования
@@ -3131,13 +7878,8 @@ def handle_left_chat_member(message):
     chat_id = str(message.chat.id)
     user_id = str(message.left_chat_member.id)
     
-    if chat_id in chats and user_id in chats[chat_id]['members']:
-        chats[chat_id]['members'].remove(user_id)
+    remove_chat_member(chat_id, user_id)
     
-    if user_id in users and chat_id in users[user_id]['chats']:
-        users[user_id]['chats'].remove(chat_id)
-    
-    save_data()
     logger.info(f"Участник {user_id} покинул чат {chat_id}")
 
 @bot.my_chat_member_handler()
@@ -3180,8 +7922,7 @@ def handle_my_chat_member(message):
         elif new_status in ['left', 'kicked']:
             # Обработка удаления бота из чата
             if chat_id in chats:
-                chats[chat_id]['is_active'] = False
-            save_data()
+                set_entity_field('chats', chat_id, 'is_active', False)
             
     except Exception as e:
         logger.error(f"Ошибка в обработчике my_chat_member: {e}")
@@ -3191,58 +7932,18 @@ def handle_my_chat_member(message):
 def handle_update_chats(message):
     """Обновление списка чатов и проверка прав бота"""
     try:
-        updated = 0
-        errors = 0
-        removed = 0
-        
-        # Создаем копию списка чатов для итерации
-        chats_to_check = list(chats.keys())
-        
         status_msg = bot.reply_to(message, f"{EMOJI['info']} Начинаю проверку чатов...")
-        
-        for chat_id in chats_to_check:
-            try:
-                # Проверяем наличие бота в чате и его права
-                chat_info = bot.get_chat(chat_id)
-                bot_member = bot.get_chat_member(chat_id, bot.get_me().id)
-                
-                # Обновляем информацию о чате
-                chats[chat_id].update({
-                    'title': chat_info.title,
-                    'type': chat_info.type,
-                    'is_active': True,
-                    'member_count': bot.get_chat_member_count(chat_id),
-                    'bot_rights': {
-                        'can_send_messages': getattr(bot_member, 'can_send_messages', None),
-                        'can_send_media_messages': getattr(bot_member, 'can_send_media_messages', None),
-                        'can_send_other_messages': getattr(bot_member, 'can_send_other_messages', None),
-                        'can_delete_messages': getattr(bot_member, 'can_delete_messages', None),
-                        'can_restrict_members': getattr(bot_member, 'can_restrict_members', None)
-                    }
-                })
-                updated += 1
-                
-            except Exception as e:
-                if "chat not found" in str(e) or "bot was kicked" in str(e):
-                    # Если бот был удален из чата, удаляем чат из базы
-                    del chats[chat_id]
-                    removed += 1
-                else:
-                    errors += 1
-                logger.error(f"Ошибка при проверке чата {chat_id}: {e}")
-        
-        save_data()
+        reporter = ProgressReporter(status_msg.chat.id, status_msg.message_id)
+        updated, errors, removed = verify_chats(
+            lambda done, total: reporter.update(f"{EMOJI['info']} Проверка чатов: {done} из {total}")
+        )
         
         report = f"{EMOJI['success']} Проверка чатов завершена:\n\n"
         report += f"✅ Обновлено: {updated}\n"
         report += f"❌ Ошибок: {errors}\n"
         report += f"🗑 Удалено: {removed}"
         
-        bot.edit_message_text(
-            report,
-            chat_id=status_msg.chat.id,
-            message_id=status_msg.message_id
-        )
+        reporter.finish(report)
         
     except Exception as e:
         bot.reply_to(
@@ -3250,6 +7951,55 @@ def handle_update_chats(message):
             f"{EMOJI['error']} Ошибка при обновлении списка чатов: {str(e)}"
         )
 
+def verify_chats(progress=None):
+    """Обновляет сведения о чатах и правах бота в них, удаляя чаты, из которых бот удалён.
+
+    progress(проверено, всего) вызывается после каждого чата. Возвращает (обновлено, ошибок, удалено).
+    """
+    updated = 0
+    errors = 0
+    removed = 0
+    
+    # Создаем копию списка чатов для итерации
+    chats_to_check = list(chats.keys())
+    
+    for chat_id in chats_to_check:
+        try:
+            # Проверяем наличие бота в чате и его права
+            chat_info = bot.get_chat(chat_id)
+            bot_member = bot.get_chat_member(chat_id, get_bot_user().id)
+            
+            # Обновляем информацию о чате
+            chats[chat_id].update({
+                'title': chat_info.title,
+                'type': chat_info.type,
+                'is_active': True,
+                'member_count': bot.get_chat_member_count(chat_id),
+                'bot_rights': {
+                    'can_send_messages': getattr(bot_member, 'can_send_messages', None),
+                    'can_send_media_messages': getattr(bot_member, 'can_send_media_messages', None),
+                    'can_send_other_messages': getattr(bot_member, 'can_send_other_messages', None),
+                    'can_delete_messages': getattr(bot_member, 'can_delete_messages', None),
+                    'can_restrict_members': getattr(bot_member, 'can_restrict_members', None)
+                }
+            })
+            save_chat(chat_id)
+            updated += 1
+            
+        except Exception as e:
+            if "chat not found" in str(e) or "bot was kicked" in str(e):
+                # Если бот был удален из чата, удаляем чат из базы
+                delete_chat(chat_id)
+                removed += 1
+            else:
+                errors += 1
+            logger.error(f"Ошибка при проверке чата {chat_id}: {e}")
+        if progress is not None:
+            progress(updated + errors + removed, len(chats_to_check))
+    
+    logger.info(f"Проверка чатов: обновлено {updated}, ошибок {errors}, удалено {removed}")
+    return updated, errors, removed
+
 # Улучшенное логирование
 class CustomFormatter(logging.Formatter):
     """Кастомный форматтер для красивого вывода логов"""
@@ -3420,7 +8170,8 @@ def handle_status(message):
         types.InlineKeyboardButton("Просмотр логов", callback_data="view_logs"),
         types.InlineKeyboardButton("Очистить логи", callback_data="clear_logs"),
         types.InlineKeyboardButton("Статистика БД", callback_data="db_stats"),
-        types.InlineKeyboardButton("Тест соединения", callback_data="test_connection")
+        types.InlineKeyboardButton("Тест соединения", callback_data="test_connection"),
+        types.InlineKeyboardButton("Экспорт JSON", callback_data="export_json")
     )
     
     bot.reply_to(message, status_text, reply_markup=markup)
@@ -3454,13 +8205,25 @@ def handle_test_connection(call):
 @super_admin_required
 def handle_db_stats(call):
     try:
-        db_size = os.path.getsize('data.json') / 1024  # размер в КБ
+        last_flush = data_store.last_flush_time
         
         stats_text = f"{EMOJI['stats']} Статистика базы данных:\n\n"
-        stats_text += f"Размер файла: {db_size:.1f} КБ\n"
-        stats_text += f"Пользователей: {len(users)}\n"
+        stats_text += f"Хранилище: {storage.name}\n"
+        for line in storage.stats_lines():
+            stats_text += line + "\n"
+        if data_loader is not None and not data_loader.done.is_set():
+            # len(users) ждал бы окончания загрузки
+            stats_text += f"Пользователей: {dict.__len__(users)} (загрузка: {data_loader.progress_text()})\n"
+        else:
+            stats_text += f"Пользователей: {len(users)}\n"
         stats_text += f"Чатов: {len(chats)}\n"
         stats_text += f"Каналов: {len(channels)}\n"
+        stats_text += f"Несохранённых изменений: {storage.pending_count()}\n"
+        stats_text += f"Несведённых счётчиков: {activity_counters.pending_count()}\n"
+        stats_text += f"Сведено приращений: {activity_counters.merged_increments} в {activity_counters.merged_records} записей\n"
+        stats_text += f"Сообщений в кэше авторов: {len(message_authors)}\n"
+        stats_text += f"Недоступных получателей: {delivery_health.unreachable_count()}\n"
+        stats_text += f"Последнее сохранение: {last_flush.strftime('%Y-%m-%d %H:%M:%S') if last_flush else 'Нет'}\n"
         
         bot.edit_message_text(
             stats_text,
@@ -3474,6 +8237,22 @@ def handle_db_stats(call):
             f"{EMOJI['error']} Ошибка при получении статистики: {str(e)}"
         )
 
+@bot.callback_query_handler(func=lambda call: call.data == "export_json")
+@super_admin_required
+def handle_export_json(call):
+    try:
+        bot.answer_callback_query(call.id, "Выгрузка данных...")
+        path = export_json(f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        try:
+            with open(path, 'rb') as export_file:
+                bot.send_document(call.message.chat.id, export_file, caption=f"{EMOJI['success']} Выгрузка данных")
+        finally:
+            os.remove(path)
+        logger.info(f"Суперадминистратор {call.from_user.id} выгрузил данные в JSON")
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке данных: {str(e)}")
+        bot.send_message(call.message.chat.id, f"{EMOJI['error']} Ошибка при выгрузке данных: {str(e)}")
+
 @bot.callback_query_handler(func=lambda call: call.data == "clear_logs")
 @super_admin_required
 def handle_clear_logs(call):
@@ -3593,13 +8372,39 @@ def run_bot_safely():
     
     try:
         logger.info(f"{EMOJI['rocket']} Бот запускается...")
-        load_data()
+        # Опрос начинается сразу после загрузки чатов и каналов, пользователи догружаются в фоне
+        try:
+            bot_user = get_bot_user()
+            logger.info(f"Бот @{bot_user.username} (ID {bot_user.id})")
+        except Exception as e:
+            # Повторный запрос будет при первом обращении к get_bot_user
+            logger.warning(f"Не удалось получить сведения о боте: {str(e)}")
+        delivery_health.load()
+        load_data(background=True)
+        leaderboard.build_async()
+        window_ratings.build_async()
+        active_users.build_async()
+        channel_users.build_async()
+        search_index.build_async()
+        audience_segments.build_async()
+        data_store.start()
+        activity_counters.start()
+        delivery_store.start()
+        resume_broadcast_jobs()
+        scheduler.load()
+        schedule_store.start()
+        scheduler.start()
         
         def shutdown_handler(signum=None, frame=None):
             """Обработчик сигналов завершения"""
             logger.info(f"{EMOJI['info']} Получен сигнал завершения. Корректное завершение работы...")
             try:
-                save_data()
+                scheduler.stop()
+                schedule_store.stop()
+                broadcast_jobs.stop()
+                delivery_store.stop()
+                activity_counters.stop()
+                data_store.stop()
                 guard.release()
             finally:
                 sys.exit(0)
@@ -3612,7 +8417,7 @@ def run_bot_safely():
         except Exception as e:
             logger.warning(f"Не удалось установить обработчики сигналов: {e}")
         
-        bot.infinity_polling(timeout=60, long_polling_timeout=60)
+        bot.infinity_polling(timeout=60, long_polling_timeout=60, allowed_updates=ALLOWED_UPDATES)
         
     except Exception as e:
         logger.error(f"{EMOJI['error']} Критическая ошибка при работе бота: {str(e)}")
@@ -3626,7 +8431,24 @@ def run_bot_safely():
         raise
         
     finally:
+        scheduler.stop()
+        schedule_store.stop()
+        broadcast_jobs.stop()
+        delivery_store.stop()
+        activity_counters.stop()
+        data_store.stop()
+        if storage is not None:
+            storage.close()
         guard.release()
 
 if __name__ == "__main__":
-    run_bot_safely()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == '--import-json':
+        # Однократный перенос: python main4.py --import-json [data.json] [data.db]
+        import_json_to_sqlite(*sys.argv[2:4])
+    elif len(sys.argv) > 1 and sys.argv[1] == '--export-json':
+        # Читаемая выгрузка: python main4.py --export-json [export.json]
+        load_data()
+        export_json(sys.argv[2] if len(sys.argv) > 2 else 'export.json')
+        storage.close()
+    else:
+        run_bot_safely()
\ No newline at end of file
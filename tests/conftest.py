@@ -0,0 +1,81 @@
+"""Общие фикстуры тестов.
+
+main4 при импорте создаёт бота (токен - из BOT_TOKEN, здесь заглушка) и файл
+журнала bot.log в текущем каталоге, поэтому модуль импортируется во временном каталоге.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+
+@pytest.fixture(scope='session')
+def main4(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('import'))
+    try:
+        import main4
+    finally:
+        os.chdir(cwd)
+    return main4
+
+
+@pytest.fixture
+def open_storage(main4, tmp_path, monkeypatch):
+    """Открывает хранилище в tmp_path и загружает из него данные, как при запуске бота.
+
+    Принимает фабрику хранилища (по умолчанию - JsonStorage с путями по умолчанию)
+    и возвращает открытое хранилище; повторный вызов закрывает прежнее.
+    """
+    monkeypatch.chdir(tmp_path)
+
+    def close():
+        storage = main4.storage
+        if storage is None:
+            return
+        thread = getattr(storage, '_compact_thread', None)
+        if thread is not None:
+            thread.join()
+        storage.close()
+        main4.storage = None
+
+    def open_(factory=None):
+        close()
+        main4.storage = factory() if factory else main4.JsonStorage()
+        main4.load_data()
+        return main4.storage
+
+    yield open_
+    close()
+
+
+def new_user(user_id, messages_count=0, reactions_received=0, first_name='Имя', **fields):
+    """Словарь пользователя в том виде, в каком его создают обработчики бота"""
+    return {'id': user_id, 'first_name': first_name, 'last_name': None, 'username': None,
+            'joined_at': '2024-01-01 00:00:00', 'messages_count': messages_count,
+            'reactions_received': reactions_received, 'chats': [], 'channels': [], 'language': 'ru', **fields}
+
+
+@pytest.fixture
+def user():
+    return new_user
+
+
+@pytest.fixture
+def snapshot(main4):
+    """Данные в памяти в виде обычных словарей; списки id отсортированы, так как их порядок не хранится"""
+    def take():
+        result = {}
+        for store_name, store in (('users', main4.users), ('chats', main4.chats), ('channels', main4.channels)):
+            result[store_name] = {}
+            for entity_id, record in store.items():
+                entity = record.to_dict()
+                for field, value in entity.items():
+                    if isinstance(value, list):
+                        entity[field] = sorted(value)
+                result[store_name][entity_id] = entity
+        return result
+    return take
@@ -0,0 +1,77 @@
+"""Счётчики активности: дельты из многих потоков сливаются без потерь и повторов."""
+import collections
+import random
+import threading
+
+
+def test_counters_from_many_threads_merge_exactly(main4):
+    applied = collections.Counter()
+    counters = main4.ActivityCounters(lambda store_name, entity_id, field, delta, member_id:
+                                      applied.update({(entity_id, field, member_id): delta}), stripes=4)
+    expected = collections.Counter()
+    expected_lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        local = collections.Counter()
+        for _ in range(3000):
+            key = (str(rnd.randrange(20)), rnd.choice(['messages_count', 'member_messages']), rnd.choice([None, '7']))
+            delta = rnd.choice([1, 1, 2, -1])
+            counters.add('users', *key[:2], delta, key[2])
+            local[key] += delta
+        with expected_lock:
+            expected.update(local)
+
+    def merger():
+        while not stop.is_set():
+            counters.merge()
+
+    merge_thread = threading.Thread(target=merger)
+    merge_thread.start()
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    stop.set()
+    merge_thread.join()
+    counters.merge()
+    assert counters.pending_count() == 0
+    assert counters.merged_increments == 8 * 3000
+    # Нулевые суммы не применяются, поэтому ключей с нулём может не быть
+    assert {key: delta for key, delta in applied.items() if delta} == {key: delta for key, delta in expected.items() if delta}
+
+
+def test_failed_merge_keeps_deltas(main4):
+    applied = collections.Counter()
+    failures = [2]
+
+    def apply(store_name, entity_id, field, delta, member_id):
+        if failures[0]:
+            failures[0] -= 1
+            raise OSError("диск недоступен")
+        applied[entity_id] += delta
+
+    counters = main4.ActivityCounters(apply)
+    for entity_id in ('1', '2', '3'):
+        counters.add('users', entity_id, 'messages_count', int(entity_id))
+    assert counters.merge() == 0
+    counters.add('users', '1', 'messages_count', 10)
+    counters.merge()
+    counters.merge()
+    assert applied == {'1': 11, '2': 2, '3': 3}
+    assert counters.pending_count() == 0
+
+
+def test_rating_override_includes_pending_counts(main4, open_storage, user):
+    open_storage()
+    main4.users['1'] = user('1', messages_count=3, reactions_received=1)
+    main4.users['2'] = user('2', messages_count=50)
+    for _ in range(7):
+        main4.count_activity('users', '1', 'messages_count')
+    assert main4.set_user_rating('1', 100) == 3 + 7 + 2
+    main4.activity_counters.merge()
+    assert main4.calculate_rating(main4.users['1']) == 100
+    assert [record.id for record in main4.leaderboard.top(2)] == ['1', '2']
+    assert main4.set_user_rating('missing', 5) is None
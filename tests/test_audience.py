@@ -0,0 +1,83 @@
+"""Сегменты аудитории рассылки: выборка по условиям против прямого фильтра."""
+import random
+
+import pytest
+
+
+def matches(main4, user_id, selection, hour):
+    record = main4.users[user_id]
+    for name, value in selection.items():
+        if name == 'active':
+            activity = record.get('activity')
+            start = hour - main4.RATING_WINDOWS[value] + 1
+            if not (activity and activity.points_since(start) > 0):
+                return False
+        elif name == 'chat':
+            if value not in record['chats']:
+                return False
+        elif main4.AUDIENCE_DIMENSIONS[name][1](record) != value:
+            return False
+    return True
+
+
+def random_selection(main4, rnd):
+    tiers = [main4.get_rank_emoji(rating) for rating in (0, 10, 100, 1000, 10000)]
+    options = {
+        'language': ['ru', 'en', 'uk'],
+        'tier': tiers,
+        'notifications': [True, False],
+        'active': list(main4.RATING_WINDOWS),
+        'chat': ['-1000', '-1001'],
+    }
+    names = rnd.sample(sorted(options), rnd.randrange(1, 4))
+    return {name: rnd.choice(options[name]) for name in names}
+
+
+@pytest.mark.parametrize('build_first', [True, False])
+def test_audience_select_matches_filter(main4, open_storage, monkeypatch, user, build_first):
+    rnd = random.Random(11)
+    hour = [600000]
+    monkeypatch.setattr(main4, 'current_hour', lambda: hour[0])
+    open_storage()
+    user_ids = [str(4000 + i) for i in range(120)]
+    for user_id in user_ids:
+        main4.users[user_id] = user(user_id, rnd.randrange(300), language=rnd.choice(['ru', 'ru', 'en', 'uk']))
+    if build_first:
+        main4.audience_segments.count({})
+
+    def check():
+        main4.activity_counters.merge()
+        for _ in range(20):
+            selection = random_selection(main4, rnd)
+            expected = {user_id for user_id in main4.users if matches(main4, user_id, selection, hour[0])}
+            assert set(main4.audience_segments.select(selection)) == expected, selection
+            assert main4.audience_segments.count(selection) == len(expected), selection
+
+    for step in range(400):
+        user_id = rnd.choice(user_ids)
+        action = rnd.random()
+        if user_id not in main4.users:
+            main4.users[user_id] = user(user_id, language='en')
+        elif action < 0.25:
+            main4.increment_counter('users', user_id, 'messages_count', rnd.choice([1, 10, 100]))
+        elif action < 0.4:
+            main4.count_user_activity(user_id)
+        elif action < 0.5:
+            main4.set_entity_field('users', user_id, 'language', rnd.choice(['ru', 'en', 'uk']))
+        elif action < 0.6:
+            main4.set_entity_field('users', user_id, 'notifications', rnd.random() < 0.5)
+        elif action < 0.7:
+            main4.add_chat_member(rnd.choice(['-1000', '-1001']), user_id)
+        elif action < 0.75:
+            main4.remove_chat_member(rnd.choice(['-1000', '-1001']), user_id)
+        elif action < 0.8:
+            main4.set_user_rating(user_id, rnd.randrange(2000))
+        elif action < 0.9:
+            # Замена записи с тем же id
+            main4.users[user_id] = user(user_id, rnd.randrange(50), language='uk')
+        else:
+            del main4.users[user_id]
+        if step % 40 == 0:
+            hour[0] += rnd.choice([0, 1, 30, 200])
+            check()
+    check()
@@ -0,0 +1,144 @@
+"""Задания рассылки: продолжение после перезапуска и пауза или отмена без повторных отправок."""
+import collections
+import functools
+import json
+import os
+import threading
+
+import pytest
+
+
+class FakeSend:
+    """Замена BroadcastJob._send: считает отправки и по желанию вызывает hook(job, id получателя) перед ними"""
+
+    def __init__(self):
+        self.sent = collections.Counter()
+        self.hook = None
+        self._lock = threading.Lock()
+
+    def __call__(self, job, recipient_id):
+        if self.hook is not None:
+            self.hook(job, recipient_id)
+        with self._lock:
+            self.sent[(job.id, recipient_id)] += 1
+
+    def recipients(self, job_id):
+        return {recipient_id for sent_job_id, recipient_id in self.sent if sent_job_id == job_id}
+
+
+@pytest.fixture
+def send(main4, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    fake = FakeSend()
+    monkeypatch.setattr(main4.BroadcastJob, '_send', lambda job, recipient_id: fake(job, recipient_id))
+    # Без ограничения частоты: тест проверяет состояние заданий, а не лимиты Telegram
+    monkeypatch.setattr(main4, 'BroadcastEngine', functools.partial(main4.BroadcastEngine, rate=100000, workers=4))
+    monkeypatch.setattr(main4, 'report_broadcast_progress', lambda job, force=False, wait=True: None)
+    return fake
+
+
+def recipients(first, count):
+    return [str(first + i) for i in range(count)]
+
+
+def wait_idle(jobs):
+    thread = jobs._thread
+    if thread is not None:
+        thread.join(10)
+        assert not thread.is_alive()
+
+
+def read_job(job):
+    with open(job._path('json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('lost_checkpoint', [False, True])
+def test_job_resumes_after_restart_without_resending(main4, send, lost_checkpoint):
+    jobs = main4.BroadcastJobs('broadcasts')
+
+    def stop_midway(job, recipient_id):
+        # Выключение бота после 60 отправок: задание остаётся в состоянии running
+        if len(send.sent) == 60:
+            job.stop()
+
+    send.hook = stop_midway
+    job = jobs.create('all_users', 'text', 'Привет', recipients(1000, 200), 1, 2)
+    created = read_job(job)
+    wait_idle(jobs)
+    first_run = send.recipients(job.id)
+    assert 60 <= len(first_run) < 200
+    saved = read_job(job)
+    assert saved['status'] == 'running'
+    assert saved['cursor'] <= len(first_run)
+    if lost_checkpoint:
+        # Процесс упал до сохранения хода: курсор на диске - с момента создания, уцелел только журнал доставки
+        with open(job._path('json'), 'w', encoding='utf-8') as f:
+            json.dump(created, f)
+
+    send.hook = None
+    restarted = main4.BroadcastJobs('broadcasts')
+    resumed = restarted.load()
+    assert [resumed_job.id for resumed_job in resumed] == [job.id]
+    wait_idle(restarted)
+    assert set(send.sent.values()) == {1}
+    assert send.recipients(job.id) == set(recipients(1000, 200))
+    assert resumed[0].status == 'done'
+    assert resumed[0].stats['sent'] == 200
+    assert not os.listdir('broadcasts')
+
+
+def test_pause_and_cancel_current_and_queued_jobs(main4, send):
+    jobs = main4.BroadcastJobs('broadcasts')
+    gate = threading.Event()
+    blocked = threading.Event()
+
+    def hold_first(job, recipient_id):
+        if job.id == first.id and not gate.is_set():
+            blocked.set()
+            gate.wait(10)
+
+    send.hook = hold_first
+    first = jobs.create('all_users', 'text', 'Первая', recipients(1000, 100), 1, 2)
+    second = jobs.create('chats', 'text', 'Вторая', recipients(2000, 50), 1, 3)
+    third = jobs.create('channels', 'text', 'Третья', recipients(3000, 50), 1, 4)
+    assert blocked.wait(10)
+    assert jobs.current is first
+
+    # Задания в очереди: пауза сохраняется на диск, отмена сразу удаляет файлы
+    assert jobs.pause(second.id) is second
+    assert read_job(second)['status'] == 'paused'
+    assert jobs.cancel(third.id) is third
+    assert third.id not in jobs.jobs and not os.path.exists(third._path('json'))
+    assert jobs.pause(second.id) is None
+
+    # Текущее задание: пауза останавливает его, ход сохраняется
+    assert jobs.pause(first.id) is first
+    gate.set()
+    wait_idle(jobs)
+    paused = read_job(first)
+    assert paused['status'] == 'paused'
+    assert paused['cursor'] <= len(send.recipients(first.id)) < 100
+    assert not send.recipients(second.id) and not send.recipients(third.id)
+    # После перезапуска приостановленные задания не продолжаются сами
+    assert main4.BroadcastJobs('broadcasts').load() == []
+
+    # Продолженное задание досылает только оставшимся
+    assert jobs.resume(first.id) is first
+    wait_idle(jobs)
+    assert first.status == 'done' and first.id not in jobs.jobs
+    assert send.recipients(first.id) == set(recipients(1000, 100))
+
+    # Отмена текущего задания: файлы удаляются, оставшимся сообщение не уходит
+    gate.clear()
+    blocked.clear()
+    first = second
+    assert jobs.resume(second.id) is second
+    assert blocked.wait(10)
+    assert jobs.cancel(second.id) is second
+    gate.set()
+    wait_idle(jobs)
+    assert second.status == 'cancelled' and second.id not in jobs.jobs
+    assert len(send.recipients(second.id)) < 50
+    assert not os.listdir('broadcasts')
+    assert set(send.sent.values()) == {1}
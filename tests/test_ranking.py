@@ -0,0 +1,92 @@
+"""Рейтинги: SortedRanking и leaderboard (RecordOrder) против прямого пересчёта."""
+import random
+
+import pytest
+
+
+@pytest.mark.parametrize('descending', [True, False])
+def test_sorted_ranking_matches_sorting(main4, descending):
+    rnd = random.Random(1)
+    ranking = main4.SortedRanking(block_size=4, descending=descending)
+    # Модель: id -> (очки, порядковый номер первого добавления)
+    model = {}
+    seq = 0
+    initial = [(str(i), rnd.randrange(20), f"item{i}") for i in range(30)]
+    ranking.load(initial)
+    for item_id, score, _ in initial:
+        model[item_id] = (score, seq)
+        seq += 1
+    for step in range(2000):
+        item_id = str(rnd.randrange(60))
+        if rnd.random() < 0.2:
+            assert ranking.discard(item_id) == (item_id in model)
+            model.pop(item_id, None)
+        else:
+            score = rnd.randrange(20)
+            ranking.set(item_id, score, f"item{item_id}")
+            if item_id in model:
+                model[item_id] = (score, model[item_id][1])
+            else:
+                model[item_id] = (score, seq)
+                seq += 1
+        if step % 50:
+            continue
+        expected = sorted(model, key=lambda i: ((-1 if descending else 1) * model[i][0], model[i][1]))
+        assert len(ranking) == len(expected)
+        assert [item for item, _ in ranking.page(0, len(expected) + 5)] == [f"item{i}" for i in expected]
+        assert [score for _, score in ranking.top(5)] == [model[i][0] for i in expected[:5]]
+        offset = rnd.randrange(len(expected) + 1)
+        assert [item for item, _ in ranking.page(offset, 7)] == [f"item{i}" for i in expected[offset:offset + 7]]
+        for place, item_id in enumerate(expected, 1):
+            assert ranking.rank(item_id) == place
+        assert ranking.rank('missing') is None
+
+
+def check_leaderboard(main4):
+    """Порядок leaderboard совпадает с сортировкой пользователей по calculate_rating"""
+    page = main4.leaderboard.page(0, len(main4.users) + 1)
+    ratings = [main4.calculate_rating(record) for record in page]
+    assert ratings == sorted(ratings, reverse=True)
+    assert sorted(record.id for record in page) == sorted(main4.users)
+    assert len(main4.leaderboard) == len(main4.users)
+    for record in page:
+        assert main4.users[record.id] is record
+    for place, record in enumerate(page, 1):
+        assert main4.leaderboard.rank(record.id) == place
+    expected_top = sorted((main4.calculate_rating(u) for u in main4.users.values()), reverse=True)[:10]
+    assert [main4.calculate_rating(u) for u in main4.get_top_users(10)] == expected_top
+
+
+def test_leaderboard_follows_rating_changes(main4, open_storage, user):
+    rnd = random.Random(2)
+    open_storage()
+    for i in range(200):
+        main4.users[str(1000 + i)] = user(str(1000 + i), rnd.randrange(50), rnd.randrange(10))
+    check_leaderboard(main4)
+    for step in range(1500):
+        user_id = str(1000 + rnd.randrange(250))
+        action = rnd.random()
+        if user_id not in main4.users:
+            main4.users[user_id] = user(user_id, rnd.randrange(50))
+            main4.save_user(user_id)
+        elif action < 0.4:
+            main4.increment_counter('users', user_id, 'messages_count', rnd.randrange(1, 5))
+        elif action < 0.6:
+            main4.count_activity('users', user_id, 'messages_count')
+            main4.count_reactions(user_id, rnd.choice([1, 1, -1]))
+        elif action < 0.7:
+            main4.set_user_rating(user_id, rnd.randrange(100))
+        elif action < 0.8:
+            main4.set_entity_field('users', user_id, 'reactions_received', rnd.randrange(10))
+        elif action < 0.9:
+            # Замена записи с тем же id
+            main4.users[user_id] = user(user_id, rnd.randrange(50))
+            main4.save_user(user_id)
+        else:
+            del main4.users[user_id]
+            main4.save_user(user_id)
+        if step % 100 == 0:
+            main4.activity_counters.merge()
+            check_leaderboard(main4)
+    main4.activity_counters.merge()
+    check_leaderboard(main4)
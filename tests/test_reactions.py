@@ -0,0 +1,96 @@
+"""Реакции: кэш авторов сообщений, зачёт изменений в рейтинг и запрос нужных обновлений у Telegram."""
+import time
+from types import SimpleNamespace
+
+
+def test_author_cache_drops_oldest_quarter_when_chat_overflows(main4):
+    cache = main4.MessageAuthorCache(per_chat=8, max_chats=10, ttl=3600)
+    now = int(time.time())
+    for message_id in range(1, 9):
+        cache.remember('-1', message_id, 100 + message_id, now)
+    assert len(cache) == 8
+    cache.remember('-1', 9, 109, now)
+    # Остаются три четверти последних сообщений
+    assert len(cache) == 6
+    assert [cache.author('-1', message_id) for message_id in range(1, 10)] == [None] * 3 + [str(100 + i) for i in range(4, 10)]
+
+
+def test_author_cache_orders_messages_and_ignores_repeats(main4):
+    cache = main4.MessageAuthorCache(per_chat=100, ttl=3600)
+    now = int(time.time())
+    for message_id, author_id in ((5, 1), (3, 2), (9, 3), (3, 4), (7, 5)):
+        cache.remember('-1', message_id, author_id, now)
+    assert len(cache) == 4
+    assert [cache.author('-1', message_id) for message_id in (3, 5, 7, 9, 4)] == ['2', '1', '5', '3', None]
+
+
+def test_author_cache_forgets_expired_messages(main4):
+    cache = main4.MessageAuthorCache(per_chat=100, ttl=600)
+    now = int(time.time())
+    cache.remember('-1', 1, 11, now - 900)
+    cache.remember('-1', 2, 12, now - 300)
+    # Сообщение старше ttl не засчитывается, даже пока лежит в массивах
+    assert cache.author('-1', 1) is None
+    assert cache.author('-1', 2) == '12'
+    cache.remember('-1', 3, 13, now)
+    assert len(cache) == 2
+
+
+def test_author_cache_evicts_least_recently_active_chat(main4):
+    cache = main4.MessageAuthorCache(per_chat=100, max_chats=2, ttl=3600)
+    now = int(time.time())
+    cache.remember('-1', 1, 11, now)
+    cache.remember('-2', 1, 21, now)
+    cache.remember('-1', 2, 12, now)
+    cache.remember('-3', 1, 31, now)
+    assert cache.author('-2', 1) is None
+    assert (cache.author('-1', 1), cache.author('-3', 1)) == ('11', '31')
+
+
+def test_reaction_total_changes_become_deltas(main4):
+    cache = main4.MessageAuthorCache(ttl=3600)
+    cache.remember('-1', 10, 42, int(time.time()))
+    assert cache.set_reaction_total('-1', 10, 3) == ('42', 3)
+    assert cache.set_reaction_total('-1', 10, 5) == ('42', 2)
+    assert cache.set_reaction_total('-1', 10, 5) == ('42', 0)
+    assert cache.set_reaction_total('-1', 10, 1) == ('42', -4)
+    assert cache.set_reaction_total('-1', 11, 1) is None
+    assert cache.set_reaction_total('-2', 10, 1) is None
+
+
+def reaction(chat_id, message_id, user_id, old, new):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=message_id,
+                           user=SimpleNamespace(id=user_id) if user_id else None,
+                           old_reaction=['👍'] * old, new_reaction=['👍'] * new)
+
+
+def reaction_count(chat_id, message_id, *counts):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=message_id,
+                           reactions=[SimpleNamespace(total_count=count) for count in counts])
+
+
+def test_reactions_feed_the_rating(main4, open_storage, monkeypatch, user):
+    open_storage()
+    monkeypatch.setattr(main4, 'message_authors', main4.MessageAuthorCache(ttl=3600))
+    main4.users['1'] = user('1', messages_count=4)
+    main4.message_authors.remember('-100', 7, 1, int(time.time()))
+
+    main4.handle_message_reaction(reaction(-100, 7, 2, 0, 2))
+    main4.handle_message_reaction(reaction(-100, 7, 3, 1, 0))
+    # Реакция автора на своё сообщение и реакция на неизвестное сообщение не засчитываются
+    main4.handle_message_reaction(reaction(-100, 7, 1, 0, 1))
+    main4.handle_message_reaction(reaction(-100, 8, 2, 0, 1))
+    main4.handle_message_reaction_count(reaction_count(-100, 7, 2, 1))
+    main4.handle_message_reaction_count(reaction_count(-100, 7, 2))
+    main4.activity_counters.merge()
+    assert main4.users['1']['reactions_received'] == 2 - 1 + 3 - 1
+    assert main4.calculate_rating(main4.users['1']) == 4 + 2 * 3
+
+
+def test_every_handled_update_type_is_requested(main4):
+    # Обработчики inline-режима называются не так, как типы обновлений
+    update_types = {'inline': 'inline_query', 'chosen_inline': 'chosen_inline_result'}
+    for name, handlers in vars(main4.bot).items():
+        if name.endswith('_handlers') and isinstance(handlers, list) and handlers:
+            update_type = name[:-len('_handlers')]
+            assert update_types.get(update_type, update_type) in main4.ALLOWED_UPDATES, name
@@ -0,0 +1,94 @@
+"""Планировщик: разбор расписания, следующий запуск повторяющихся заданий и перезагрузка."""
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def test_parse_schedule_relative_and_daily(main4):
+    now = datetime.now().timestamp()
+    run_at, interval = main4.parse_schedule('через 30 мин')
+    assert interval is None and now + 1800 <= run_at <= now + 1810
+    run_at, interval = main4.parse_schedule('  Каждые  6 ч ')
+    assert interval == 6 * 3600 and now + interval <= run_at <= now + interval + 10
+    # Время суток - ближайшее в будущем
+    run_at, interval = main4.parse_schedule('09:00 каждые 1 д')
+    assert interval == 86400 and now < run_at <= now + 86400
+    moment = datetime.fromtimestamp(run_at)
+    assert (moment.hour, moment.minute, moment.second) == (9, 0, 0)
+
+
+def test_parse_schedule_absolute_date(main4):
+    moment = (datetime.now() + timedelta(days=3)).replace(second=0, microsecond=0)
+    text = moment.strftime('%Y-%m-%d %H:%M')
+    assert main4.parse_schedule(text) == (moment.timestamp(), None)
+    assert main4.parse_schedule(f"{text} каждые 2 ч") == (moment.timestamp(), 7200)
+
+
+@pytest.mark.parametrize('text', [
+    '2020-01-01 09:00',
+    (datetime.now() - timedelta(minutes=1)).strftime('%Y-%m-%d %H:%M'),
+    '2020-01-01 09:00 каждые 1 д',
+    'каждые 0 мин',
+    '2025-13-45 09:00',
+    'завтра',
+    '',
+])
+def test_parse_schedule_rejects(main4, text):
+    with pytest.raises(ValueError):
+        main4.parse_schedule(text)
+
+
+def next_due(scheduler):
+    with scheduler._condition:
+        return scheduler._next_due()
+
+
+def test_recurring_task_moves_to_next_grid_point(main4, monkeypatch, tmp_path):
+    now = [1_000_000.0]
+    monkeypatch.setattr(main4.time, 'time', lambda: now[0])
+    scheduler = main4.Scheduler(str(tmp_path / 'schedule.json'))
+    hourly = scheduler.add('channel_stats', {}, now[0] + 60, interval=3600)
+    once = scheduler.add('check_chats', {}, now[0] + 120)
+    cancelled = scheduler.add('check_chats', {}, now[0] + 30)
+    scheduler.cancel(cancelled['id'])
+
+    task, delay = next_due(scheduler)
+    assert task is None and delay == 60
+    # Бот не работал три с лишним часа: задание выполняется один раз, пропущенные запуски не наверстываются
+    now[0] += 60 + 3 * 3600 + 5
+    task, delay = next_due(scheduler)
+    assert task is hourly and task['run_at'] == 1_000_000 + 60 + 4 * 3600
+    task, delay = next_due(scheduler)
+    assert task is once and once['id'] not in scheduler.tasks
+    task, delay = next_due(scheduler)
+    assert task is None and delay == 3600 - 5
+    now[0] += delay
+    task, _ = next_due(scheduler)
+    assert task is hourly and task['run_at'] == 1_000_000 + 60 + 5 * 3600
+    assert next_due(scheduler) == (None, 3600)
+
+
+def test_scheduler_reload(main4, monkeypatch, tmp_path):
+    now = [2_000_000.0]
+    monkeypatch.setattr(main4.time, 'time', lambda: now[0])
+    path = str(tmp_path / 'schedule.json')
+    scheduler = main4.Scheduler(path)
+    daily = scheduler.add('broadcast', {'broadcast_type': 'users', 'text': 'Привет'}, now[0] + 500, 86400, chat_id=1)
+    once = scheduler.add('check_chats', {}, now[0] + 100)
+    removed = scheduler.add('channel_stats', {}, now[0] + 50)
+    scheduler.cancel(removed['id'])
+    assert scheduler.save()
+
+    # Перезапуск на час позже: пропущенный запуск выполняется сразу, один раз
+    now[0] += 3600
+    reloaded = main4.Scheduler(path)
+    reloaded.load()
+    assert reloaded.tasks == {daily['id']: daily, once['id']: once}
+    assert [task['id'] for task in reloaded.upcoming(0, 10)] == [once['id'], daily['id']]
+    assert next_due(reloaded)[0]['id'] == once['id']
+    task, _ = next_due(reloaded)
+    assert task['id'] == daily['id'] and task['run_at'] == 2_000_000 + 500 + 86400
+    assert next_due(reloaded) == (None, 86400 + 500 - 3600)
+    # Номера новых заданий не совпадают с сохранёнными
+    assert reloaded.add('check_chats', {}, now[0] + 10)['id'] not in (daily['id'], once['id'])
+    assert len(reloaded) == 2
@@ -0,0 +1,62 @@
+"""Поиск администратора: SearchIndex против прямого прохода по записям."""
+import random
+
+
+def normalized_contains(main4, record, fields, query):
+    return any(isinstance(record.get(field), str) and query in main4.normalize_search_text(record[field])
+               for field in fields)
+
+
+def expected_search(main4, query):
+    """Прямой проход: начало поля без учёта регистра или подстрока нормализованного имени"""
+    index = main4.search_index
+    query = query.strip()
+    fields = index.prefix_fields
+    if query.startswith('@'):
+        query, fields = query[1:], ('username',)
+    if not query:
+        return set()
+    substring = main4.normalize_search_text(query) if fields is index.prefix_fields else ''
+    found = set()
+    for record in main4.users.values():
+        if any(isinstance(record.get(field), str) and record[field].lower().startswith(query.lower())
+               for field in fields):
+            found.add(record.id)
+        elif len(substring) >= 3 and normalized_contains(main4, record, index.substring_fields, substring):
+            found.add(record.id)
+    return found
+
+
+def test_search_index_matches_linear_search(main4, open_storage, user):
+    rnd = random.Random(4)
+    first_names = ['Алёна', 'Алена', 'Александр', 'Иван', 'Ivan', 'Мария', 'Цветана', 'Kate', 'Алексей', 'Alexey']
+    last_names = ['Иванов', 'Цветкова', 'Tsvetkova', 'Smith', 'Хабибуллин', None]
+    open_storage()
+
+    def random_user(user_id):
+        record = user(user_id, first_name=rnd.choice(first_names))
+        record['last_name'] = rnd.choice(last_names)
+        record['username'] = rnd.choice([None, f"user_{user_id}", f"Ivan{user_id}"])
+        return record
+
+    for i in range(300):
+        main4.users[str(3000 + i)] = random_user(str(3000 + i))
+    queries = ['ал', 'Алё', 'алена', 'ivan', 'иван', 'tsvet', 'цвет', 'user_30', '@ivan3', '@user', 'smi', 'бул',
+               'lexe', '30', 'zzz', '@', ' ']
+    for step in range(6):
+        for query in queries:
+            assert {record.id for record in main4.search_index.search(query)} == expected_search(main4, query), query
+        for _ in range(60):
+            user_id = str(3000 + rnd.randrange(320))
+            if user_id not in main4.users:
+                main4.users[user_id] = random_user(user_id)
+            elif rnd.random() < 0.2:
+                del main4.users[user_id]
+            else:
+                field = rnd.choice(['first_name', 'last_name', 'username'])
+                value = random_user(user_id)[field]
+                main4.set_entity_field('users', user_id, field, value)
+    # Точный поиск по username - без учёта регистра и только среди текущих записей
+    usernames = {record['username'] for record in main4.users.values() if record.get('username')}
+    found = main4.search_index.lookup('username', [name.upper() for name in usernames] + ['nobody'])
+    assert {name: record['username'] for name, record in found.items()} == {name.lower(): name for name in usernames}
@@ -0,0 +1,183 @@
+"""Хранилища: после перезапуска данные совпадают с тем, что было в памяти."""
+import os
+import random
+import threading
+
+import pytest
+
+
+def mutate(main4, rnd, steps):
+    """Случайные изменения через те же функции, что используют обработчики бота"""
+    for _ in range(steps):
+        user_id = str(100 + rnd.randrange(80))
+        chat_id = str(-1000 - rnd.randrange(6))
+        channel_id = str(-2000 - rnd.randrange(4))
+        action = rnd.random()
+        if channel_id not in main4.channels:
+            main4.channels[channel_id] = {'id': channel_id, 'title': f"Канал {channel_id}", 'username': None,
+                                          'posts_count': 0, 'created_at': '2024-01-01 00:00:00'}
+            main4.save_channel(channel_id)
+        elif chat_id not in main4.chats:
+            main4.chats[chat_id] = {'id': chat_id, 'title': f"Чат {chat_id}", 'type': 'supergroup', 'members': [],
+                                    'messages_count': 0, 'created_at': '2024-01-01 00:00:00'}
+            main4.save_chat(chat_id)
+        elif user_id not in main4.users:
+            main4.users[user_id] = {'id': user_id, 'first_name': f"Имя {user_id}", 'last_name': None,
+                                    'username': f"user_{user_id}", 'joined_at': '2024-02-01 10:00:00',
+                                    'messages_count': 0, 'reactions_received': 0, 'chats': [], 'channels': [],
+                                    'language': 'ru'}
+            main4.save_user(user_id)
+        elif action < 0.3:
+            main4.increment_counter('users', user_id, 'messages_count', rnd.randrange(1, 4))
+            main4.increment_counter('chats', chat_id, 'messages_count')
+            main4.increment_counter('chats', chat_id, 'member_messages', 1, member_id=user_id)
+        elif action < 0.45:
+            main4.count_activity('users', user_id, 'messages_count')
+            main4.count_user_activity(user_id, rnd.randrange(1, 3))
+        elif action < 0.6:
+            main4.add_chat_member(chat_id, user_id)
+        elif action < 0.7:
+            main4.remove_chat_member(chat_id, user_id)
+        elif action < 0.8:
+            main4.set_entity_field('users', user_id, 'first_name', f"Имя {rnd.randrange(1000)}")
+        elif action < 0.85:
+            main4.set_entity_field('users', user_id, 'notifications', rnd.random() < 0.5)
+        elif action < 0.87:
+            main4.set_user_rating(user_id, rnd.randrange(100))
+        elif action < 0.9:
+            main4.count_activity('channels', channel_id, 'posts_count')
+            main4.set_entity_field('users', user_id, 'channels', sorted({channel_id, *main4.users[user_id]['channels']}))
+        elif action < 0.95:
+            del main4.users[user_id]
+            main4.save_user(user_id)
+        else:
+            main4.delete_chat(chat_id)
+    main4.flush_data()
+
+
+def check_shards_written(storage):
+    for shard, generation in storage.shard_generations.items():
+        assert generation > 0, shard
+
+
+def check_channel_users(main4):
+    """Обратный индекс каналов совпадает со списками channels пользователей"""
+    for channel_id in main4.channels:
+        subscribers = [user_id for user_id, user in main4.users.items() if channel_id in user['channels']]
+        assert subscribers
+        assert sorted(main4.query_users_with_channel(channel_id)) == sorted(subscribers)
+
+
+def compact(main4):
+    main4.storage.compact_async()
+    main4.storage._compact_thread.join()
+
+
+@pytest.mark.parametrize('snapshot_format', ['json', 'binary'])
+def test_json_storage_replays_journal_after_compaction(main4, open_storage, snapshot, snapshot_format):
+    rnd = random.Random(5)
+    factory = lambda: main4.JsonStorage(user_shards=4, snapshot_format=snapshot_format)
+    open_storage(factory)
+    for _ in range(3):
+        mutate(main4, rnd, 400)
+        compact(main4)
+        check_shards_written(main4.storage)
+        # Изменения после снимка остаются только в журнале
+        mutate(main4, rnd, 200)
+        expected = snapshot()
+        assert expected['users'] and expected['chats']
+        check_channel_users(main4)
+        open_storage(factory)
+        assert snapshot() == expected
+        check_channel_users(main4)
+
+
+def test_json_storage_snapshot_during_updates(main4, open_storage, snapshot):
+    """Приращения, сделанные пока пишется снимок, не учитываются дважды"""
+    rnd = random.Random(6)
+    factory = lambda: main4.JsonStorage(user_shards=4)
+    open_storage(factory)
+    mutate(main4, rnd, 300)
+    user_ids = list(main4.users)
+    stop = threading.Event()
+
+    def increments():
+        while not stop.is_set():
+            main4.increment_counter('users', rnd.choice(user_ids), 'messages_count')
+
+    worker = threading.Thread(target=increments)
+    worker.start()
+    try:
+        for _ in range(5):
+            compact(main4)
+    finally:
+        stop.set()
+        worker.join()
+    main4.flush_data()
+    expected = snapshot()
+    open_storage(factory)
+    assert snapshot() == expected
+
+
+def test_json_storage_compacts_when_journal_grows(main4, open_storage, snapshot):
+    rnd = random.Random(7)
+    factory = lambda: main4.JsonStorage(user_shards=4, compact_size=2048)
+    storage = open_storage(factory)
+    mutate(main4, rnd, 500)
+    storage._compact_thread.join()
+    # Свёрнутые поколения удалены, осталось только текущее
+    assert storage.journal_generations() in ([], [storage.generation])
+    expected = snapshot()
+    open_storage(factory)
+    assert snapshot() == expected
+
+
+def test_sqlite_storage_round_trip(main4, open_storage, snapshot):
+    rnd = random.Random(8)
+    factory = lambda: main4.SqliteStorage()
+    open_storage(factory)
+    mutate(main4, rnd, 800)
+    expected = snapshot()
+    open_storage(factory)
+    assert snapshot() == expected
+    check_channel_users(main4)
+
+
+def test_legacy_data_file_is_split_into_shards(main4, open_storage, snapshot):
+    rnd = random.Random(9)
+    open_storage(lambda: main4.JsonStorage(user_shards=4))
+    mutate(main4, rnd, 600)
+    expected = snapshot()
+    # Выгрузка в JSON имеет вид прежнего data.json
+    main4.export_json('legacy.json')
+    factory = lambda: main4.JsonStorage(data_dir='migrated', journal_file='migrated.journal',
+                                        legacy_file='legacy.json', user_shards=4)
+    open_storage(factory)
+    assert snapshot() == expected
+    assert not os.path.exists('legacy.json') and os.path.exists('legacy.json.migrated')
+    assert sorted(os.listdir('migrated')) == ['channels.json', 'chats.json'] + [f"users.0{i}.json" for i in range(4)]
+    # Повторный запуск читает уже шарды
+    open_storage(factory)
+    assert snapshot() == expected
+
+
+def test_shard_count_and_format_follow_files_on_disk(main4, open_storage, snapshot):
+    rnd = random.Random(10)
+    open_storage(lambda: main4.JsonStorage(user_shards=4))
+    mutate(main4, rnd, 400)
+    compact(main4)
+    expected = snapshot()
+    # Другое число шардов в настройках не переносит пользователей между шардами
+    storage = open_storage(lambda: main4.JsonStorage(user_shards=16, snapshot_format='binary'))
+    assert storage.user_shards == 4
+    assert snapshot() == expected
+    # Шарды в прежнем формате переписываются в новом при следующем снимке
+    compact(main4)
+    assert sorted(os.listdir('data')) == ['channels.bin', 'chats.bin'] + [f"users.0{i}.bin" for i in range(4)]
+    open_storage(lambda: main4.JsonStorage(snapshot_format='binary'))
+    assert snapshot() == expected
+    open_storage(lambda: main4.JsonStorage())
+    compact(main4)
+    assert all(name.endswith('.json') for name in os.listdir('data'))
+    open_storage()
+    assert snapshot() == expected
@@ -0,0 +1,39 @@
+"""Поиск id по username для массовых команд: по индексу и параллельными запросами get_chat."""
+import threading
+import time
+from types import SimpleNamespace
+
+
+def test_resolve_usernames(main4, open_storage, monkeypatch, user):
+    open_storage()
+    main4.users['1'] = user('1', username='Alice')
+    main4.users['2'] = user('2', username='bob_2')
+    main4.users['3'] = user('3')
+    remote = {'@carol': 30, '@dave': 40, '@erin': 50}
+    requested = []
+    active = [0, 0]  # одновременных запросов сейчас и наибольшее число
+    lock = threading.Lock()
+
+    def get_chat(chat_id):
+        with lock:
+            requested.append(chat_id)
+            active[0] += 1
+            active[1] = max(active)
+        try:
+            time.sleep(0.05)
+            if chat_id not in remote:
+                raise main4.telebot.apihelper.ApiTelegramException(
+                    'getChat', None, {'error_code': 400, 'description': 'Bad Request: chat not found'})
+            return SimpleNamespace(id=remote[chat_id])
+        finally:
+            with lock:
+                active[0] -= 1
+
+    monkeypatch.setattr(main4.bot, 'get_chat', get_chat)
+    resolved, unresolved = main4.resolve_usernames(
+        ['@alice', 'BOB_2', ' @Alice ', 'carol', '@dave', 'erin', 'ghost', '@', '', '  '])
+    # Имена возвращаются так, как введены (первое из повторов); известные боту не запрашиваются
+    assert resolved == {'@alice': '1', 'BOB_2': '2', 'carol': '30', '@dave': '40', 'erin': '50'}
+    assert unresolved == ['ghost']
+    assert sorted(requested) == ['@carol', '@dave', '@erin', '@ghost']
+    assert active[1] > 1
@@ -0,0 +1,95 @@
+"""Активность пользователей: рейтинги за окна (WindowRatings) и число активных против прямого пересчёта."""
+import random
+
+
+def test_window_ratings_match_hourly_sums(main4, open_storage, monkeypatch, user):
+    rnd = random.Random(3)
+    hour = [500000]
+    monkeypatch.setattr(main4, 'current_hour', lambda: hour[0])
+    open_storage()
+    user_ids = [str(2000 + i) for i in range(60)]
+    for user_id in user_ids:
+        main4.users[user_id] = user(user_id)
+    # Модель: (id, час) -> очки
+    points = {}
+
+    def check():
+        main4.activity_counters.merge()
+        for window, hours in main4.RATING_WINDOWS.items():
+            expected = {}
+            for (user_id, point_hour), value in points.items():
+                if point_hour > hour[0] - hours and user_id in main4.users:
+                    expected[user_id] = expected.get(user_id, 0) + value
+            expected = {user_id: value for user_id, value in expected.items() if value > 0}
+            assert main4.window_ratings.count(window) == len(expected)
+            assert main4.window_ratings.members(window) == set(expected)
+            for user_id in user_ids:
+                assert main4.window_ratings.points(window, user_id) == expected.get(user_id, 0)
+            top = main4.window_ratings.top(window, 10)
+            assert [value for _, value in top] == sorted(expected.values(), reverse=True)[:10]
+            for record, value in top:
+                assert expected[record.id] == value
+                assert top[main4.window_ratings.rank(window, record.id) - 1][0] is record
+
+    check()
+    for step in range(300):
+        for _ in range(rnd.randrange(5)):
+            user_id = rnd.choice(user_ids)
+            value = rnd.randrange(1, 4)
+            main4.count_user_activity(user_id, value)
+            points[(user_id, hour[0])] = points.get((user_id, hour[0]), 0) + value
+        if step % 25 == 24:
+            # Удалённый пользователь пропадает из окон, вернувшийся начинает с нуля
+            user_id = rnd.choice(user_ids)
+            main4.activity_counters.merge()
+            main4.users[user_id] = user(user_id)
+            for key in [key for key in points if key[0] == user_id]:
+                del points[key]
+        hour[0] += rnd.choice([0, 1, 1, 2, 5, 24])
+        if step % 10 == 0:
+            check()
+    hour[0] += max(main4.RATING_WINDOWS.values())
+    check()
+    assert main4.window_ratings.count('month') == 0
+
+
+def test_active_users_follow_message_counts(main4, open_storage, user):
+    rnd = random.Random(12)
+    open_storage()
+    user_ids = [str(5000 + i) for i in range(80)]
+    for user_id in user_ids[:40]:
+        main4.users[user_id] = user(user_id, rnd.choice([0, 0, 3]))
+        main4.save_user(user_id)
+
+    def check():
+        main4.activity_counters.merge()
+        expected = sum(1 for record in main4.users.values() if record.get('messages_count', 0) > 0)
+        assert len(main4.active_users) == expected
+
+    check()
+    for step in range(600):
+        user_id = rnd.choice(user_ids)
+        action = rnd.random()
+        if user_id not in main4.users:
+            main4.users[user_id] = user(user_id)
+            main4.save_user(user_id)
+        elif action < 0.4:
+            main4.count_activity('users', user_id, 'messages_count')
+        elif action < 0.55:
+            main4.set_user_rating(user_id, rnd.choice([0, 5]))
+        elif action < 0.7:
+            main4.set_entity_field('users', user_id, 'messages_count', 0)
+        elif action < 0.85:
+            # Замена записи с тем же id
+            main4.users[user_id] = user(user_id, rnd.choice([0, 2]))
+            main4.save_user(user_id)
+        else:
+            del main4.users[user_id]
+            main4.save_user(user_id)
+        if step % 50 == 0:
+            check()
+    check()
+    # После перезапуска число строится заново по загруженным данным
+    main4.flush_data()
+    open_storage()
+    check()